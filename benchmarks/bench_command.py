@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""Micro-benchmarks of Command construction and Run overhead.
+
+USAGE
+    python3 benchmarks/bench_command.py
+"""
+import timeit
+
+from pysh import *
+
+
+def bench(name: str, stmt, number: int) -> None:
+    best = min(timeit.repeat(stmt, number=number, repeat=5))
+    print(f"{name:<32} {best / number * 1e6:10.2f} us")
+
+
+def main() -> None:
+    base = git("-C", "/tmp")
+    bench("derive command", lambda: base("log", "--oneline", o=None), 20000)
+
+    def pipeline(n: int) -> Command:
+        cmd = echo_("x")
+        for _ in range(n):
+            cmd = cmd | sed("s/x/y/")
+        return cmd
+
+    for n in (1, 8, 32):
+        bench(f"build {n}-stage pipeline", lambda: pipeline(n), 2000 // n)
+    long = pipeline(32)
+    bench("extend 32-stage pipeline", lambda: long(o=None), 2000)
+    bench("Run(true)", lambda: Run("true"), 200)
+    bench("Run(echo | 8 x sed)", lambda: Run(pipeline(8), o=None), 50)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+"""Spawn latency of a parent with a large heap, with and without the fork server.
+
+USAGE
+    python3 benchmarks/bench_forkserver.py [heap size in MiB]
+"""
+import sys
+import timeit
+
+from pysh import *
+
+
+def bench(name: str, stmt, number: int) -> None:
+    best = min(timeit.repeat(stmt, number=number, repeat=5))
+    print(f"{name:<40} {best / number * 1e6:10.2f} us")
+
+
+def main() -> None:
+    # Started while the parent is still small
+    forkserver = ForkServerBackend()
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    heap = [bytearray(1 << 20) for _ in range(size)]
+    for chunk in heap:
+        chunk[::4096] = b"x" * len(chunk[::4096])
+    for backend in (PopenBackend(), forkserver):
+        set_spawn_backend(backend)
+        name = f"{type(backend).__name__} ({size} MiB heap)"
+        bench(f"{name}: Run(true)", lambda: Run("true"), 100)
+    forkserver.close()
+
+
+if __name__ == "__main__":
+    main()
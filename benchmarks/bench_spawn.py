@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+"""Compares the spawn backends on short-lived commands.
+
+USAGE
+    python3 benchmarks/bench_spawn.py
+"""
+import subprocess
+import timeit
+
+from pysh import *
+
+
+def bench(name: str, stmt, number: int) -> None:
+    best = min(timeit.repeat(stmt, number=number, repeat=5))
+    print(f"{name:<40} {best / number * 1e6:10.2f} us")
+
+
+def main() -> None:
+    pipe = echo_("x") | grep("x") | head("-n1") | sed("s/x/y/")
+    bench("subprocess.run(true)", lambda: subprocess.run(["true"]), 200)
+    builtins = echo_("b\na") | sort | head("-n1")
+    for backend in (PopenBackend(), PosixSpawnBackend(), BuiltinBackend()):
+        set_spawn_backend(backend)
+        name = type(backend).__name__
+        bench(f"{name}: Run(true)", lambda: Run("true"), 200)
+        bench(f"{name}: Cap(4-stage pipeline)", lambda: Cap(pipe), 100)
+        bench(f"{name}: Cap(echo | sort | head)", lambda: Cap(builtins), 100)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""The benchmark suite of pysh, with machine-readable results.
+
+USAGE
+    # Measure and save the results
+    python3 benchmarks/suite.py -o baseline.json
+    # After upgrading pysh, measure again and compare
+    python3 benchmarks/suite.py -o new.json --compare baseline.json
+
+The comparison exits with status 1 if any benchmark got worse by more than
+--threshold (10% by default). Use -k to only run benchmarks whose name
+contains a substring.
+
+Results are JSON:
+    {"meta": {...}, "results": {name: {"value", "unit", "better"}}}
+where better is "lower" or "higher".
+"""
+import argparse
+import copy
+import json
+import platform
+import subprocess
+import sys
+import time
+import timeit
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable
+
+import pysh
+from pysh import *
+
+MiB = 1 << 20
+
+# name -> function returning (value, unit, better)
+BENCHMARKS: dict[str, Callable[[], tuple[float, str, str]]] = {}
+
+
+def benchmark(name: str) -> Callable:
+    def register(fn: Callable) -> Callable:
+        BENCHMARKS[name] = fn
+        return fn
+
+    return register
+
+
+def best_us(stmt: Callable[[], Any], number: int) -> tuple[float, str, str]:
+    """Best time per call over several repeats, in microseconds."""
+    best = min(timeit.repeat(stmt, number=number, repeat=5))
+    return best / number * 1e6, "us", "lower"
+
+
+def zeros(size: int) -> Command:
+    return Command("head", "-c", str(size), "/dev/zero")
+
+
+@benchmark("command.construct")
+def _() -> tuple[float, str, str]:
+    return best_us(lambda: Command("git", "log", "--oneline", o=None), 20000)
+
+
+@benchmark("command.derive")
+def _() -> tuple[float, str, str]:
+    base = git("-C", "/tmp")
+    return best_us(lambda: base("log", "--oneline", o=None), 20000)
+
+
+@benchmark("command.deepcopy_32_stages")
+def _() -> tuple[float, str, str]:
+    cmd = echo_("x")
+    for _ in range(32):
+        cmd = cmd | sed("s/x/y/")
+    return best_us(lambda: copy.deepcopy(cmd), 20000)
+
+
+@benchmark("spawn.subprocess_run")
+def _() -> tuple[float, str, str]:
+    return best_us(lambda: subprocess.run(["true"]), 200)
+
+
+@benchmark("spawn.Run")
+def _() -> tuple[float, str, str]:
+    return best_us(lambda: Run("true"), 200)
+
+
+def pipeline_throughput(stages: int) -> tuple[float, str, str]:
+    size = 256 * MiB
+    cmd = zeros(size)
+    for _ in range(stages):
+        cmd = cmd | cat_
+    best = min(timeit.repeat(lambda: Run(cmd, o=None, strict=True), number=1, repeat=3))
+    return size / MiB / best, "MB/s", "higher"
+
+
+for _stages in (1, 4, 8):
+    benchmark(f"pipeline.throughput_{_stages}_cat")(
+        lambda stages=_stages: pipeline_throughput(stages)
+    )
+
+
+@benchmark("cap.time_64MiB")
+def _() -> tuple[float, str, str]:
+    cmd = zeros(64 * MiB)
+    best = min(timeit.repeat(lambda: Cap(cmd, text=False), number=1, repeat=5))
+    return best * 1e3, "ms", "lower"
+
+
+@benchmark("cap.peak_memory_64MiB")
+def _() -> tuple[float, str, str]:
+    """Peak Python allocations while capturing, the ideal being one copy."""
+    cmd = zeros(64 * MiB)
+    tracemalloc.start()
+    try:
+        Cap(cmd, text=False)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / MiB, "MiB", "lower"
+
+
+@benchmark("cap.peak_memory_64MiB_spill")
+def _() -> tuple[float, str, str]:
+    """Peak Python allocations while capturing past the spill threshold."""
+    cmd = zeros(64 * MiB)
+    tracemalloc.start()
+    try:
+        Cap(cmd, text=False, keep=Spill("1MiB")).close()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / MiB, "MiB", "lower"
+
+
+@benchmark("timeout.overhead")
+def _() -> tuple[float, str, str]:
+    """Extra cost of passing a timeout to a command that does not hit it."""
+    with_timeout = best_us(lambda: Run("true", timeout=60), 200)[0]
+    return with_timeout - best_us(lambda: Run("true"), 200)[0], "us", "lower"
+
+
+@benchmark("timeout.latency")
+def _() -> tuple[float, str, str]:
+    """How late a timed out command is reported, after the timeout expired."""
+    lateness = []
+    for _ in range(5):
+        start = time.perf_counter()
+        Run("sleep", "5", timeout=0.05)
+        lateness.append(time.perf_counter() - start - 0.05)
+    return min(lateness) * 1e6, "us", "lower"
+
+
+def run(names: list[str]) -> dict[str, Any]:
+    results = {}
+    for name in names:
+        value, unit, better = BENCHMARKS[name]()
+        results[name] = {"value": value, "unit": unit, "better": better}
+        print(f"{name:<36} {value:12.2f} {unit}", file=sys.stderr)
+    return {
+        "meta": {
+            "pysh": str(Path(pysh.__file__).parent),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        },
+        "results": results,
+    }
+
+
+def compare(
+    baseline: dict[str, Any], current: dict[str, Any], threshold: float
+) -> bool:
+    """Prints the change of every benchmark. Returns whether none regressed."""
+    ok = True
+    print(f"{'benchmark':<36} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name, cur in current["results"].items():
+        if (base := baseline["results"].get(name, None)) is None:
+            continue
+        change = cur["value"] / base["value"] - 1 if base["value"] else 0.0
+        worse = change > threshold if cur["better"] == "lower" else change < -threshold
+        ok = ok and not worse
+        print(
+            f"{name:<36} {base['value']:12.2f} {cur['value']:12.2f} {change:+8.1%}"
+            + ("  REGRESSION" if worse else "")
+        )
+    return ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-o", "--output", type=Path, help="where to save the results")
+    parser.add_argument("-k", dest="filter", default="", help="name substring")
+    parser.add_argument("--compare", type=Path, help="baseline results")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args()
+
+    current = run([name for name in BENCHMARKS if args.filter in name])
+    if args.output is not None:
+        args.output.write_text(json.dumps(current, indent=2) + "\n")
+    else:
+        print(json.dumps(current, indent=2))
+    if args.compare is not None:
+        baseline = json.loads(args.compare.read_text())
+        sys.exit(0 if compare(baseline, current, args.threshold) else 1)
+
+
+if __name__ == "__main__":
+    main()
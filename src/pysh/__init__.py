@@ -1,37 +1,194 @@
-from .exec import Run, Cap
-from .command import Command, CommitResult, CommitResKind
-from .errors import PyShError, PyShCommitError
-from .contexts import ChDir
-
-from .prelude import (
-    chmod,
-    fd,
-    tr,
-    find,
-    git,
-    git,
-    grep,
-    head,
-    make,
-    rg,
-    sed,
-    sort,
-    tail,
-    vim,
-    touch,
-    ls_,
-    echo_,
-    cat_,
-    cp_,
-    mkdir_,
-    rm_,
-    mv_,
-    tee_,
-)
-
 # version check
 import sys
 
 if sys.version_info < (3, 11):
     print(f"Pysh runs on python >= 3.11. Got:\n{sys.version}", file=sys.stderr)
     exit(1)
+
+from types import MappingProxyType
+from typing import TYPE_CHECKING, Any
+
+from . import prelude
+
+# name -> submodule defining it.
+# Submodules are imported on first access (PEP 562), so that a script only
+# pays for what it uses. `import pysh` itself imports almost nothing.
+_LAZY = MappingProxyType(
+    {
+        "Run": "exec",
+        "Cap": "exec",
+        "Parallel": "exec",
+        "Xargs": "exec",
+        "ARun": "aexec",
+        "ACap": "aexec",
+        "Stream": "stream",
+        "Command": "command",
+        "CommitResult": "command",
+        "CommitResKind": "command",
+        "Pipeline": "pipeline",
+        "StageResult": "pipeline",
+        "PopenBackend": "spawn",
+        "PosixSpawnBackend": "spawn",
+        "Rusage": "spawn",
+        "set_spawn_backend": "spawn",
+        "ForkServerBackend": "forkserver",
+        "BuiltinBackend": "builtin",
+        "ResultCache": "cache",
+        "Tracer": "trace",
+        "set_tracer": "trace",
+        "Coproc": "coproc",
+        "CoprocPool": "coproc",
+        "LineFraming": "coproc",
+        "LengthPrefixFraming": "coproc",
+        "PyShError": "errors",
+        "PyShCommitError": "errors",
+        "PyShCoprocError": "errors",
+        "ChDir": "contexts",
+        "Deadline": "contexts",
+        "Session": "contexts",
+        "Batch": "batch",
+        "PyFilter": "pyfilter",
+        "Tee": "tee",
+        "Plan": "plan",
+        "KeepHead": "capture",
+        "KeepTail": "capture",
+        "Spill": "capture",
+        "SpilledOutput": "capture",
+        "Agent": "agent",
+        "AgentServer": "agent",
+        "HereDoc": "heredoc",
+    }
+)
+
+# Literal, so that type checkers understand `from pysh import *`
+__all__ = [
+    "Run",
+    "Cap",
+    "Parallel",
+    "Xargs",
+    "ARun",
+    "ACap",
+    "Stream",
+    "Command",
+    "CommitResult",
+    "CommitResKind",
+    "Pipeline",
+    "StageResult",
+    "PopenBackend",
+    "PosixSpawnBackend",
+    "Rusage",
+    "set_spawn_backend",
+    "ForkServerBackend",
+    "BuiltinBackend",
+    "ResultCache",
+    "Tracer",
+    "set_tracer",
+    "Coproc",
+    "CoprocPool",
+    "LineFraming",
+    "LengthPrefixFraming",
+    "PyShError",
+    "PyShCommitError",
+    "PyShCoprocError",
+    "ChDir",
+    "Deadline",
+    "Session",
+    "Batch",
+    "PyFilter",
+    "Tee",
+    "Plan",
+    "KeepHead",
+    "KeepTail",
+    "Spill",
+    "SpilledOutput",
+    "Agent",
+    "AgentServer",
+    "HereDoc",
+    "chmod",
+    "fd",
+    "tr",
+    "find",
+    "git",
+    "grep",
+    "head",
+    "make",
+    "rg",
+    "sed",
+    "sort",
+    "tail",
+    "vim",
+    "touch",
+    "ls_",
+    "echo_",
+    "cat_",
+    "cp_",
+    "mkdir_",
+    "rm_",
+    "mv_",
+    "tee_",
+]
+assert set(__all__) == {*_LAZY, *prelude.PRELUDE}
+
+
+def __getattr__(name: str) -> Any:
+    if name in prelude.PRELUDE:
+        value = getattr(prelude, name)
+    elif (module := _LAZY.get(name, None)) is not None:
+        import importlib
+
+        value = getattr(importlib.import_module(f".{module}", __name__), name)
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> list[str]:
+    return sorted(set(globals()) | set(__all__))
+
+
+if TYPE_CHECKING:
+    from .exec import Run, Cap, Parallel, Xargs
+    from .aexec import ARun, ACap
+    from .stream import Stream
+    from .command import Command, CommitResult, CommitResKind
+    from .pipeline import Pipeline, StageResult
+    from .spawn import PopenBackend, PosixSpawnBackend, Rusage, set_spawn_backend
+    from .forkserver import ForkServerBackend
+    from .builtin import BuiltinBackend
+    from .cache import ResultCache
+    from .trace import Tracer, set_tracer
+    from .coproc import Coproc, CoprocPool, LineFraming, LengthPrefixFraming
+    from .errors import PyShError, PyShCommitError, PyShCoprocError
+    from .contexts import ChDir, Deadline, Session
+    from .batch import Batch
+    from .pyfilter import PyFilter
+    from .tee import Tee
+    from .plan import Plan
+    from .capture import KeepHead, KeepTail, Spill, SpilledOutput
+    from .agent import Agent, AgentServer
+    from .heredoc import HereDoc
+    from .prelude import (
+        chmod,
+        fd,
+        tr,
+        find,
+        git,
+        grep,
+        head,
+        make,
+        rg,
+        sed,
+        sort,
+        tail,
+        vim,
+        touch,
+        ls_,
+        echo_,
+        cat_,
+        cp_,
+        mkdir_,
+        rm_,
+        mv_,
+        tee_,
+    )
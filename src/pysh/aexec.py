@@ -0,0 +1,278 @@
+import os
+import signal
+import subprocess
+import time
+from typing import TYPE_CHECKING, Any, Literal, overload
+
+from . import capture, contexts, trace
+from .command import Command, CommitResult, CommitResKind
+from .contexts import effective_timeout, in_session
+from .errors import PyShCommitError, PyShError
+from .pipeline import Pipeline, StageResult
+from .utils import *
+
+# asyncio is imported on first use, it would double the import time of pysh
+if TYPE_CHECKING:
+    import asyncio
+
+
+async def ARun(cmd: str | Command, *args: str, **kwargs: Any) -> CommitResult:
+    """Coroutine version of Run().
+    Supervises the child processes from the running event loop, without
+    blocking a thread per child.
+
+    USAGE
+        res = await ARun(git, "fetch", timeout=60)
+        results = await asyncio.gather(*(ARun(git("-C", d, "pull")) for d in dirs))
+
+    Keyword arguments: see Run(). input may also be an async iterable.
+
+    Inside `with Batch():` the command is queued as with Run(), and using
+    its result runs the queue without yielding to the event loop. Unlike
+    Run(), the commands run in this process even inside `with Agent(...)`,
+    and the stages have no rusage.
+    """
+    (suppress, capture) = multipop_dict(kwargs, suppress=False, capture=False)
+    if isinstance(cmd, str):
+        cmd = Command(cmd)
+    try:
+        if capture:
+            kwargs = {"o": subprocess.PIPE, "e": subprocess.PIPE} | kwargs
+        return await _acommit(cmd, *args, **kwargs)
+    except Exception as e:
+        if not suppress:
+            raise
+        return CommitResult(CommitResKind.CRITICAL, None, "", "", None)
+
+
+@overload
+async def ACap(
+    cmd: str | Command,
+    *args: str,
+    keep: capture.Spilling,
+    **kwargs: Any,
+) -> capture.SpilledOutput:
+    ...
+
+
+@overload
+async def ACap(
+    cmd: str | Command,
+    *args: str,
+    text: Literal[False],
+    keep: capture.InMemory = None,
+    **kwargs: Any,
+) -> bytes:
+    ...
+
+
+@overload
+async def ACap(
+    cmd: str | Command,
+    *args: str,
+    text: Literal[True] = True,
+    keep: capture.InMemory = None,
+    **kwargs: Any,
+) -> str:
+    ...
+
+
+async def ACap(
+    cmd: str | Command, *args: str, **kwargs: Any
+) -> str | bytes | capture.SpilledOutput:
+    """Coroutine version of Cap().
+
+    Keyword arguments: see Cap().
+    """
+    (strip,) = multipop_dict(kwargs, strip=True)
+    res = await ARun(cmd, *args, **{"o": subprocess.PIPE} | kwargs)
+    stdout = res.stdout
+    if strip and isinstance(stdout, (str, bytes)):
+        return stdout.strip()
+    else:
+        return stdout
+
+
+async def _acommit(cmd: Command, *args: str, **kwargs: Any) -> CommitResult:
+    """Async counterpart of Command.commit()."""
+    RUN_KEYS = ["timeout", "input", "strict", "cache"]
+    run_kwargs = project_dict(kwargs, *RUN_KEYS)
+    kwargs = dict(kv for kv in kwargs.items() if kv[0] not in RUN_KEYS)
+    input = run_kwargs.get("input", None)
+    cmd = in_session(cmd.update(*args, **kwargs), input is not None)
+    timeout = effective_timeout(run_kwargs.get("timeout", None))
+    if (batch := contexts._batch.get()) is not None:
+        if (pending := batch.add(cmd, timeout, run_kwargs)) is not None:
+            return pending
+
+    async def run() -> CommitResult:
+        return await _arun(cmd, input, timeout)
+
+    match run_kwargs.get("cache", None):
+        case None | False:
+            res = await run()
+        case True:
+            from . import cache
+
+            res = await cache.default_cache.afetch(cmd, input, run)
+        case result_cache:
+            res = await result_cache.afetch(cmd, input, run)
+    if res.kind != CommitResKind.SUCCESS and run_kwargs.get("strict", False):
+        raise PyShCommitError(res)
+    return res
+
+
+async def _arun(cmd: Command, input: Any, timeout: float | None) -> CommitResult:
+    """Runs cmd from the event loop. Pipeline stages are connected with OS
+    pipes, so the data flowing between them never passes through Python."""
+    import asyncio
+
+    stages = Pipeline.unfold(cmd)
+    if any("pystage" in stage.kwargs for stage in stages):
+        raise PyShError("Python stages are not supported by ARun(), use Run()")
+    pgroup = cmd.kwargs.get("pgroup", timeout is not None)
+    pgids: list[int] = []
+
+    time_start = time.perf_counter()
+    procs: "list[asyncio.subprocess.Process]" = []
+    starts: list[float] = []
+    prev_read: int | None = None
+    try:
+        for idx, stage in enumerate(stages):
+            popen_kwargs = stage._popen_kwargs()
+            if prev_read is not None:
+                popen_kwargs["stdin"] = prev_read
+            elif input is not None and "stdin" not in popen_kwargs:
+                popen_kwargs["stdin"] = subprocess.PIPE
+            if idx != len(stages) - 1:
+                prev_read, popen_kwargs["stdout"] = os.pipe()
+            else:
+                prev_read = None
+            if pgroup:
+                popen_kwargs["process_group"] = next(iter(pgids), 0)
+            try:
+                starts.append(time.perf_counter())
+                procs.append(
+                    await asyncio.create_subprocess_exec(*stage.args, **popen_kwargs)
+                )
+                if pgroup and not pgids:
+                    pgids.append(procs[0].pid)
+            finally:
+                # The child owns its copies of the descriptors now
+                _close_parent_ends(popen_kwargs)
+    except BaseException:
+        if prev_read is not None:
+            os.close(prev_read)
+        _signal(procs, pgids, signal.SIGKILL)
+        raise
+
+    first, last = procs[0], procs[-1]
+    outputs = capture.sinks(stages[-1])
+    ends: list[float | None] = [None] * len(procs)
+
+    async def wait(idx: int) -> None:
+        await procs[idx].wait()
+        ends[idx] = ends[idx] or time.perf_counter()
+
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(
+                _feed(first.stdin, input),
+                _drain(last.stdout, outputs["stdout"]),
+                _drain(last.stderr, outputs["stderr"]),
+                *(wait(idx) for idx in range(len(procs))),
+            ),
+            timeout,
+        )
+        retcode = last.returncode
+        kind = CommitResKind.SUCCESS if retcode == 0 else CommitResKind.FAILED
+    except TimeoutError:
+        retcode = last.returncode
+        kind = CommitResKind.TIMEOUT
+        # Like Pipeline.terminate()
+        _signal(procs, pgids, signal.SIGTERM)
+        waits = asyncio.gather(*(wait(idx) for idx in range(len(procs))))
+        try:
+            await asyncio.wait_for(
+                asyncio.shield(waits),
+                timeout_to_seconds(stages[-1].kwargs.get("kill_after", 1)),
+            )
+        except TimeoutError:
+            pass
+        _signal(procs, pgids, signal.SIGKILL)
+        await waits
+    except BaseException:
+        _signal(procs, pgids, signal.SIGKILL)
+        raise
+    elapsed = time.perf_counter() - time_start
+    for stage, proc, start, end in zip(stages, procs, starts, ends):
+        trace.record(stage, proc.pid, start, end, proc.returncode)
+    return CommitResult(
+        kind,
+        retcode,
+        stdout=outputs["stdout"].value(),
+        stderr=outputs["stderr"].value(),
+        elapsed=elapsed,
+        stages=[
+            StageResult(
+                stage.args,
+                proc.pid,
+                proc.returncode,
+                None if end is None else end - start,
+            )
+            for stage, proc, start, end in zip(stages, procs, starts, ends)
+        ],
+    )
+
+
+async def _feed(stream: "asyncio.StreamWriter | None", input: Any) -> None:
+    """Writes input one chunk at a time, waiting for the stage to read each.
+    Async iterables are supported on top of what Run() accepts."""
+    if stream is None:
+        return
+    try:
+        if hasattr(input, "__aiter__"):
+            async for chunk in input:
+                stream.write(chunk.encode() if isinstance(chunk, str) else chunk)
+                await stream.drain()
+        else:
+            for chunk in input_chunks(input):
+                stream.write(chunk)
+                await stream.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        pass
+    finally:
+        stream.close()
+
+
+async def _drain(stream: "asyncio.StreamReader | None", sink: Any) -> None:
+    if stream is None:
+        return
+    while chunk := await stream.read(65536):
+        sink.write(chunk)
+
+
+def _close_parent_ends(popen_kwargs: dict[str, Any]) -> None:
+    for key in ("stdin", "stdout", "stderr"):
+        match popen_kwargs.get(key, None):
+            case int(fd) if fd >= 0:
+                os.close(fd)
+            case f if hasattr(f, "close"):
+                f.close()
+
+
+def _signal(
+    procs: "list[asyncio.subprocess.Process]", pgids: list[int], sig: int
+) -> None:
+    """Signals the running processes and their process groups."""
+    for pgid in pgids:
+        try:
+            os.killpg(pgid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+    for proc in procs:
+        if proc.returncode is None:
+            try:
+                proc.send_signal(sig)
+            except ProcessLookupError:
+                pass
@@ -0,0 +1,547 @@
+"""Runs commands in a long-lived agent process, over a Unix socket.
+
+USAGE
+    # Once per host or per user, e.g. from a service manager
+    python3 -m pysh.agent /run/user/1000/pysh.sock --jobs 16
+
+    # In every script
+    with Agent("/run/user/1000/pysh.sock"):
+        Run(make, "-j8")               # runs in the agent
+        branch = Cap(git, "branch", "--show-current")
+
+Scripts share the worker pool of the agent and its spawn backend. Commands
+run in the cwd and with the environment of the script. posix_spawn cannot
+change the cwd, so only commands run in the cwd of the agent use it and
+the executables it already resolved through PATH, the others are spawned
+with Popen. The stdin, stdout and stderr of the script are passed to the
+agent, so that commands read from and write to them as with a local Run().
+
+Only processes of the user running the agent may connect. The socket is
+only accessible to that user, in a directory no one else can access.
+
+Captured output and input= are streamed over the socket as the command
+produces and consumes them. keep=, text= and the like apply in the script.
+Timeouts, including Deadlines, are enforced by the agent. When the script
+is interrupted or exits, the agent kills its commands.
+
+Python stages, like PyFilter and Tee, cannot be sent to an agent. ARun()
+and ACap() do not use the agent, their commands run in the script.
+
+PROTOCOL
+    SOCK_SEQPACKET messages: one line of JSON, then raw data. Every message
+    has a "type" and the "id" of the command it is about.
+    script -> agent
+        run     stages, cwd, env, timeout, input. Carries the fds 0, 1, 2
+                of the script.
+        input   input data, empty at the end of the input.
+        cancel  kills the command.
+    agent -> script
+        output  stream, "stdout" or "stderr", then the data.
+        more    an input message was consumed, another one may be sent.
+        result  kind, retcode, elapsed, stages, like CommitResult.
+        error   errno, strerror, filename for an OSError, else message.
+"""
+import dataclasses
+import os
+import queue
+import socket
+import struct
+import sys
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Iterable, Iterator, Self
+
+from . import capture, contexts
+from .command import Command, CommitResKind, CommitResult
+from .errors import PyShError
+from .pipeline import Pipeline, StageResult
+from .spawn import PosixSpawnBackend, Rusage, set_spawn_backend
+from .utils import input_chunks
+
+if TYPE_CHECKING:
+    from concurrent.futures import ThreadPoolExecutor
+
+MAX_MESSAGE = 1 << 20
+# Input data per message
+CHUNK = 65536
+# Kwargs that only matter in the script, or that it sends in another form
+_LOCAL = {"pipefrom", "text", "encoding", "errors", "keep"}
+
+
+class Agent:
+    """A connection to an agent, see the module documentation.
+    Inside `with Agent(path):`, Run(), Cap() and whatever uses them in
+    this context run their commands in the agent."""
+
+    # Input messages sent ahead of what the agent consumed
+    WINDOW = 4
+
+    def __init__(self, path: str | Path) -> None:
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            self._sock.connect(os.fspath(path))
+        except BaseException:
+            self._sock.close()
+            raise
+        self._send_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._next_id = 0
+        self._calls: dict[int, _Call] = {}
+        self._closed = False
+        self._token: Any = None
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._reader.start()
+
+    def __enter__(self) -> Self:
+        self._token = contexts._agent.set(self)
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        contexts._agent.reset(self._token)
+        self.close()
+
+    def close(self) -> None:
+        """Disconnects. The agent kills the commands still running."""
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._reader.join()
+        self._sock.close()
+
+    def run(
+        self, cmd: Command, input: Any = None, timeout: float | None = None
+    ) -> CommitResult:
+        """Runs cmd in the agent, like Pipeline.communicate()."""
+        message = {
+            "type": "run",
+            "stages": [_encode(stage) for stage in Pipeline.unfold(cmd)],
+            "cwd": os.getcwd(),
+            "env": dict(os.environ),
+            "timeout": timeout,
+            "input": input is not None,
+        }
+        call = _Call(capture.sinks(cmd), self.WINDOW)
+        with self._cond:
+            if self._closed:
+                raise PyShError("The agent is not running")
+            self._next_id += 1
+            message["id"] = req_id = self._next_id
+            self._calls[req_id] = call
+        try:
+            fds, to_close = _stdio()
+            try:
+                try:
+                    self._send(message, b"", fds)
+                finally:
+                    for fd in to_close:
+                        os.close(fd)
+                if input is not None:
+                    self._feed(req_id, call, input)
+            except (BrokenPipeError, ConnectionResetError) as e:
+                raise PyShError("The agent closed the connection") from e
+            with self._cond:
+                self._cond.wait_for(lambda: call.reply is not None or self._closed)
+        except BaseException:
+            # e.g. KeyboardInterrupt, the command must not outlive the call
+            try:
+                self._send({"type": "cancel", "id": req_id})
+            except OSError:
+                pass
+            raise
+        finally:
+            with self._cond:
+                del self._calls[req_id]
+        return call.result()
+
+    def _feed(self, req_id: int, call: "_Call", input: Any) -> None:
+        """Sends input as the agent consumes it, at most WINDOW messages ahead."""
+        for chunk in input_chunks(input, CHUNK):
+            for pos in range(0, len(chunk), CHUNK):
+                with self._cond:
+                    self._cond.wait_for(
+                        lambda: call.credit or call.reply is not None or self._closed
+                    )
+                    if call.reply is not None or self._closed:
+                        # Done without reading all of it, like `head`
+                        return
+                    call.credit -= 1
+                self._send({"type": "input", "id": req_id}, chunk[pos : pos + CHUNK])
+        self._send({"type": "input", "id": req_id}, b"")
+
+    def _send(
+        self, message: dict[str, Any], data: bytes = b"", fds: Iterable[int] = ()
+    ) -> None:
+        import json
+
+        with self._send_lock:
+            packet = json.dumps(message).encode() + b"\n" + data
+            socket.send_fds(self._sock, [packet], fds)
+
+    def _read_loop(self) -> None:
+        import json
+
+        try:
+            while packet := self._sock.recv(MAX_MESSAGE):
+                header, _, data = packet.partition(b"\n")
+                message = json.loads(header)
+                with self._cond:
+                    call = self._calls.get(message["id"], None)
+                    if call is None:
+                        continue
+                    if message["type"] == "more":
+                        call.credit += 1
+                    elif message["type"] != "output":
+                        call.reply = message
+                    self._cond.notify_all()
+                if message["type"] == "output":
+                    # Only this thread writes to the sinks until the reply
+                    call.sinks[message["stream"]].write(data)
+        except OSError:
+            pass
+        finally:
+            with self._cond:
+                self._closed = True
+                self._cond.notify_all()
+
+
+class _Call:
+    """A command running in the agent, as seen from the script."""
+
+    def __init__(self, sinks: dict[str, Any], credit: int) -> None:
+        self.sinks = sinks
+        self.credit = credit
+        self.reply: dict[str, Any] | None = None
+
+    def result(self) -> CommitResult:
+        match self.reply:
+            case None:
+                raise PyShError(
+                    "The connection to the agent closed before the command ended"
+                )
+            case {"type": "error", "errno": errno, **rest}:
+                raise OSError(errno, rest["strerror"], rest["filename"])
+            case {"type": "error", "message": message}:
+                raise PyShError(f"The agent failed to run the command: {message}")
+        reply = self.reply
+        stages = [
+            StageResult(
+                tuple(stage["args"]),
+                stage["pid"],
+                stage["retcode"],
+                stage["elapsed"],
+                stage["rusage"] and Rusage(**stage["rusage"]),
+            )
+            for stage in reply["stages"]
+        ]
+        return CommitResult(
+            CommitResKind[reply["kind"]],
+            reply["retcode"],
+            stdout=self.sinks["stdout"].value(),
+            stderr=self.sinks["stderr"].value(),
+            elapsed=reply["elapsed"],
+            stages=stages,
+        )
+
+
+def _encode(stage: Command) -> dict[str, Any]:
+    """A stage as JSON, with paths made absolute."""
+    kwargs: dict[str, Any] = {}
+    for name, value in stage.kwargs.items():
+        if name in _LOCAL:
+            continue
+        if name == "pystage":
+            raise PyShError("Python stages cannot run in an agent, use Run()")
+        if name in ("i", "o", "a", "e", "cwd") and isinstance(value, (str, Path)):
+            value = os.path.abspath(value)
+        elif name == "env" and value is not None:
+            value = dict(value)
+        elif not isinstance(value, (str, int, float, bool, type(None))):
+            raise PyShError(f"Cannot send {name}={value!r} to an agent")
+        kwargs[name] = value
+    return {"args": [os.fsdecode(arg) for arg in stage.args], "kwargs": kwargs}
+
+
+def _stdio() -> tuple[list[int], list[int]]:
+    """The fds 0, 1 and 2 of this process, /dev/null for closed ones.
+    Returns them and the ones to close once sent."""
+    fds, to_close = [], []
+    for fd in range(3):
+        try:
+            os.fstat(fd)
+        except OSError:
+            fd = os.open(os.devnull, os.O_RDWR)
+            to_close.append(fd)
+        fds.append(fd)
+    return fds, to_close
+
+
+class AgentServer:
+    """Runs the commands of every connected Agent, at most jobs at a time.
+
+    The directory of path is created if needed. It must not be accessible
+    to other users, so that they cannot replace the socket.
+
+    USAGE
+        server = AgentServer(f"/run/user/{os.getuid()}/pysh.sock", jobs=8)
+        threading.Thread(target=server.serve_forever).start()
+        ...
+        server.close()
+    """
+
+    def __init__(self, path: str | Path, jobs: int | None = None) -> None:
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.path = Path(path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            self._bind()
+        except BaseException:
+            self._sock.close()
+            raise
+        self.pool: "ThreadPoolExecutor" = ThreadPoolExecutor(
+            max_workers=jobs or os.cpu_count() or 1
+        )
+
+    def _bind(self) -> None:
+        self.path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        st = self.path.parent.stat()
+        if st.st_uid != os.getuid() or st.st_mode & 0o077:
+            raise PyShError(f"{self.path.parent} must be private to its owner")
+        if self.path.exists():
+            with socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET) as probe:
+                try:
+                    probe.connect(os.fspath(self.path))
+                except ConnectionRefusedError:
+                    # Left behind by an agent that did not exit cleanly
+                    self.path.unlink()
+                else:
+                    raise PyShError(f"An agent is already listening on {self.path}")
+        self._sock.bind(os.fspath(self.path))
+        # Clients connect as soon as the path exists. Until the chmod, the
+        # directory keeps other users out.
+        self._sock.listen()
+        os.chmod(self.path, 0o600)
+
+    def serve_forever(self) -> None:
+        """Accepts connections until close() is called."""
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                return
+            if not _same_user(conn):
+                conn.close()
+                continue
+            threading.Thread(target=_Connection(conn, self).serve, daemon=True).start()
+
+    def close(self) -> None:
+        """Stops accepting connections and waits for the running commands."""
+        # Wakes up accept()
+        self._sock.shutdown(socket.SHUT_RDWR)
+        self._sock.close()
+        self.path.unlink(missing_ok=True)
+        self.pool.shutdown(wait=True)
+
+
+def _same_user(conn: socket.socket) -> bool:
+    """Whether the peer of conn runs as the user of this process."""
+    if not hasattr(socket, "SO_PEERCRED"):
+        # Only the permissions of the socket protect it then
+        return True
+    creds = conn.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+    )
+    _, uid, _ = struct.unpack("3i", creds)
+    return uid == os.getuid()
+
+
+class _Connection:
+    """The commands of one Agent, as seen from the agent."""
+
+    def __init__(self, sock: socket.socket, server: AgentServer) -> None:
+        self.sock = sock
+        self.server = server
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.inputs: dict[int, queue.SimpleQueue[bytes | None]] = {}
+        self.pipes: dict[int, Pipeline] = {}
+        self.running: set[int] = set()
+        self.cancelled: set[int] = set()
+        # The socket is closed once the script left and every command ended
+        self.users = 1
+        self.closed = False
+
+    def serve(self) -> None:
+        import json
+
+        try:
+            while True:
+                packet, fds, _, _ = socket.recv_fds(self.sock, MAX_MESSAGE, 3)
+                if not packet:
+                    break
+                header, _, data = packet.partition(b"\n")
+                message = json.loads(header)
+                req_id = message["id"]
+                if message["type"] == "run":
+                    with self.lock:
+                        self.users += 1
+                        self.running.add(req_id)
+                        if message["input"]:
+                            self.inputs[req_id] = queue.SimpleQueue()
+                    self.server.pool.submit(self._run, message, fds)
+                    continue
+                for fd in fds:
+                    os.close(fd)
+                if message["type"] == "input":
+                    with self.lock:
+                        if (inputs := self.inputs.get(req_id, None)) is not None:
+                            inputs.put(data or None)
+                elif message["type"] == "cancel":
+                    self._cancel(req_id)
+        except OSError:
+            pass
+        finally:
+            with self.lock:
+                self.closed = True
+                running = list(self.running)
+            for req_id in running:
+                self._cancel(req_id)
+            self._release()
+
+    def _cancel(self, req_id: int) -> None:
+        with self.lock:
+            if req_id not in self.running:
+                return
+            self.cancelled.add(req_id)
+            pipe = self.pipes.get(req_id, None)
+            if (inputs := self.inputs.get(req_id, None)) is not None:
+                inputs.put(None)
+        if pipe is not None:
+            pipe.kill()
+
+    def _release(self) -> None:
+        with self.lock:
+            self.users -= 1
+            if self.users:
+                return
+        self.sock.close()
+
+    def _run(self, message: dict[str, Any], fds: list[int]) -> None:
+        req_id = message["id"]
+        try:
+            reply = self._execute(message, fds)
+        except OSError as e:
+            reply = {"errno": e.errno, "strerror": e.strerror, "filename": e.filename}
+        except Exception as e:
+            reply = {"message": f"{type(e).__name__}: {e}"}
+        finally:
+            for fd in fds:
+                os.close(fd)
+            with self.lock:
+                self.inputs.pop(req_id, None)
+                self.pipes.pop(req_id, None)
+                self.running.discard(req_id)
+                self.cancelled.discard(req_id)
+        try:
+            self._send({"type": "error", "id": req_id} | reply)
+        except OSError:
+            # The script is gone
+            pass
+        finally:
+            self._release()
+
+    def _execute(self, message: dict[str, Any], fds: list[int]) -> dict[str, Any]:
+        req_id = message["id"]
+        # Only where they differ, posix_spawn() cannot change the cwd
+        common: dict[str, Any] = {}
+        if message["cwd"] != os.getcwd():
+            common["cwd"] = message["cwd"]
+        if message["env"] != os.environ:
+            common["env"] = message["env"]
+        cmd: Command | None = None
+        for stage in message["stages"]:
+            kwargs = common | stage["kwargs"]
+            if cmd is not None:
+                kwargs["pipefrom"] = cmd
+            cmd = Command(*stage["args"], **kwargs)
+        assert cmd is not None
+        forward = (_Forward(self, req_id, "stdout"), _Forward(self, req_id, "stderr"))
+        cmd = cmd.update(keep=forward)
+        timeout = message["timeout"]
+        with Pipeline(cmd) as pipe:
+            if timeout is not None and "pgroup" not in cmd.kwargs:
+                pipe.pgroup = True
+            if req_id in self.cancelled:
+                raise PyShError("Cancelled")
+            pipe.spawn(stdin=message["input"], stdio=(fds[0], fds[1], fds[2]))
+            with self.lock:
+                # Cancelled while spawning, _cancel() could not kill it yet
+                if req_id in self.cancelled:
+                    pipe.kill()
+                self.pipes[req_id] = pipe
+            input = self._input(req_id) if message["input"] else None
+            res = pipe.communicate(input, timeout)
+        return {
+            "type": "result",
+            "kind": res.kind.name,
+            "retcode": res.retcode,
+            "elapsed": res.elapsed,
+            "stages": [dataclasses.asdict(stage) for stage in res.stages],
+        }
+
+    def _input(self, req_id: int) -> Iterator[bytes]:
+        inputs = self.inputs[req_id]
+        while (data := inputs.get()) is not None:
+            self._send({"type": "more", "id": req_id})
+            yield data
+
+    def _send(self, message: dict[str, Any], data: bytes = b"") -> None:
+        import json
+
+        with self.send_lock:
+            self.sock.send(json.dumps(message).encode() + b"\n" + data)
+
+
+class _Forward:
+    """A capture policy sending the output to the script as it is read."""
+
+    def __init__(self, conn: _Connection, req_id: int, stream: str) -> None:
+        self.conn = conn
+        self.req_id = req_id
+        self.stream = stream
+
+    def sink(self, cmd: Command) -> Self:
+        return self
+
+    def write(self, data: bytes) -> None:
+        message = {"type": "output", "id": self.req_id, "stream": self.stream}
+        self.conn._send(message, data)
+
+    def value(self) -> bytes:
+        return b""
+
+
+def main(argv: list[str] | None = None) -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="python3 -m pysh.agent", description="Runs the commands of pysh scripts."
+    )
+    parser.add_argument("path", help="the Unix socket to listen on")
+    parser.add_argument("-j", "--jobs", type=int, help="commands run at most at once")
+    args = parser.parse_args(argv)
+    # Resolves executables once for every script
+    set_spawn_backend(PosixSpawnBackend())
+    server = AgentServer(args.path, args.jobs)
+    print(f"pysh agent listening on {server.path}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+if __name__ == "__main__":
+    main()
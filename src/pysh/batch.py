@@ -0,0 +1,255 @@
+"""Runs many small commands in a single bash process.
+
+USAGE
+    with Batch():
+        for d in dirs:
+            Run(mkdir_("-p", d))
+            Run(touch(d / "stamp"))
+    # Every command has run by now, in order
+
+Inside the block Run() queues the command and returns at once. The queue
+runs as one bash script when the block ends, or as soon as one of the
+returned results is used, e.g. `if not Run(...)`. Cap() uses its result
+right away, so it runs the queue and gains nothing.
+
+Commands that cannot be expressed in bash run on their own, after the
+queue: those with timeout=, input=, strict=, cache=, with a Python object
+as redirection or a PyFilter stage, or whose program is a bash builtin that
+would change the shell itself (cd, exit, set, ...). So do commands run by
+other threads.
+
+Differences with Run() outside the block:
+* echo, printf, test, pwd and the like are the builtins of bash.
+* The commands see the environment as it is when the queue runs.
+* A process killed by signal N has retcode 128+N, and stages is empty.
+"""
+import os
+import shlex
+import subprocess
+import threading
+import time
+from pathlib import Path
+from typing import Any, Self
+
+from . import capture, contexts, pipeline, trace
+from .command import Command, CommitResult, CommitResKind
+from .spawn import executables
+
+# Builtins that behave like the program of the same name
+SAFE_BUILTINS = frozenset(
+    ["echo", "printf", "true", "false", "test", "[", "pwd", "kill"]
+)
+# Builtins and keywords that would act on the batch shell itself
+SHELL_WORDS = frozenset(
+    """. : alias bg bind break builtin caller cd command compgen complete
+    compopt continue declare dirs disown enable eval exec exit export fc fg
+    getopts hash help history jobs let local logout mapfile popd pushd read
+    readarray readonly return set shift shopt source suspend times trap type
+    typeset ulimit umask unalias unset wait if then else elif fi case esac
+    for select while until do done in function time { } ! [[ ]] coproc""".split()
+)
+
+
+class _PendingResult(CommitResult):
+    """The result of a queued command. Using it runs the queue."""
+
+    def __init__(self, batch: "Batch") -> None:
+        self._batch = batch
+
+    def __getattr__(self, name: str) -> Any:
+        # Only called for attributes that are not set yet
+        if name.startswith("_"):
+            raise AttributeError(name)
+        self._batch.flush()
+        if name not in vars(self):
+            raise AttributeError(name)
+        return vars(self)[name]
+
+
+class Batch:
+    """Collects the Run() calls of the block to run them in one bash process.
+    See the module documentation.
+
+    Nested blocks run the queue of the enclosing one first.
+    """
+
+    def __init__(self) -> None:
+        self._queue: list[tuple[Command, str, _PendingResult]] = []
+        self._owner: int | None = None
+        self._token: Any = None
+        # Results can be used, and so the queue run, from any thread
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> Self:
+        if (outer := contexts._batch.get()) is not None:
+            outer.flush()
+        self._owner = threading.get_ident()
+        self._token = contexts._batch.set(self)
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        contexts._batch.reset(self._token)
+        self.flush()
+
+    def add(
+        self, cmd: Command, timeout: float | None, run_kwargs: dict[str, Any]
+    ) -> CommitResult | None:
+        """Queues cmd and returns its pending result.
+        Returns None if cmd cannot be batched, after running the queue so
+        that cmd still runs after the commands queued before it."""
+        with self._lock:
+            if (
+                timeout is None
+                and run_kwargs.get("input", None) is None
+                and not run_kwargs.get("strict", False)
+                and not run_kwargs.get("cache", None)
+                and threading.get_ident() == self._owner
+                and (line := self._line(cmd, len(self._queue))) is not None
+            ):
+                res = _PendingResult(self)
+                self._queue.append((cmd, line, res))
+                return res
+        self.flush()
+        return None
+
+    def _line(self, cmd: Command, idx: int) -> str | None:
+        """cmd as a line of the script, None if bash cannot run it like Run()."""
+
+        def redir(kwname: str, value: Any) -> str:
+            if value == subprocess.PIPE:
+                return f'"$d/{idx}.{"err" if kwname == "e" else "out"}"'
+            if value is None or value == 0:
+                return "/dev/null"
+            # Relative to the cwd at the time of Run(), as for Popen
+            return shlex.quote(os.path.abspath(value))
+
+        stages = pipeline.Pipeline.unfold(cmd)
+        words = []
+        for pos, stage in enumerate(stages):
+            if any(k in stage.kwargs for k in ("pystage", "env", "ii")):
+                return None
+            if not stage.args or not self._known(stage.args[0]):
+                return None
+            kwargs = dict(stage.kwargs)
+            if kwargs.pop("capture", None) == 1:
+                kwargs["o"] = subprocess.PIPE
+            for kwname in ("i", "o", "a", "e"):
+                value = kwargs.get(kwname, None)
+                if not (value is None or isinstance(value, (int, str, Path))):
+                    return None
+                if isinstance(value, int) and value not in (0, subprocess.PIPE):
+                    return None
+                pipe = value == subprocess.PIPE
+                if pipe and (kwname not in ("o", "e") or pos != len(stages) - 1):
+                    return None
+            stage_words = " ".join(
+                Command._from_parts(stage.args, kwargs)._shell(redir)
+            )
+            if "cwd" in kwargs:
+                if not Path(kwargs["cwd"]).is_dir():
+                    return None
+                cwd = shlex.quote(os.path.abspath(kwargs["cwd"]))
+                stage_words = f"( cd -- {cwd} && {stage_words} )"
+            words.append(stage_words)
+        pipefail = "-o" if cmd.kwargs.get("pipefail", False) else "+o"
+        return f"cd -- {shlex.quote(os.getcwd())}; set {pipefail} pipefail\n" + (
+            " | ".join(words)
+        )
+
+    @staticmethod
+    def _known(program: str) -> bool:
+        if program in SAFE_BUILTINS:
+            return True
+        if program in SHELL_WORDS or "=" in program:
+            return False
+        # Missing programs raise FileNotFoundError right away, as with Run()
+        executables.resolve(program)
+        return True
+
+    def flush(self) -> None:
+        """Runs the queued commands and fills in their results."""
+        # Held until the results are filled in, so that a concurrent flush()
+        # returns only once the results it might be waiting for are there
+        with self._lock:
+            if self._queue:
+                queue, self._queue = self._queue, []
+                self._flush(queue)
+
+    def _flush(self, queue: list[tuple[Command, str, _PendingResult]]) -> None:
+        import shutil
+        import tempfile
+
+        tmp = Path(tempfile.mkdtemp(prefix="pysh-batch-"))
+        try:
+            # From the wall clock of bash to perf_counter(), for the tracer
+            offset = time.perf_counter() - time.time()
+            pid, statuses = self._run(queue, tmp)
+            for idx, (cmd, _, res) in enumerate(queue):
+                if idx + 1 < len(statuses):
+                    retcode = int(statuses[idx + 1][0])
+                    start = float(statuses[idx][1]) + offset
+                    end = float(statuses[idx + 1][1]) + offset
+                    elapsed = end - start
+                    kind = (
+                        CommitResKind.SUCCESS if retcode == 0 else CommitResKind.FAILED
+                    )
+                    for stage in pipeline.Pipeline.unfold(cmd):
+                        trace.record(stage, pid, start, end, retcode)
+                else:
+                    # bash was killed before running it
+                    retcode, elapsed, kind = None, None, CommitResKind.CRITICAL
+                outputs = capture.sinks(cmd)
+                for name, path in (("stdout", f"{idx}.out"), ("stderr", f"{idx}.err")):
+                    if data := self._read(tmp / path):
+                        outputs[name].write(data)
+                vars(res).update(
+                    kind=kind,
+                    retcode=retcode,
+                    stdout=outputs["stdout"].value(),
+                    stderr=outputs["stderr"].value(),
+                    elapsed=elapsed,
+                    stages=[],
+                )
+        except BaseException:
+            for cmd, _, res in queue:
+                if "kind" not in vars(res):
+                    empty = cmd._decoded(None)
+                    vars(res).update(
+                        kind=CommitResKind.CRITICAL,
+                        retcode=None,
+                        stdout=empty,
+                        stderr=empty,
+                        elapsed=None,
+                        stages=[],
+                    )
+            raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def _run(
+        self, queue: list[tuple[Command, str, Any]], tmp: Path
+    ) -> tuple[int, list[list[str]]]:
+        """Runs the script of queue in tmp. Returns the pid of bash and the
+        status lines: the start time, then the retcode and end time of every
+        command."""
+        status = '"$d/status"'
+        # The commands are separated by their status lines, with the time
+        # from $EPOCHREALTIME (bash >= 5)
+        mark = f'printf "%s %s\\n" $? "${{EPOCHREALTIME/,/.}}" >> {status}'
+        lines = [f"d={shlex.quote(str(tmp))}", f"true; {mark}"]
+        for _, line, _ in queue:
+            lines += [line, mark]
+        script = tmp / "script.sh"
+        script.write_bytes(os.fsencode("\n".join(lines) + "\n"))
+        with pipeline.Pipeline(Command("bash", str(script))) as pipe:
+            pipe.spawn()
+            pipe.communicate()
+        lines = (tmp / "status").read_text().splitlines()
+        return pipe.procs[0].pid, [line.split() for line in lines]
+
+    @staticmethod
+    def _read(path: Path) -> bytes | None:
+        try:
+            return path.read_bytes()
+        except FileNotFoundError:
+            return None
@@ -0,0 +1,515 @@
+"""In-process implementations of simple prelude commands.
+
+echo_, cat_, head, tail, tr, sort and tee_ often appear in pipelines only to
+move a few kilobytes around, yet every one of them costs a fork/exec.
+The builtin backend runs them as Python threads instead, when their flags
+are in the subset below. Otherwise the real binary is spawned. Output and
+return codes are the same as the ones of GNU coreutils.
+
+Only bare names are run in-process, and only when PATH resolves them to
+the system binary, so that `./cat` or a wrapper earlier in PATH still runs.
+
+    echo    [-n] [-E] WORD...
+    cat     [FILE...]
+    head    [-n N | -c N] [FILE]
+    tail    [-n N | -c N] [FILE]
+    tr      SET1 SET2 | -d SET1             (chars and ranges like a-z only)
+    sort    [-r] [-u] [FILE...]             (only in the C locale)
+    tee     [-a] FILE...
+
+USAGE
+    set_spawn_backend(BuiltinBackend())
+"""
+import contextvars
+import os
+import re
+import resource
+import select
+import signal
+import stat
+import subprocess
+import threading
+from pathlib import Path
+from typing import Any, Callable, Iterator
+
+from .spawn import ChildProcess, PopenBackend, Rusage, executables
+
+# Runs a builtin command given its stdio, returns the exit code
+Builtin = Callable[["BuiltinIO"], int]
+
+
+class BuiltinBackend:
+    """Runs supported commands in-process and spawns the others with fallback."""
+
+    def __init__(self, fallback: Any = None) -> None:
+        self.fallback = fallback if fallback is not None else PopenBackend()
+
+    SUPPORTED_KWARGS = {"stdin", "stdout", "stderr", "cwd", "env", "process_group"}
+    # Where the binaries the builtins stand in for are installed
+    SYSTEM_DIRS = ("/bin", "/usr/bin")
+
+    def spawn(self, args: tuple[str, ...], **popen_kwargs: Any) -> Any:
+        parsed = None
+        env = popen_kwargs.get("env", None) or os.environ
+        parse = PARSERS.get(os.fsencode(args[0]), None)
+        if parse is not None and set(popen_kwargs) <= self.SUPPORTED_KWARGS:
+            if self._system_binary(os.fsdecode(args[0]), env):
+                words = [os.fsencode(arg) for arg in args[1:]]
+                parsed = parse(words, popen_kwargs.get("cwd", None), env)
+        if parsed is None:
+            return self.fallback.spawn(args, **popen_kwargs)
+        builtin, files = parsed
+        try:
+            return BuiltinProcess(args, builtin, files, **popen_kwargs)
+        except BaseException:
+            for fd in files:
+                os.close(fd)
+            raise
+
+    def _system_binary(self, name: str, env: Any) -> bool:
+        """Whether PATH in env resolves name to a binary in SYSTEM_DIRS."""
+        try:
+            if env.get("PATH", None) == os.environ.get("PATH", None):
+                path: str | None = executables.resolve(name)
+            else:
+                import shutil  # slow to import, rarely needed
+
+                path = shutil.which(name, path=env.get("PATH", None))
+        except FileNotFoundError:
+            path = None
+        if path is None:
+            return False
+        return os.path.dirname(os.path.realpath(path)) in self.SYSTEM_DIRS
+
+
+class _Killed(Exception):
+    pass
+
+
+class BuiltinIO:
+    """The stdio of a builtin command.
+    Every blocking operation can be interrupted by BuiltinProcess.kill()."""
+
+    READ_SIZE = 65536
+
+    def __init__(self, fds: list[int], cancel: int) -> None:
+        self.fds = fds
+        self._cancel = cancel
+
+    def wait(self, fd: int, event: int) -> None:
+        """Waits for a select.poll() event on fd."""
+        poll = select.poll()
+        poll.register(fd, event)
+        poll.register(self._cancel, select.POLLIN)
+        while True:
+            ready = dict(poll.poll())
+            if self._cancel in ready:
+                raise _Killed()
+            if fd in ready:
+                return
+
+    def chunks(self, fd: int | None = None) -> Iterator[bytes]:
+        """Reads fd, or stdin if not given, until EOF."""
+        fd = self.fds[0] if fd is None else fd
+        while True:
+            self.wait(fd, select.POLLIN)
+            if not (data := os.read(fd, self.READ_SIZE)):
+                return
+            yield data
+
+    def read_all(self, fd: int | None = None) -> bytes:
+        return b"".join(self.chunks(fd))
+
+    def write(self, data: bytes | memoryview, fd: int | None = None) -> None:
+        """Writes all of data to fd, or stdout if not given."""
+        fd = self.fds[1] if fd is None else fd
+        view = memoryview(data)
+        while view:
+            self.wait(fd, select.POLLOUT)
+            view = view[os.write(fd, view[: select.PIPE_BUF]) :]
+
+
+class BuiltinProcess(ChildProcess):
+    """A builtin command running in a thread of this process.
+    pid is the one of this process, so it is never part of a process group."""
+
+    in_process = True
+
+    def __init__(
+        self,
+        args: tuple[str, ...],
+        builtin: Builtin,
+        files: list[int],
+        stdin: Any = None,
+        stdout: Any = None,
+        stderr: Any = None,
+        cwd: Any = None,
+        env: Any = None,
+        process_group: int | None = None,
+    ) -> None:
+        super().__init__(args)
+        self.pid = os.getpid()
+        self._signal: int = signal.SIGKILL
+        child_fds, to_close = self._child_stdio(stdin, stdout, stderr)
+        try:
+            # Own copies, closed by the thread when done so that EOF propagates
+            fds = [os.dup(fd) for fd in child_fds]
+        finally:
+            for fd in to_close:
+                os.close(fd)
+        self._lock = threading.Lock()
+        self._released = False
+        self._cancel_r, self._cancel_w = os.pipe()
+        self._exit_r, self._exit_w = os.pipe()
+        io = BuiltinIO(fds, self._cancel_r)
+        # Stages like Tee() see the Session of the caller
+        ctx = contextvars.copy_context()
+        self._thread = threading.Thread(
+            target=ctx.run, args=(self._run, builtin, io, files), daemon=True
+        )
+        self._thread.start()
+
+    def _run(self, builtin: Builtin, io: BuiltinIO, files: list[int]) -> None:
+        retcode = 1
+        try:
+            retcode = builtin(io)
+        except _Killed:
+            retcode = -self._signal
+        except BrokenPipeError:
+            # Like the default action of SIGPIPE
+            retcode = -signal.SIGPIPE
+        except Exception as e:
+            name = os.path.basename(os.fsdecode(self.args[0]))
+            try:
+                io.write(f"{name}: {e}\n".encode(), io.fds[2])
+            except Exception:
+                pass
+        finally:
+            for fd in io.fds + files:
+                os.close(fd)
+            if hasattr(resource, "RUSAGE_THREAD"):
+                # maxrss is the one of this whole process
+                self.rusage = Rusage.from_struct(
+                    resource.getrusage(resource.RUSAGE_THREAD)
+                )
+            self.returncode = retcode
+            os.close(self._exit_w)
+
+    def open_exit_fd(self) -> int:
+        """A descriptor that becomes readable when the command exits."""
+        return os.dup(self._exit_r)
+
+    def _try_wait(self, block: bool) -> int | None:
+        if block:
+            self._thread.join()
+        if self._thread.is_alive():
+            return None
+        with self._lock:
+            if not self._released:
+                self._released = True
+                for fd in (self._exit_r, self._cancel_r, self._cancel_w):
+                    os.close(fd)
+        return self.returncode
+
+    def poll(self) -> int | None:
+        return self._try_wait(False)
+
+    def wait(self, timeout: float | None = None) -> int:
+        self._thread.join(timeout)
+        if (retcode := self._try_wait(False)) is None:
+            raise subprocess.TimeoutExpired(self.args, timeout or 0)
+        return retcode
+
+    def send_signal(self, sig: int) -> None:
+        with self._lock:
+            if not self._released and self._thread.is_alive():
+                self._signal = sig
+                os.write(self._cancel_w, b"\0")
+
+
+# PARSING
+# Each parser returns None when the real binary must be used, otherwise the
+# builtin and the descriptors it opened.
+
+Parsed = tuple[Builtin, list[int]] | None
+
+
+def _parse_opts(
+    words: list[bytes], flags: str, valued: str = ""
+) -> tuple[dict[str, bytes], list[bytes]] | None:
+    """A strict getopt: options must come before the operands."""
+    opts: dict[str, bytes] = {}
+    idx = 0
+    while idx < len(words) and words[idx].startswith(b"-") and words[idx] != b"-":
+        word = words[idx].decode("latin-1")
+        if word.startswith("--"):
+            return None
+        if word[1] in valued:
+            if len(word) > 2:
+                opts[word[1]] = words[idx][2:]
+            elif idx + 1 < len(words):
+                idx += 1
+                opts[word[1]] = words[idx]
+            else:
+                return None
+        elif all(letter in flags for letter in word[1:]):
+            opts.update((letter, b"") for letter in word[1:])
+        else:
+            return None
+        idx += 1
+    operands = words[idx:]
+    if any(op.startswith(b"-") and op != b"-" for op in operands):
+        # GNU would have parsed it as an option
+        return None
+    return opts, operands
+
+
+def _open_inputs(operands: list[bytes], cwd: Any) -> list[int] | None:
+    """Opens the input files, -1 standing for stdin.
+    Returns None if any cannot be read, so that the real binary reports it."""
+    fds: list[int] = []
+    try:
+        for op in operands:
+            if op == b"-":
+                fds.append(-1)
+                continue
+            fd = os.open(Path(cwd or ".") / os.fsdecode(op), os.O_RDONLY)
+            fds.append(fd)
+            if stat.S_ISDIR(os.fstat(fd).st_mode):
+                raise IsADirectoryError(op)
+    except OSError:
+        for fd in fds:
+            if fd >= 0:
+                os.close(fd)
+        return None
+    return fds
+
+
+def _count(value: bytes | None, default: int) -> int | None:
+    if value is None:
+        return default
+    return int(value) if value.isdigit() else None
+
+
+def _parse_echo(words: list[bytes], cwd: Any, env: Any) -> Parsed:
+    if env.get("POSIXLY_CORRECT", None) is not None:
+        return None
+    if len(words) == 1 and words[0] in (b"--help", b"--version"):
+        return None
+    newline = True
+    while words and re.fullmatch(rb"-[neE]+", words[0]):
+        if b"e" in words[0]:
+            return None
+        newline = newline and b"n" not in words[0]
+        words = words[1:]
+    data = b" ".join(words) + (b"\n" if newline else b"")
+
+    def echo(io: BuiltinIO) -> int:
+        io.write(data)
+        return 0
+
+    return echo, []
+
+
+def _parse_cat(words: list[bytes], cwd: Any, env: Any) -> Parsed:
+    if (parsed := _parse_opts(words, "")) is None:
+        return None
+    names = parsed[1] or [b"-"]
+    if (fds := _open_inputs(names, cwd)) is None:
+        return None
+
+    def cat(io: BuiltinIO) -> int:
+        retcode = 0
+        out = os.fstat(io.fds[1])
+        for name, fd in zip(names, fds):
+            fd = io.fds[0] if fd < 0 else fd
+            st = os.fstat(fd)
+            if (
+                stat.S_ISREG(out.st_mode)
+                and (st.st_dev, st.st_ino) == (out.st_dev, out.st_ino)
+                and os.lseek(fd, 0, os.SEEK_CUR) < st.st_size
+            ):
+                # Like GNU cat, instead of growing the file forever
+                msg = b"cat: " + name + b": input file is output file\n"
+                io.write(msg, io.fds[2])
+                retcode = 1
+                continue
+            for chunk in io.chunks(fd):
+                io.write(chunk)
+        return retcode
+
+    return cat, [fd for fd in fds if fd >= 0]
+
+
+def _parse_head_tail(words: list[bytes], cwd: Any) -> tuple[str, int, int] | None:
+    """Returns whether to count lines or bytes, the count and the input."""
+    if (parsed := _parse_opts(words, "", "nc")) is None:
+        return None
+    opts, operands = parsed
+    if len(opts) > 1 or len(operands) > 1:
+        return None
+    unit = "c" if "c" in opts else "n"
+    if (count := _count(opts.get(unit, None), 10)) is None:
+        return None
+    if (fds := _open_inputs(operands or [b"-"], cwd)) is None:
+        return None
+    return unit, count, fds[0]
+
+
+def _parse_head(words: list[bytes], cwd: Any, env: Any) -> Parsed:
+    if (parsed := _parse_head_tail(words, cwd)) is None:
+        return None
+    unit, count, fd = parsed
+
+    def head(io: BuiltinIO) -> int:
+        left = count
+        if left == 0:
+            return 0
+        for chunk in io.chunks(None if fd < 0 else fd):
+            if unit == "c":
+                io.write(chunk[:left])
+                left -= min(left, len(chunk))
+            else:
+                pos = -1
+                while left and (pos := chunk.find(b"\n", pos + 1)) >= 0:
+                    left -= 1
+                io.write(chunk if left else chunk[: pos + 1])
+            if not left:
+                break
+        return 0
+
+    return head, [] if fd < 0 else [fd]
+
+
+def _parse_tail(words: list[bytes], cwd: Any, env: Any) -> Parsed:
+    if (parsed := _parse_head_tail(words, cwd)) is None:
+        return None
+    unit, count, fd = parsed
+
+    def tail(io: BuiltinIO) -> int:
+        data = io.read_all(None if fd < 0 else fd)
+        if unit == "c":
+            io.write(data[max(0, len(data) - count) :] if count else b"")
+            return 0
+        pos = len(data) - 1 if data.endswith(b"\n") else len(data)
+        for _ in range(count):
+            if (pos := data.rfind(b"\n", 0, pos)) < 0:
+                break
+        io.write(data[pos + 1 :])
+        return 0
+
+    return tail, [] if fd < 0 else [fd]
+
+
+def _expand_set(word: bytes) -> bytes | None:
+    """Expands the ranges of a tr set. None for anything fancier."""
+    if not word.isascii() or b"\\" in word or b"[" in word:
+        return None
+    res = bytearray()
+    idx = 0
+    while idx < len(word):
+        if idx + 2 < len(word) and word[idx + 1] == ord("-"):
+            if word[idx] > word[idx + 2]:
+                return None
+            res += bytes(range(word[idx], word[idx + 2] + 1))
+            idx += 3
+        else:
+            res.append(word[idx])
+            idx += 1
+    return bytes(res)
+
+
+def _parse_tr(words: list[bytes], cwd: Any, env: Any) -> Parsed:
+    if (parsed := _parse_opts(words, "d")) is None:
+        return None
+    opts, operands = parsed
+    sets = [_expand_set(op) for op in operands]
+    if None in sets or len(sets) != (1 if "d" in opts else 2):
+        return None
+    table: bytes | None = None
+    delete = b""
+    if "d" in opts:
+        assert sets[0] is not None
+        delete = sets[0]
+    else:
+        src, dst = sets
+        assert src is not None and dst is not None
+        if not dst:
+            return None
+        dst = dst[: len(src)] + dst[-1:] * (len(src) - len(dst))
+        table = bytes.maketrans(src, dst)
+
+    def tr(io: BuiltinIO) -> int:
+        for chunk in io.chunks():
+            io.write(chunk.translate(table, delete))
+        return 0
+
+    return tr, []
+
+
+def _parse_sort(words: list[bytes], cwd: Any, env: Any) -> Parsed:
+    locale = (
+        env.get("LC_ALL", None) or env.get("LC_COLLATE", None) or env.get("LANG", None)
+    )
+    if locale not in (None, "C", "POSIX", "C.UTF-8", "C.utf8"):
+        # Collation would differ from comparing bytes
+        return None
+    if (parsed := _parse_opts(words, "ru")) is None:
+        return None
+    opts, operands = parsed
+    if (fds := _open_inputs(operands or [b"-"], cwd)) is None:
+        return None
+
+    def sort(io: BuiltinIO) -> int:
+        lines: list[bytes] = []
+        for fd in fds:
+            data = io.read_all(None if fd < 0 else fd)
+            lines += data.removesuffix(b"\n").split(b"\n") if data else []
+        lines.sort(reverse="r" in opts)
+        if "u" in opts:
+            lines = [
+                line
+                for idx, line in enumerate(lines)
+                if idx == 0 or line != lines[idx - 1]
+            ]
+        io.write(b"".join(line + b"\n" for line in lines))
+        return 0
+
+    return sort, [fd for fd in fds if fd >= 0]
+
+
+def _parse_tee(words: list[bytes], cwd: Any, env: Any) -> Parsed:
+    if (parsed := _parse_opts(words, "a")) is None:
+        return None
+    opts, operands = parsed
+    if b"-" in operands:
+        return None
+    flags = os.O_WRONLY | os.O_CREAT | (os.O_APPEND if "a" in opts else os.O_TRUNC)
+    fds: list[int] = []
+    try:
+        for op in operands:
+            fds.append(os.open(Path(cwd or ".") / os.fsdecode(op), flags, 0o666))
+    except OSError:
+        for fd in fds:
+            os.close(fd)
+        return None
+
+    def tee(io: BuiltinIO) -> int:
+        for chunk in io.chunks():
+            io.write(chunk)
+            for fd in fds:
+                io.write(chunk, fd)
+        return 0
+
+    return tee, fds
+
+
+PARSERS: dict[bytes, Callable[[list[bytes], Any, Any], Parsed]] = {
+    b"echo": _parse_echo,
+    b"cat": _parse_cat,
+    b"head": _parse_head,
+    b"tail": _parse_tail,
+    b"tr": _parse_tr,
+    b"sort": _parse_sort,
+    b"tee": _parse_tee,
+}
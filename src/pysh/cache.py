@@ -0,0 +1,265 @@
+"""Memoizes the results of idempotent commands.
+
+USAGE
+    cache = ResultCache(ttl=60, depends=[".git/HEAD", ".git/refs"])
+    head = Cap(git("rev-parse", "HEAD"), cache=cache)
+
+Results are keyed on the argv and kwargs of every stage, the cwd, the values
+of the selected environment variables and the input. An entry is stale once
+its TTL has passed, or once the mtime of any declared dependency changed.
+Files redirected with i= are dependencies too.
+
+Only the CommitResult is replayed: output that is not captured is not
+printed again. Every hit gets its own copy of it. Commands writing to files with o=, a= or e= are never cached,
+neither are timed out runs.
+"""
+import dataclasses
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Iterable
+
+from . import capture, command, heredoc, pipeline
+
+
+@dataclass
+class _Entry:
+    result: "command.CommitResult"
+    created: float
+    # mtime_ns of every dependency, None if missing
+    stamps: dict[str, int | None]
+
+
+@dataclass
+class _Lookup:
+    key: str
+    stamps: dict[str, int | None]
+    # The cached result, None on a miss
+    result: "command.CommitResult | None"
+
+
+class ResultCache:
+    """An LRU cache of CommitResults, optionally persisted in a directory.
+
+    Arguments:
+    * maxsize: int=128
+      Maximum number of entries kept in memory.
+    * ttl: float=None
+      Seconds after which an entry is stale. None means never.
+    * depends: paths=()
+      Files or directories whose mtime invalidates the entries.
+      Relative paths are relative to the cwd of the command.
+    * env: names=("PATH",)
+      Environment variables that are part of the key.
+    * path: path=None
+      Directory where entries are also stored, so that they persist across
+      runs. Entries are pickles, only point it to a directory you trust.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 128,
+        ttl: float | None = None,
+        depends: Iterable[str | Path] = (),
+        env: Iterable[str] = ("PATH",),
+        path: str | Path | None = None,
+    ) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.depends = [Path(p) for p in depends]
+        self.env = tuple(env)
+        self.path = None if path is None else Path(path)
+        if self.path is not None:
+            self.path.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def clear(self) -> None:
+        """Drops every entry, including the ones on disk."""
+        with self._lock:
+            self._entries.clear()
+        if self.path is not None:
+            for file in self.path.glob("*.pickle"):
+                file.unlink(missing_ok=True)
+
+    def fetch(
+        self,
+        cmd: "command.Command",
+        input: Any,
+        run: Callable[[], "command.CommitResult"],
+    ) -> "command.CommitResult":
+        """Returns the cached result of cmd, or calls run() and caches it.
+        Streamed input, e.g. a generator, is not cached."""
+        if (lookup := self._lookup(cmd, input)) is None:
+            return run()
+        if lookup.result is not None:
+            return _copy(lookup.result)
+        return self._store(lookup, run())
+
+    async def afetch(
+        self,
+        cmd: "command.Command",
+        input: Any,
+        run: Callable[[], Awaitable["command.CommitResult"]],
+    ) -> "command.CommitResult":
+        """Coroutine version of fetch(), for a coroutine function run."""
+        if (lookup := self._lookup(cmd, input)) is None:
+            return await run()
+        if lookup.result is not None:
+            return _copy(lookup.result)
+        return self._store(lookup, await run())
+
+    def _lookup(self, cmd: "command.Command", input: Any) -> "_Lookup | None":
+        """The key of cmd and its cached result if fresh, None if cmd
+        cannot be cached."""
+        stages = pipeline.Pipeline.unfold(cmd)
+        if not isinstance(input, (bytes, str, type(None))):
+            return None
+        if not all(_cacheable(stage) for stage in stages):
+            return None
+        cwd = Path(cmd.kwargs.get("cwd", None) or os.getcwd()).absolute()
+        key = self._key(stages, cwd, input)
+        deps = [cwd / p for p in self.depends]
+        deps += [
+            cwd / stage.kwargs["i"]
+            for stage in stages
+            if isinstance(stage.kwargs.get("i", None), (str, Path))
+        ]
+        stamps = {str(dep): _mtime(dep) for dep in deps}
+        if (entry := self._get(key)) is not None and not self._fresh(entry, stamps):
+            entry = None
+        # Parallel() runs share the cache
+        with self._lock:
+            if entry is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return _Lookup(key, stamps, None if entry is None else entry.result)
+
+    def _store(
+        self, lookup: "_Lookup", res: "command.CommitResult"
+    ) -> "command.CommitResult":
+        if res.kind in (command.CommitResKind.SUCCESS, command.CommitResKind.FAILED):
+            self._put(lookup.key, _Entry(_copy(res), time.time(), lookup.stamps))
+        return res
+
+    def _key(
+        self, stages: list["command.Command"], cwd: Path, input: bytes | str | None
+    ) -> str:
+        parts = [
+            (
+                stage.args,
+                sorted(
+                    (k, _repr(v)) for k, v in stage.kwargs.items() if k != "pipefrom"
+                ),
+            )
+            for stage in stages
+        ]
+        env = [(name, os.environ.get(name, None)) for name in self.env]
+        data = repr((parts, str(cwd), env, input)).encode("utf-8", "surrogateescape")
+        import hashlib
+
+        return hashlib.sha256(data).hexdigest()
+
+    def _fresh(self, entry: _Entry, stamps: dict[str, int | None]) -> bool:
+        if self.ttl is not None and time.time() - entry.created > self.ttl:
+            return False
+        return entry.stamps == stamps
+
+    def _get(self, key: str) -> _Entry | None:
+        with self._lock:
+            if (entry := self._entries.get(key, None)) is not None:
+                self._entries.move_to_end(key)
+                return entry
+        if self.path is None:
+            return None
+        import pickle
+
+        try:
+            with open(self.path / f"{key}.pickle", "rb") as f:
+                entry = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        self._remember(key, entry)
+        return entry
+
+    def _put(self, key: str, entry: _Entry) -> None:
+        self._remember(key, entry)
+        if self.path is None:
+            return
+        import pickle
+        import tempfile
+
+        # Written then renamed, so that concurrent runs never read half an entry
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with open(fd, "wb") as f:
+                pickle.dump(entry, f)
+            os.replace(tmp, self.path / f"{key}.pickle")
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def _remember(self, key: str, entry: _Entry) -> None:
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+# Used by Run(..., cache=True)
+default_cache = ResultCache()
+
+
+def _repr(value: Any) -> str:
+    """value as part of a key, the same in every process for the same value."""
+    if isinstance(value, heredoc.HereDoc):
+        return f"HereDoc({value.digest()})"
+    return repr(value)
+
+
+def _copy(res: "command.CommitResult") -> "command.CommitResult":
+    """res for one caller, so that changing it leaves the cached one alone."""
+    stages = [
+        dataclasses.replace(
+            stage, rusage=stage.rusage and dataclasses.replace(stage.rusage)
+        )
+        for stage in res.stages
+    ]
+    return command.CommitResult(
+        res.kind, res.retcode, res.stdout, res.stderr, res.elapsed, stages
+    )
+
+
+def _cacheable(cmd: "command.Command") -> bool:
+    """Whether running cmd has no effect besides its result."""
+    if "pystage" in cmd.kwargs:
+        # Python functions may have side effects or state
+        return False
+    keep = cmd.kwargs.get("keep", None)
+    policies = keep if isinstance(keep, tuple) else (keep,)
+    if any(isinstance(policy, capture.Spill) for policy in policies):
+        # A SpilledOutput can be closed, so it cannot be handed out twice
+        return False
+    if not isinstance(cmd.kwargs.get("ii", b""), (bytes, str, heredoc.HereDoc)):
+        # Other buffers are keyed on their repr(), which is not their content
+        return False
+    return not any(
+        isinstance(cmd.kwargs.get(name, None), (str, Path)) for name in ("o", "a", "e")
+    )
+
+
+def _mtime(path: Path) -> int | None:
+    try:
+        return path.stat().st_mtime_ns
+    except OSError:
+        return None
@@ -0,0 +1,316 @@
+"""Capture policies, bounding the memory held by captured output.
+
+USAGE
+    # Only the last 4KiB of the output of a chatty build, for the error message
+    res = Run(make, "-j8", capture=True, keep=KeepTail("4KiB"))
+    # A different policy for stdout and stderr
+    res = Run(find("/"), capture=True, keep=(Spill("1MiB"), KeepTail("4KiB")))
+    # Past 1MiB, stdout goes to an anonymous temporary file
+    with Run(find("/"), o=-1, keep=Spill("1MiB")).stdout as files:
+        print(len(files), files[-1])
+
+Policies, given with the keep= kwarg of Run(), Cap(), ARun() and Pipeline:
+* KeepHead(size): the first size bytes, the rest is read and dropped.
+* KeepTail(size): the last size bytes, in a ring buffer.
+* Spill(threshold): everything, in memory up to threshold and in a
+  temporary file beyond. The output is a SpilledOutput, a memory mapped
+  sequence of lines decoded on access.
+Without keep=, the whole output is kept in memory.
+
+A truncated output is decoded without the character the cut went through.
+Either way the command runs to completion, as without keep=.
+"""
+import codecs
+import itertools
+from array import array
+from collections.abc import Sequence
+from typing import TYPE_CHECKING, Any, Iterator, TypeAlias, overload
+
+from .utils import size_to_bytes
+
+if TYPE_CHECKING:
+    import mmap
+
+    from .command import Command
+
+
+# Bytes scanned at a time for lines
+_BLOCK = 1 << 20
+
+
+class KeepHead:
+    """Keep the first size bytes, an int or a str like "4KiB"."""
+
+    def __init__(self, size: int | str) -> None:
+        self.size = size_to_bytes(size)
+
+    def sink(self, cmd: "Command") -> "_HeadSink":
+        return _HeadSink(self.size, cmd)
+
+    def __repr__(self) -> str:
+        return f"KeepHead({self.size})"
+
+
+class KeepTail:
+    """Keep the last size bytes, an int or a str like "4KiB"."""
+
+    def __init__(self, size: int | str) -> None:
+        self.size = size_to_bytes(size)
+
+    def sink(self, cmd: "Command") -> "_TailSink":
+        return _TailSink(self.size, cmd)
+
+    def __repr__(self) -> str:
+        return f"KeepTail({self.size})"
+
+
+class Spill:
+    """Keep everything, in a temporary file past threshold bytes.
+    The output is a SpilledOutput either way."""
+
+    def __init__(self, threshold: int | str = "1MiB") -> None:
+        self.threshold = size_to_bytes(threshold)
+
+    def sink(self, cmd: "Command") -> "_SpillSink":
+        return _SpillSink(self.threshold, cmd)
+
+    def __repr__(self) -> str:
+        return f"Spill({self.threshold})"
+
+
+# keep= values for which the captured stdout is a SpilledOutput, and the others
+Spilling: TypeAlias = "Spill | tuple[Spill, Any]"
+InMemory: TypeAlias = (
+    "KeepHead | KeepTail | tuple[KeepHead | KeepTail | None, Any] | None"
+)
+
+
+class SpilledOutput(Sequence[Any]):
+    """Captured output, memory mapped from a temporary file if it was large.
+
+    Indexing and iterating give the lines without their newline, decoded
+    like the command output was, or bytes with text=False. str() and bytes()
+    give the whole output. len() is the number of lines. Random access
+    builds an index of the lines on first use, 8 bytes per line.
+
+    The mapping is released by close(), on leaving a with block or when
+    the object is garbage collected.
+    """
+
+    def __init__(
+        self, data: "bytes | mmap.mmap", codec: tuple[str, str] | None
+    ) -> None:
+        self._data = data
+        self._codec = codec
+        self._starts: array[int] | None = None
+
+    @property
+    def size(self) -> int:
+        """Size of the output in bytes."""
+        return len(self._data)
+
+    def close(self) -> None:
+        if not isinstance(self._data, bytes):
+            self._data.close()
+        self._data, self._starts = b"", None
+
+    def __enter__(self) -> "SpilledOutput":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+    def __bytes__(self) -> bytes:
+        return self._data[:]
+
+    def __str__(self) -> str:
+        return self._data[:].decode(*(self._codec or ("utf-8", "strict")))
+
+    def __repr__(self) -> str:
+        return f"<SpilledOutput {self.size} bytes>"
+
+    def __len__(self) -> int:
+        return len(self._index())
+
+    @overload
+    def __getitem__(self, idx: int) -> Any:
+        ...
+
+    @overload
+    def __getitem__(self, idx: slice) -> list[Any]:
+        ...
+
+    def __getitem__(self, idx: int | slice) -> Any:
+        starts = self._index()
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(starts)))]
+        if idx < 0:
+            idx += len(starts)
+        if not 0 <= idx < len(starts):
+            raise IndexError("line index out of range")
+        end = starts[idx + 1] - 1 if idx + 1 < len(starts) else self._end()
+        return self._decoded(self._data[starts[idx] : end])
+
+    def __iter__(self) -> Iterator[Any]:
+        # Block by block, without building the index
+        if not len(self._data):
+            return
+        rest, end = b"", self._end()
+        for pos in range(0, end, _BLOCK):
+            block = rest + self._data[pos : min(pos + _BLOCK, end)]
+            if (cut := block.rfind(b"\n")) < 0:
+                rest = block
+                continue
+            block, rest = block[:cut], block[cut + 1 :]
+            if self._codec is None:
+                yield from block.split(b"\n")
+            else:
+                # Cut at a newline, so no character is cut in half
+                yield from block.decode(*self._codec).split("\n")
+        yield self._decoded(rest)
+
+    def _index(self) -> "array[int]":
+        """Offsets of the first byte of every line."""
+        if self._starts is None:
+            starts = array("q", [0] if len(self._data) else [])
+            end = self._end()
+            for pos in range(0, end, _BLOCK):
+                lines = self._data[pos : min(pos + _BLOCK, end)].split(b"\n")
+                # Where each line but the last ends, plus its newline
+                sizes = map((1).__add__, map(len, lines[:-1]))
+                starts.extend(itertools.accumulate(sizes, initial=pos))
+                # pos itself, added by the previous block if a line starts there
+                del starts[len(starts) - len(lines)]
+            self._starts = starts
+        return self._starts
+
+    def _end(self) -> int:
+        """Where the last line ends, before the final newline if any."""
+        size = len(self._data)
+        return size - 1 if size and self._data[size - 1] == ord("\n") else size
+
+    def _decoded(self, line: bytes) -> Any:
+        return line if self._codec is None else line.decode(*self._codec)
+
+
+def sinks(cmd: "Command") -> dict[str, Any]:
+    """Where the captured stdout and stderr of cmd go, see the keep= kwarg.
+    Sinks have write(data) and value(), the decoded output."""
+    match cmd.kwargs.get("keep", None):
+        case (out, err):
+            pass
+        case policy:
+            out = err = policy
+    return {
+        "stdout": _Memory(cmd) if out is None else out.sink(cmd),
+        "stderr": _Memory(cmd) if err is None else err.sink(cmd),
+    }
+
+
+def _codec(cmd: "Command") -> tuple[str, str] | None:
+    if not cmd.kwargs.get("text", True):
+        return None
+    encoding = cmd.kwargs.get("encoding", None) or "utf-8"
+    return encoding, cmd.kwargs.get("errors", None) or "strict"
+
+
+class _Memory:
+    def __init__(self, cmd: "Command") -> None:
+        self.cmd = cmd
+        self.chunks: list[bytes] = []
+
+    def write(self, data: bytes) -> None:
+        self.chunks.append(data)
+
+    def value(self) -> Any:
+        return self.cmd._decoded(b"".join(self.chunks))
+
+
+class _HeadSink:
+    def __init__(self, size: int, cmd: "Command") -> None:
+        self.size = size
+        self.cmd = cmd
+        self.buffer = bytearray()
+        self.truncated = False
+
+    def write(self, data: bytes) -> None:
+        if len(self.buffer) + len(data) > self.size:
+            self.truncated = True
+            data = data[: self.size - len(self.buffer)]
+        self.buffer += data
+
+    def value(self) -> Any:
+        codec = _codec(self.cmd)
+        if self.truncated and codec is not None:
+            # Not final, so an incomplete last character is left out
+            return codecs.getincrementaldecoder(codec[0])(codec[1]).decode(self.buffer)
+        return self.cmd._decoded(bytes(self.buffer))
+
+
+class _TailSink:
+    def __init__(self, size: int, cmd: "Command") -> None:
+        self.size = size
+        self.cmd = cmd
+        # Grows up to size, then wraps around at pos
+        self.ring = bytearray()
+        self.pos = 0
+        self.truncated = False
+
+    def write(self, data: bytes) -> None:
+        if room := self.size - len(self.ring):
+            self.ring += data[:room]
+            data = data[room:]
+        if not data or not self.size:
+            self.truncated = self.truncated or bool(data)
+            return
+        self.truncated = True
+        data = data[-self.size :]
+        first = min(len(data), self.size - self.pos)
+        self.ring[self.pos : self.pos + first] = data[:first]
+        self.ring[: len(data) - first] = data[first:]
+        self.pos = (self.pos + len(data)) % self.size
+
+    def value(self) -> Any:
+        data = bytes(self.ring[self.pos :] + self.ring[: self.pos])
+        codec = _codec(self.cmd)
+        if self.truncated and codec is not None:
+            if codecs.lookup(codec[0]).name == "utf-8":
+                # Skip the continuation bytes of a character cut in half
+                skip = 0
+                while skip < min(3, len(data)) and data[skip] & 0xC0 == 0x80:
+                    skip += 1
+                data = data[skip:]
+        return self.cmd._decoded(data)
+
+
+class _SpillSink:
+    def __init__(self, threshold: int, cmd: "Command") -> None:
+        self.threshold = threshold
+        self.cmd = cmd
+        self.buffer = bytearray()
+        self.file: Any = None
+
+    def write(self, data: bytes) -> None:
+        if self.file is None:
+            if len(self.buffer) + len(data) <= self.threshold:
+                self.buffer += data
+                return
+            import tempfile
+
+            # Unbuffered, and unlinked so that nothing is left behind
+            self.file = tempfile.TemporaryFile(prefix="pysh-", buffering=0)
+            self.file.write(self.buffer)
+            self.buffer = bytearray()
+        self.file.write(data)
+
+    def value(self) -> SpilledOutput:
+        codec = _codec(self.cmd)
+        if self.file is None:
+            return SpilledOutput(bytes(self.buffer), codec)
+        import mmap
+
+        # The mapping stays valid once the file is closed
+        with self.file:
+            return SpilledOutput(
+                mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ), codec
+            )
@@ -1,13 +1,15 @@
-import shutil
+import os
+import shlex
 import subprocess
-import copy
 import time
 from enum import Enum, auto
-from typing import Self, TypeAlias, Any
+from types import MappingProxyType
+from typing import Callable, Self, TypeAlias, Any, Mapping
 from pathlib import Path
 
 from .utils import *
 from .errors import *
+from . import contexts, heredoc, pipeline, spawn
 
 
 class CommitResKind(Enum):
@@ -35,12 +37,20 @@ class CommitResult:
         stdout: bytes | str = "",
         stderr: bytes | str = "",
         elapsed: float | None = None,
+        stages: "list[pipeline.StageResult] | None" = None,
     ) -> None:
         self.kind = kind
         self.retcode = retcode
         self.stdout = stdout
         self.stderr = stderr
         self.elapsed = elapsed
+        self.stages = stages if stages is not None else []
+
+    @property
+    def rusage(self) -> "spawn.Rusage | None":
+        """Total resource usage of the stages, where known."""
+        usages = [stage.rusage for stage in self.stages if stage.rusage is not None]
+        return sum(usages[1:], usages[0]) if usages else None
 
     def __bool__(self) -> bool:
         return self.kind == CommitResKind.SUCCESS
@@ -51,6 +61,9 @@ class Command:
     It can be created, edited (adding parameter or set redirection), pipelined.
     It is NOT executed unless explicitly `commit`ed.
 
+    Commands are immutable values. Editing or pipelining returns a new command
+    which shares its arguments and upstream commands with the original.
+
     NOTE while in principle we can override comparison operators for output redirection,
     Python's chained comparisons lead to weird behaviour.
     Python parses `f >o.txt <i.txt` as `f > o.txt and o.txt < i.txt`.
@@ -66,7 +79,8 @@ class Command:
             e=path      >
             a=path      >>
             eo=1        2>&1
-            #TODO: ii=  <<<
+            ii=data     <<<, str, bytes-like or heredoc.HereDoc.
+                        Unlike bash, no newline is appended.
 
             Special paths:
             * 0 and None    : indicate /dev/null
@@ -76,6 +90,7 @@ class Command:
             Constraints:
             * o and a must not be present at the same time
             * i and stdin are exclusive. Same for o and stdout, e and stderr.
+            * i and ii are exclusive.
 
         PIPELINING
             The operator `|` is supported for pipelining.
@@ -83,6 +98,16 @@ class Command:
             kwargs          meaning
             ===================
             pipefrom=cmd    self takes input from output of cmd i.e. cmd|self
+            pipefail=1      like `set -o pipefail`, see pipeline.Pipeline.
+            pystage=fn      run fn(BuiltinIO) in a thread instead of a program,
+                            see pyfilter.PyFilter.
+
+        PROCESS
+            kwargs          meaning
+            ===================
+            cwd=path        working directory of the process.
+            env=mapping     the whole environment of the process,
+                            instead of the one of this process.
 
         COMMAND SUBSTITUTION
             Capture command outputs like $( ... )
@@ -91,36 +116,77 @@ class Command:
             ===================
             capture=1       capture stdout.
                             Use in combination with eo=1 to capture stderr.
+
+        DECODING
+            How captured output is turned into CommitResult.stdout and stderr.
+
+            kwargs          meaning
+            ===================
+            text=False      keep captured output as raw bytes, do not decode.
+            encoding=str    codec used to decode captured output. Default utf-8.
+            errors=str      codec error handler, e.g. "replace". Default strict.
+            keep=policy     how much captured output is kept, see capture.py.
     """
 
     # TODO: kwargs validity check
     #       o, stdout exclusive etc
 
+    __slots__ = ("args", "kwargs")
+    args: tuple[str, ...]
+    kwargs: Mapping[str, Any]
+
     def __init__(self, *args: str, **kwargs: Any) -> None:
-        self.args: list[str] = []
-        self.kwargs: dict[str, Any] = {}
-        self.update(*args, **kwargs)
+        args, kwargs = Command._normalized_args(args, kwargs)
+        object.__setattr__(self, "args", tuple(args))
+        object.__setattr__(self, "kwargs", MappingProxyType(kwargs))
+
+    @classmethod
+    def _from_parts(cls, args: tuple[str, ...], kwargs: Mapping[str, Any]) -> Self:
+        new = object.__new__(cls)
+        object.__setattr__(new, "args", args)
+        object.__setattr__(new, "kwargs", kwargs)
+        return new
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError(f"Command is immutable, use update() to derive a new one")
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError(f"Command is immutable, use update() to derive a new one")
+
+    def __reduce__(self) -> tuple[Any, ...]:
+        return (_rebuild_command, (type(self), self.args, dict(self.kwargs)))
+
+    def __copy__(self) -> Self:
+        return self
+
+    def __deepcopy__(self, memo: dict[int, Any]) -> Self:
+        return self
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Command):
+            return NotImplemented
+        return self.args == other.args and self.kwargs == other.kwargs
+
+    def __hash__(self) -> int:
+        return hash((self.args, _frozen(self.kwargs)))
 
-    def update(self, *args: str, **kwargs: Any) -> None:
+    def update(self, *args: str, **kwargs: Any) -> Self:
         """Augment the command.
         Added parameters and options should be passed as `*args`.
         Information related to invocation of the command (redirection etc) is passed in `**kwargs`, such as redirections.
 
-        Modifies self in-place.
+        Commands are immutable. Returns a new command that shares structure
+        with self, e.g. an upstream pipeline is referenced instead of copied.
         """
+        if not args and not kwargs:
+            return self
         args, kwargs = Command._normalized_args(args, kwargs)
-        self.args += args
-        self.kwargs.update(kwargs)
+        merged = MappingProxyType({**self.kwargs, **kwargs}) if kwargs else self.kwargs
+        return self._from_parts(self.args + tuple(args), merged)
 
     def update_copy(self, *args: str, **kwargs: Any) -> Self:
-        """Copy the command and augment it.
-        Operates on a copy of self, leaving self intact.
-
-        For details check update().
-        """
-        new = copy.deepcopy(self)
-        new.update(*args, **kwargs)
-        return new
+        """Same as update(). Kept for compatibility."""
+        return self.update(*args, **kwargs)
 
     @staticmethod
     def _normalized_args(args, kwargs) -> tuple[Any, Any]:
@@ -150,86 +216,69 @@ class Command:
                 raise ValueError(f"Invalid redirection {redir}")
         return ""  # XXX: why does mypy complain?
 
-    def popen_inplace(self, *args: str, **kwargs: Any) -> subprocess.Popen:
-        """Get the popen object used for this command.
-        IMMEDIATELY spawns the process and starts execution.
-
-        Modifies self in-place."""
-        self.update(*args, **kwargs)
-        if "pipefrom" not in self.kwargs:
-            # self is not pipelined (or is the very first of a pipeline)
-            kwargs = self._popen_kwargs()
-            proc = subprocess.Popen(self.args, **kwargs)
-            return proc
-        else:
-            proc1 = self.kwargs["pipefrom"].popen(o=subprocess.PIPE)
-            kwargs = self._popen_kwargs(pipefrom=proc1.stdout)
-            proc2 = subprocess.Popen(self.args, **kwargs)
-            proc1.stdout.close()  # required
-            return proc2
-
     def popen(self, *args: str, **kwargs: Any) -> subprocess.Popen:
         """Get the popen object used for this command.
-        For details check popen_inplace().
+        IMMEDIATELY spawns the process and starts execution.
+        For a pipeline this is the popen object of the last stage, use
+        pipeline.Pipeline to access every stage.
 
-        Operates on a copy of self."""
-        new = copy.deepcopy(self)
-        return new.popen_inplace(*args, **kwargs)
+        Arguments augment the command, see update()."""
+        return pipeline.Pipeline(self.update(*args, **kwargs)).spawn().procs[-1]
 
     def commit(self, *args: str, **kwargs) -> CommitResult:
         """Commit the command to system and execute it.
 
         kwargs: See Run()
-        * input, timeout, strict, suppress
+        * input, timeout, strict, suppress, cache
         """
-        RUN_KEYS = ["timeout", "input", "strict"]
+        RUN_KEYS = ["timeout", "input", "strict", "cache"]
         run_kwargs = project_dict(kwargs, *RUN_KEYS)
         kwargs = dict(kv for kv in kwargs.items() if kv[0] not in RUN_KEYS)
-        time_start = time.perf_counter()
-        with self.popen(*args, **kwargs) as proc:
-            try:
-                timeout = run_kwargs.get("timeout", None)
-                input = run_kwargs.get("input", None)
-                output, stderr = proc.communicate(input=input, timeout=timeout)
-                # TODO: binary output
-                stdout = output.decode() if output is not None else ""
-                stderr = stderr.decode() if stderr is not None else ""
-                elapsed = time.perf_counter() - time_start
-                retcode = proc.poll()
-                if retcode == 0:
-                    kind = CommitResKind.SUCCESS
-                else:
-                    kind = CommitResKind.FAILED
-                res = CommitResult(
-                    kind, retcode, stdout=stdout, stderr=stderr, elapsed=elapsed
-                )
-                if retcode != 0 and run_kwargs.get("strict", False):
-                    raise PyShCommitError(res)
-                else:
-                    return res
-            except subprocess.TimeoutExpired as exc:
-                elapsed = time.perf_counter() - time_start
-                kind = CommitResKind.TIMEOUT
-                retcode = proc.poll()
-                proc.kill()
-                proc.wait()
-                stdout = exc.output.decode() if exc.output is not None else ""
-                stderr = exc.stderr.decode() if exc.stderr is not None else ""
-                res = CommitResult(
-                    kind, retcode, stdout=stdout, stderr=stderr, elapsed=elapsed
-                )
-                if run_kwargs.get("strict", False):
-                    raise PyShCommitError(res)
-                else:
-                    return res
-            except Exception as exc:
-                proc.kill()
-                raise
+        input = run_kwargs.get("input", None)
+        cmd = contexts.in_session(self.update(*args, **kwargs), input is not None)
+        timeout = contexts.effective_timeout(run_kwargs.get("timeout", None))
+        if (batch := contexts._batch.get()) is not None:
+            if (pending := batch.add(cmd, timeout, run_kwargs)) is not None:
+                return pending
+
+        def run() -> CommitResult:
+            if (agent := contexts._agent.get()) is not None:
+                return agent.run(cmd, input, timeout)
+            with pipeline.Pipeline(cmd) as pipe:
+                if timeout is not None and "pgroup" not in cmd.kwargs:
+                    pipe.pgroup = True
+                pipe.spawn(stdin=input is not None)
+                return pipe.communicate(input, timeout)
+
+        match run_kwargs.get("cache", None):
+            case None | False:
+                res = run()
+            case True:
+                # Imported on first use to keep `import pysh` fast
+                from . import cache
+
+                res = cache.default_cache.fetch(cmd, input, run)
+            case result_cache:
+                res = result_cache.fetch(cmd, input, run)
+        if res.kind != CommitResKind.SUCCESS and run_kwargs.get("strict", False):
+            raise PyShCommitError(res)
+        return res
+
+    def _decoded(self, data: bytes | None) -> bytes | str:
+        """Decode captured output as requested by the text, encoding and errors kwargs.
+        With text=False the bytes read from the pipe are returned as is, without copying.
+        """
+        if data is None:
+            data = b""
+        if not self.kwargs.get("text", True):
+            return data
+        encoding = self.kwargs.get("encoding", None) or "utf-8"
+        return data.decode(encoding, self.kwargs.get("errors", None) or "strict")
 
     def __call__(self, *args: str, **kwargs):
         """Add new arguments and update options.
         Returns a new command without modifying self."""
-        return self.update_copy(*args, **kwargs)
+        return self.update(*args, **kwargs)
 
     def __or__(self, cmd: Self) -> Self:
         """Bash-like command pipelining.
@@ -237,31 +286,43 @@ class Command:
         if not isinstance(cmd, Command):
             raise TypeError(f"Expected a Command object for pipelining. Got {cmd}")
         assert "pipefrom" not in cmd.kwargs
-        return cmd.update_copy(pipefrom=copy.deepcopy(self))
-
-    def __str__(self):
-        res = []
-        if (pipefrom := self.kwargs.get("pipefrom", None)) is not None:
-            res += [str(pipefrom), "|"]
-        for arg in self.args:
-            if " " in arg:
-                res += ['"' + arg + '"']
-            else:
-                res += [arg]
-        if (i := self.kwargs.get("i", None)) is not None:
-            res += ["<", Command._redir2str(i)]
-        if (o := self.kwargs.get("o", None)) is not None:
-            res += [">", Command._redir2str(o)]
-        if (e := self.kwargs.get("e", None)) is not None:
-            res += ["2>", Command._redir2str(e)]
-        if (eo := self.kwargs.get("eo", None)) is not None:
-            res += ["2>&1"]
-        if (capture := self.kwargs.get("capture", None)) is not None:
-            res = ["$("] + res + [")"]
-        return " ".join(res)
+        return cmd.update(pipefrom=self)
+
+    def __str__(self) -> str:
+        """The command in bash syntax. Arguments and paths are quoted, so
+        the result can be pasted into a shell, except for <pipe> and
+        <heredoc>."""
+        res = " | ".join(
+            " ".join(stage._shell(Command._redir2word))
+            for stage in pipeline.Pipeline.unfold(self)
+        )
+        if self.kwargs.get("capture", None) is not None:
+            res = f"$( {res} )"
+        return res
+
+    def _shell(self, redir: Callable[[str, Any], str]) -> list[str]:
+        """Words of this stage in bash syntax, ignoring pipefrom.
+        redir(kwname, value) gives the word a redirection refers to."""
+        res = [shlex.quote(os.fsdecode(arg)) for arg in self.args]
+        for kwname, op in [("i", "<"), ("o", ">"), ("a", ">>"), ("e", "2>")]:
+            if kwname in self.kwargs:
+                res += [op, redir(kwname, self.kwargs[kwname])]
+        if "ii" in self.kwargs:
+            res += ["<", "<heredoc>"]
+        if "eo" in self.kwargs:
+            res += ["2>&1"] if self.kwargs["eo"] == 1 else [">", "/dev/null", "2>&1"]
+        return res
+
+    @staticmethod
+    def _redir2word(kwname: str, redir: Any) -> str:
+        if redir == subprocess.PIPE:
+            return "<pipe>"
+        return shlex.quote(Command._redir2str(redir))
 
     def _popen_kwargs(self, **kwargs) -> dict[str, Any]:
-        """Interfacing python commands with system commands."""
+        """Interfacing python commands with system commands.
+        Redirection files are opened here, the caller must close them once the
+        process is spawned."""
         res: dict[str, Any] = {}
         kwargs = self.kwargs | kwargs
         # HANDLE: a o e i
@@ -279,11 +340,13 @@ class Command:
                 case subprocess.PIPE:
                     res[resname] = subprocess.PIPE
                 case str(s):
-                    res[resname] = open(s, openflags)  # TODO: close
+                    res[resname] = (Path(s), openflags)
                 case p if isinstance(p, Path):
-                    res[resname] = p.open(openflags)
+                    res[resname] = (p, openflags)
                 case inv:
                     raise ValueError(f'Invalid kwargs["{kwname}"]: {inv}')
+        if "ii" in kwargs and "i" in kwargs:
+            raise ValueError("i and ii are exclusive")
         # HANDLE: eo
         if "eo" in kwargs:
             match kwargs["eo"]:
@@ -294,11 +357,48 @@ class Command:
                     res["stderr"] = subprocess.STDOUT
         if kwargs.get("capture", None) == 1:
             res["stdout"] = subprocess.PIPE
-        # HANDLE: pipefrom
-        if "pipefrom" in kwargs:
-            res["stdin"] = kwargs["pipefrom"]
-        # HANDLE: cwd
+        # HANDLE: cwd, env
         if "cwd" in kwargs:
             res["cwd"] = Path(kwargs["cwd"])
             assert res["cwd"].is_dir()
+        if kwargs.get("env", None) is not None:
+            res["env"] = dict(kwargs["env"])
+        # Open the files last, so that nothing leaks if anything above fails
+        try:
+            if "ii" in kwargs:
+                res["stdin"] = heredoc.open_input(kwargs["ii"])
+            for resname in ("stdin", "stdout", "stderr"):
+                if isinstance(res.get(resname, None), tuple):
+                    path, openflags = res[resname]
+                    res[resname] = path.open(openflags)
+        except BaseException:
+            for resname in ("stdin", "stdout", "stderr"):
+                if hasattr(res.get(resname, None), "close"):
+                    res[resname].close()
+            raise
         return res
+
+
+def _frozen(value: Any) -> Any:
+    """A hashable stand-in for value, equal for equal values."""
+    if isinstance(value, Mapping):
+        return frozenset((k, _frozen(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(_frozen(v) for v in value)
+    if isinstance(value, set):
+        return frozenset(value)
+    if isinstance(value, bytearray):
+        return bytes(value)
+    try:
+        hash(value)
+    except TypeError:
+        # Equal values must hash alike, so only the type can be used
+        return type(value)
+    return value
+
+
+def _rebuild_command(
+    cls: type[Command], args: tuple[str, ...], kwargs: dict
+) -> Command:
+    """Unpickles a Command."""
+    return cls._from_parts(args, MappingProxyType(kwargs))
@@ -1,6 +1,17 @@
 import contextlib
+import contextvars
 import os
+import time
 from pathlib import Path
+from types import MappingProxyType
+from typing import TYPE_CHECKING, Any, Self
+
+from .utils import timeout_to_seconds
+
+if TYPE_CHECKING:
+    from .agent import Agent
+    from .batch import Batch
+    from .command import Command
 
 
 @contextlib.contextmanager
@@ -10,11 +21,205 @@ def ChDir(path: str | Path):
         with ChDir(".."):
             Run("ls")
 
-    Still this modifies the system-wide CWD.
-    Better is to individually supply cwd parameters to subprocess."""
+    Still this modifies the system-wide CWD, which races with commands run
+    by other threads. Better is Session(cwd=path) or the cwd= kwarg."""
     prev = Path.cwd()
     os.chdir(path)
     try:
         yield
     finally:
         os.chdir(prev)
+
+
+_deadline: contextvars.ContextVar[float | None] = contextvars.ContextVar(
+    "pysh_deadline", default=None
+)
+
+
+class Deadline:
+    """A time limit shared by every command run inside the block.
+    USAGE
+        with Deadline("3m24s"):
+            Run(git, "fetch")          # at most 3m24s
+            Run(make, timeout="5m")    # whatever is left, if less than 5m
+
+    Nested deadlines cannot extend the enclosing one. The deadline follows
+    the context, so it applies to asyncio tasks and to Parallel() too."""
+
+    def __init__(self, duration: int | float | str) -> None:
+        self.duration = timeout_to_seconds(duration)
+        self.at: float | None = None
+        self._token: contextvars.Token | None = None
+
+    def __enter__(self) -> Self:
+        self.at = time.perf_counter() + self.duration
+        if (outer := _deadline.get()) is not None:
+            self.at = min(self.at, outer)
+        self._token = _deadline.set(self.at)
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        assert self._token is not None
+        _deadline.reset(self._token)
+
+    def remaining(self) -> float:
+        assert self.at is not None, "Deadline not entered"
+        return max(0.0, self.at - time.perf_counter())
+
+
+_session: contextvars.ContextVar["Session | None"] = contextvars.ContextVar(
+    "pysh_session", default=None
+)
+
+
+class Session:
+    """A working directory, environment variables and default redirections
+    for every command run inside the block, like a subshell.
+    USAGE
+        with Session(cwd="build", env={"CC": "clang", "CFLAGS": None}, e=None):
+            Run(make)               # in build/, CFLAGS unset, no stderr
+            with Session(cwd=".."):
+                Run(ls_)            # lists the parent of build/
+
+    Nothing global is changed: the process keeps its cwd and os.environ.
+    The session follows the context like Deadline, so threads each have
+    their own. Parallel(), Plan and asyncio tasks use the session of the
+    code that started them.
+
+    * cwd: str|Path=None
+      Relative to the cwd of the enclosing session, if any. Relative
+      redirection paths and cwd= kwargs are relative to it as well.
+    * env: dict=None
+      Variables exported to the commands, on top of os.environ and of the
+      enclosing sessions. None unsets a variable. Commands given a whole
+      environment with env= are left alone.
+    * i, o, a, e, eo: redirections, see Command
+      Applied to commands that do not redirect the same stream. i= applies
+      to the first stage of a pipeline, e= to every stage, o=, a= and eo=
+      to the last stage.
+    """
+
+    REDIRECTIONS = ("i", "o", "a", "e", "eo")
+
+    def __init__(
+        self,
+        cwd: str | Path | None = None,
+        env: dict[str, str | None] | None = None,
+        **redirections: Any,
+    ) -> None:
+        if unknown := set(redirections) - set(self.REDIRECTIONS):
+            raise TypeError(f"Unexpected Session arguments {sorted(unknown)}")
+        self.cwd = cwd
+        self.env = env or {}
+        self.redirections = redirections
+        self._token: contextvars.Token | None = None
+        # Merged with the enclosing session
+        self._cwd: str | None = None
+        self._env: dict[str, str | None] = {}
+        self._defaults: dict[str, Any] = {}
+
+    def __enter__(self) -> Self:
+        outer = _session.get()
+        base = outer._cwd if outer is not None else None
+        if self.cwd is not None:
+            cwd = os.path.join(base or os.getcwd(), self.cwd)
+            if not os.path.isdir(cwd):
+                raise NotADirectoryError(f"Not a directory: {cwd}")
+            base = os.path.normpath(cwd)
+        self._cwd = base
+        self._env = (outer._env if outer is not None else {}) | self.env
+        self._defaults = dict(outer._defaults) if outer is not None else {}
+        for name, value in self.redirections.items():
+            if isinstance(value, (str, Path)):
+                value = os.path.join(base or os.getcwd(), value)
+            if name in ("o", "a"):
+                # Replaces the other one
+                self._defaults.pop("a" if name == "o" else "o", None)
+            self._defaults[name] = value
+        self._token = _session.set(self)
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        assert self._token is not None
+        _session.reset(self._token)
+
+    def apply(self, cmd: "Command", stdin: bool = False) -> "Command":
+        """cmd as run in this session. Applying it twice changes nothing.
+        stdin tells that the first stage reads from the caller, e.g. input=,
+        so that i= does not apply."""
+        from .pipeline import Pipeline
+
+        env = None
+        if self._env:
+            env = {k: v for k, v in (os.environ | self._env).items() if v is not None}
+        stages = Pipeline.unfold(cmd)
+        res = None
+        for pos, stage in enumerate(stages):
+            kwargs = dict(stage.kwargs)
+            if self._cwd is not None:
+                for name in ("i", "o", "a", "e", "cwd"):
+                    if isinstance(value := kwargs.get(name, None), (str, Path)):
+                        kwargs[name] = os.path.join(self._cwd, value)
+                kwargs.setdefault("cwd", self._cwd)
+            if env is not None and kwargs.get("env", None) is None:
+                kwargs["env"] = env
+            for name, value in self._defaults.items():
+                first = pos == 0 and not stdin
+                if _applies(name, value, kwargs, first, pos == len(stages) - 1):
+                    kwargs[name] = value
+            if res is not None:
+                kwargs["pipefrom"] = res
+            res = type(stage)._from_parts(stage.args, MappingProxyType(kwargs))
+        assert res is not None
+        return res
+
+
+def _applies(
+    name: str, value: Any, kwargs: dict[str, Any], first: bool, last: bool
+) -> bool:
+    """Whether the default redirection name=value applies to a stage."""
+    stdout = any(k in kwargs for k in ("o", "a", "capture")) or kwargs.get("eo") == 0
+    stderr = "e" in kwargs or "eo" in kwargs
+    match name:
+        case "i":
+            return first and "i" not in kwargs and "ii" not in kwargs
+        case "o" | "a":
+            return last and not stdout
+        case "e":
+            return not stderr
+        case _:
+            return last and not stderr and not (value == 0 and stdout)
+
+
+def in_session(cmd: "Command", stdin: bool = False) -> "Command":
+    """cmd as run in the current Session, see Session.apply()."""
+    session = _session.get()
+    return cmd if session is None else session.apply(cmd, stdin)
+
+
+def session_path(path: str | Path) -> str | Path:
+    """path relative to the cwd of the current Session, if any."""
+    session = _session.get()
+    if session is None or session._cwd is None:
+        return path
+    return os.path.join(session._cwd, path)
+
+
+def effective_timeout(timeout: int | float | str | None) -> float | None:
+    """The timeout for a command, in seconds, bounded by the current Deadline."""
+    seconds = None if timeout is None else timeout_to_seconds(timeout)
+    if (at := _deadline.get()) is not None:
+        left = max(0.0, at - time.perf_counter())
+        seconds = left if seconds is None else min(seconds, left)
+    return seconds
+
+
+# The Batch collecting the Run() calls of the current context, see batch.py
+_batch: contextvars.ContextVar["Batch | None"] = contextvars.ContextVar(
+    "pysh_batch", default=None
+)
+
+# The Agent running the commands of the current context, see agent.py
+_agent: contextvars.ContextVar["Agent | None"] = contextvars.ContextVar(
+    "pysh_agent", default=None
+)
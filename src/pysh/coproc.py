@@ -0,0 +1,333 @@
+"""Long-running commands answering requests over their stdin and stdout.
+
+USAGE
+    with Coproc("bc", "-q") as bc:
+        bc.request("2^64")  # returns: "18446744073709551616"
+
+    # Up to 4 instances shared by the threads calling request()
+    with CoprocPool(git("cat-file", "--batch-check"), size=4) as pool:
+        info = pool.request("HEAD")  # returns: "<sha> commit 259"
+
+Messages are delimited by a framing. LineFraming (the default) and
+LengthPrefixFraming are provided; tools with their own protocol get a
+custom one, see Framing.
+"""
+import os
+import queue
+import select
+import struct
+import subprocess
+import threading
+import time
+from collections import deque
+from typing import Any, Self
+
+from .command import Command
+from .contexts import effective_timeout, in_session
+from .errors import PyShCoprocError
+from .pipeline import Pipeline
+
+
+class FrameReader:
+    """Buffered reads of the stdout of a coprocess, with a deadline."""
+
+    READ_SIZE = 65536
+
+    def __init__(self, fd: int) -> None:
+        self.fd = fd
+        self.buffer = bytearray()
+        self.deadline: float | None = None
+
+    def fill(self) -> None:
+        """Reads what is available, waiting for at least one byte.
+        Raises EOFError once the coprocess closed its stdout."""
+        if self.deadline is not None:
+            wait = max(0.0, self.deadline - time.perf_counter())
+            if not select.select([self.fd], [], [], wait)[0]:
+                raise TimeoutError()
+        if not (data := os.read(self.fd, self.READ_SIZE)):
+            raise EOFError()
+        self.buffer += data
+
+    def read_exact(self, size: int) -> bytes:
+        while len(self.buffer) < size:
+            self.fill()
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def read_until(self, sep: bytes) -> bytes:
+        """Reads up to and including sep."""
+        start = 0
+        while (pos := self.buffer.find(sep, start)) < 0:
+            start = max(0, len(self.buffer) - len(sep) + 1)
+            self.fill()
+        return self.read_exact(pos + len(sep))
+
+
+class Framing:
+    """How messages are delimited on the pipes.
+    encode() turns a request into bytes to write, decode() reads one
+    response with the FrameReader."""
+
+    def encode(self, message: bytes) -> bytes:
+        raise NotImplementedError
+
+    def decode(self, reader: FrameReader) -> bytes:
+        raise NotImplementedError
+
+
+class LineFraming(Framing):
+    """One message per line. The separator is not part of the message."""
+
+    def __init__(self, sep: bytes = b"\n") -> None:
+        self.sep = sep
+
+    def encode(self, message: bytes) -> bytes:
+        return message if message.endswith(self.sep) else message + self.sep
+
+    def decode(self, reader: FrameReader) -> bytes:
+        return reader.read_until(self.sep)[: -len(self.sep)]
+
+
+class LengthPrefixFraming(Framing):
+    """Messages prefixed with their length, packed with the struct format."""
+
+    def __init__(self, fmt: str = "!I") -> None:
+        self.fmt = fmt
+
+    def encode(self, message: bytes) -> bytes:
+        return struct.pack(self.fmt, len(message)) + message
+
+    def decode(self, reader: FrameReader) -> bytes:
+        (size,) = struct.unpack(self.fmt, reader.read_exact(struct.calcsize(self.fmt)))
+        return reader.read_exact(size)
+
+
+class Coproc:
+    """A command kept running to answer requests, like bash's coproc.
+    Spawned right away.
+
+    Keyword arguments:
+    * framing: Framing=LineFraming()
+    * restart: bool=True
+      If the coprocess exited, the next call starts it again. The call
+      during which it exited raises PyShCoprocError either way.
+    * text, encoding, errors: see Run(). Messages may be str or bytes,
+      responses are str unless text=False.
+    * for more check Run(). stdin and stdout must not be redirected.
+
+    stderr is drained in the background, its tail is part of the errors.
+    Requests are serialized, use CoprocPool to run them concurrently.
+    """
+
+    STDERR_TAIL = 65536
+
+    def __init__(self, cmd: str | Command, *args: str, **kwargs: Any) -> None:
+        self.framing: Framing = kwargs.pop("framing", None) or LineFraming()
+        self.restart: bool = kwargs.pop("restart", True)
+        if isinstance(cmd, str):
+            cmd = Command(cmd)
+        # The session at creation applies to restarts too
+        self.cmd = in_session(
+            cmd.update(*args, **{"o": subprocess.PIPE, "e": subprocess.PIPE} | kwargs),
+            stdin=True,
+        )
+        self.restarts = -1
+        self._closed = False
+        self._lock = threading.Lock()
+        self._start()
+
+    def _start(self) -> None:
+        self._pipe = Pipeline(self.cmd).spawn(stdin=True)
+        self.restarts += 1
+        self._reader = FrameReader(self._pipe.stdout.fileno())
+        self._stderr: deque[bytes] = deque()
+        self._stderr_thread: threading.Thread | None = None
+        if self._pipe.stderr is not None:
+            # The thread owns its copy, so that closing the pipeline is safe
+            fd = os.dup(self._pipe.stderr.fileno())
+            self._stderr_thread = threading.Thread(
+                target=self._drain_stderr, args=(fd, self._stderr), daemon=True
+            )
+            self._stderr_thread.start()
+
+    def _drain_stderr(self, fd: int, tail: deque[bytes]) -> None:
+        size = 0
+        try:
+            while data := os.read(fd, 65536):
+                tail.append(data)
+                size += len(data)
+                while size - len(tail[0]) >= self.STDERR_TAIL:
+                    size -= len(tail.popleft())
+        finally:
+            os.close(fd)
+
+    @property
+    def pid(self) -> int:
+        return self._pipe.procs[-1].pid
+
+    def running(self) -> bool:
+        return self._pipe.running()
+
+    def send(self, message: str | bytes, timeout: Any = None) -> None:
+        """Sends a message without waiting for a response."""
+        with self._lock:
+            self._call(message, False, timeout)
+
+    def recv(self, timeout: Any = None) -> str | bytes:
+        """Waits for one message."""
+        with self._lock:
+            return self._call(None, True, timeout)
+
+    def request(self, message: str | bytes, timeout: Any = None) -> str | bytes:
+        """Sends a message and waits for the response.
+        Raises PyShCoprocError if the coprocess exits or the timeout expires.
+        """
+        with self._lock:
+            return self._call(message, True, timeout)
+
+    def _call(
+        self, message: str | bytes | None, respond: bool, timeout: Any
+    ) -> str | bytes:
+        if self._closed:
+            raise PyShCoprocError(f"{self.cmd} is closed", b"")
+        if not self._pipe.running():
+            if not self.restart:
+                raise self._error("exited")
+            self._stop()
+            self._start()
+        timeout = effective_timeout(timeout)
+        self._reader.deadline = (
+            None if timeout is None else time.perf_counter() + timeout
+        )
+        try:
+            if message is not None:
+                if isinstance(message, str):
+                    message = message.encode(*self._codec())
+                self._write(self.framing.encode(message))
+            if not respond:
+                return b""
+            response = self.framing.decode(self._reader)
+        except TimeoutError:
+            # Unknown protocol state, start afresh next time
+            self._stop()
+            raise self._error(f"timed out after {timeout}s") from None
+        except (EOFError, BrokenPipeError):
+            self._stop()
+            raise self._error("exited") from None
+        return self.cmd._decoded(response)
+
+    def _write(self, data: bytes) -> None:
+        """Writes all of data while buffering responses, so that a coprocess
+        blocked on writing its stdout cannot deadlock us."""
+        fd = self._pipe.stdin.fileno()
+        view = memoryview(data)
+        while view:
+            wait = None
+            if self._reader.deadline is not None:
+                wait = max(0.0, self._reader.deadline - time.perf_counter())
+            readable, writable, _ = select.select([self._reader.fd], [fd], [], wait)
+            if not readable and not writable:
+                raise TimeoutError()
+            if writable:
+                view = view[os.write(fd, view[: select.PIPE_BUF]) :]
+            if readable:
+                self._reader.fill()
+
+    def _codec(self) -> tuple[str, str]:
+        return (
+            self.cmd.kwargs.get("encoding", None) or "utf-8",
+            self.cmd.kwargs.get("errors", None) or "strict",
+        )
+
+    def _error(self, what: str) -> PyShCoprocError:
+        if self._stderr_thread is not None:
+            # Usually done soon after the coprocess exited
+            self._stderr_thread.join(0.1)
+        stderr = b"".join(self._stderr)
+        retcode = self._pipe.procs[-1].poll()
+        return PyShCoprocError(f"{self.cmd} {what} (retcode {retcode})", stderr)
+
+    def _stop(self) -> None:
+        """Kills and reaps the coprocess."""
+        self._pipe.__exit__(None, None, None)
+
+    def close(self, grace: float = 1) -> None:
+        """Closes the stdin of the coprocess and waits for it to exit,
+        terminating it after grace seconds."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            try:
+                self._pipe.stdin.close()
+            except BrokenPipeError:
+                pass
+            deadline = time.perf_counter() + grace
+            while self._pipe.running() and time.perf_counter() < deadline:
+                time.sleep(0.005)
+            self._pipe.terminate()
+            self._stop()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+
+class CoprocPool:
+    """Up to `size` instances of the same coprocess, shared by threads.
+    Instances are started on demand. With restart=False, an instance that
+    exited is replaced by a new one instead of being handed out again.
+
+    Arguments: see Coproc(). size defaults to os.cpu_count().
+    """
+
+    def __init__(
+        self, cmd: str | Command, *args: str, size: int | None = None, **kwargs: Any
+    ) -> None:
+        self.size = size or os.cpu_count() or 1
+        self._cmd = cmd
+        self._args = args
+        self._kwargs = kwargs
+        self._lock = threading.Lock()
+        self._all: list[Coproc] = []
+        self._idle: queue.SimpleQueue[Coproc] = queue.SimpleQueue()
+
+    def request(self, message: str | bytes, timeout: Any = None) -> str | bytes:
+        coproc = self._acquire()
+        try:
+            return coproc.request(message, timeout)
+        finally:
+            self._idle.put(coproc)
+
+    def _acquire(self) -> Coproc:
+        try:
+            coproc = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                if len(self._all) < self.size:
+                    self._all.append(Coproc(self._cmd, *self._args, **self._kwargs))
+                    return self._all[-1]
+            coproc = self._idle.get()
+        if coproc.restart or coproc.running():
+            return coproc
+        # Would only raise PyShCoprocError, its slot goes to a new instance
+        coproc.close()
+        with self._lock:
+            self._all.remove(coproc)
+            self._all.append(Coproc(self._cmd, *self._args, **self._kwargs))
+            return self._all[-1]
+
+    def close(self) -> None:
+        with self._lock:
+            for coproc in self._all:
+                coproc.close()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
@@ -8,3 +8,10 @@ class PyShError(Exception):
 class PyShCommitError(PyShError):
     def __init__(self, res: "command.CommitResult") -> None:
         self.res = res
+
+
+class PyShCoprocError(PyShError):
+    def __init__(self, message: str, stderr: bytes) -> None:
+        super().__init__(message)
+        # The last bytes the coprocess wrote to stderr
+        self.stderr = stderr
@@ -1,10 +1,28 @@
-from typing import Any
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Iterable,
+    Iterator,
+    Literal,
+    Mapping,
+    overload,
+)
+from pathlib import Path
+import contextvars
+import os
 import subprocess
-import copy
+import threading
+import time
 
+from . import contexts
 from .command import Command, CommitResult, CommitResKind
 from .utils import *
 
+if TYPE_CHECKING:
+    from concurrent.futures import Future
+
+    from .capture import InMemory, Spilling, SpilledOutput
+
 
 def Run(cmd: str | Command, *args: str, **kwargs: Any) -> CommitResult:
     """Executes the command with the arguments.
@@ -22,17 +40,31 @@ def Run(cmd: str | Command, *args: str, **kwargs: Any) -> CommitResult:
       If true, suppress all python exceptions raised by the command.
       Can cause bugs to go undetected, like mistyped commands.
     * timeout: int|str=None
-      Timeout in seconds, or suffixed with [smh].
-    * input: str=None
-      Supplied stdin input.
+      Timeout in seconds, or a duration like "5m" or "3m24s".
+      Bounded by the enclosing Deadline, if any. On timeout every process of
+      the command gets SIGTERM, then SIGKILL, see Pipeline for pgroup and
+      kill_after.
+    * input: str|bytes=None
+      Supplied stdin input. Also a file object, an iterable of str or bytes,
+      or a function returning one of those, e.g. a generator function.
+      Those are read one chunk at a time as the command consumes them.
     * capture: bool=False
       Whether to capture stdout AND stderr.
       Precedence is lower than redirection.
+    * text: bool=True
+      If false, captured stdout and stderr are returned as raw bytes.
+    * encoding: str="utf-8", errors: str="strict"
+      How captured stdout and stderr are decoded when text=True.
+    * keep: KeepHead|KeepTail|Spill=None
+      Bound the memory held by captured output, see capture.py. A pair
+      (stdout policy, stderr policy) applies a different one to each.
+    * cache: ResultCache|bool=None
+      Reuse the result of an identical earlier run, see cache.ResultCache.
+      True uses a process-wide cache without dependencies or TTL.
     """
     (suppress, capture) = multipop_dict(kwargs, suppress=False, capture=False)
     if isinstance(cmd, str):
         cmd = Command(cmd)
-    cmd = copy.deepcopy(cmd)
     try:
         if capture:
             kwargs = {"o": subprocess.PIPE, "e": subprocess.PIPE} | kwargs
@@ -43,13 +75,45 @@ def Run(cmd: str | Command, *args: str, **kwargs: Any) -> CommitResult:
         return CommitResult(CommitResKind.CRITICAL, None, "", "", None)
 
 
-def Cap(cmd: str | Command, *args: str, **kwargs: Any) -> str:
+@overload
+def Cap(
+    cmd: str | Command,
+    *args: str,
+    keep: "Spilling",
+    **kwargs: Any,
+) -> "SpilledOutput":
+    ...
+
+
+@overload
+def Cap(
+    cmd: str | Command,
+    *args: str,
+    text: Literal[False],
+    keep: "InMemory" = None,
+    **kwargs: Any,
+) -> bytes:
+    ...
+
+
+@overload
+def Cap(
+    cmd: str | Command,
+    *args: str,
+    text: Literal[True] = True,
+    keep: "InMemory" = None,
+    **kwargs: Any,
+) -> str:
+    ...
+
+
+def Cap(cmd: str | Command, *args: str, **kwargs: Any) -> "str | bytes | SpilledOutput":
     """Executes the command with the arguments and captures stdout.
     Different from the capture kwargs, which additionally captures stderr.
 
     Returns:
-      a str containing the stdout contents.
-      By default strips the output.
+      a str containing the stdout contents, or bytes with text=False.
+      By default strips the output, unless it is a capture.SpilledOutput.
 
     Keyword arguments:
     * strip: bool=True
@@ -63,9 +127,211 @@ def Cap(cmd: str | Command, *args: str, **kwargs: Any) -> str:
     # kwargs takes precedence so that Cap works with redirects
     res = Run(cmd, *args, **{"o": subprocess.PIPE} | kwargs)
     stdout = res.stdout
-    if isinstance(stdout, bytes):
-        raise ValueError(f"You can only capture text stdout with Cap(), but got bytes.")
-    if strip:
+    if strip and isinstance(stdout, (str, bytes)):
         return stdout.strip()
     else:
         return stdout
+
+
+def Parallel(
+    cmds: str | Command | Iterable[str | Command],
+    argss: Iterable[Any] | None = None,
+    *,
+    jobs: int | None = None,
+    ordered: bool = True,
+    failfast: bool = False,
+    **kwargs: Any,
+) -> Iterator[CommitResult]:
+    """Executes many commands concurrently, similar to GNU parallel.
+
+    Either pass an iterable of commands
+        Parallel([git("fetch", r) for r in remotes])
+    or a command template and an iterable of argument tuples
+        Parallel("gzip", [("-k", f) for f in files])
+    A single str or Path in argss is treated as a one-argument tuple.
+
+    The commands are started immediately, at most `jobs` at a time.
+
+    Returns:
+      an iterator of CommitResults.
+
+    Keyword arguments:
+    * jobs: int=os.cpu_count()
+      Maximum number of commands running at the same time.
+    * ordered: bool=True
+      If true, results are yielded in input order. Otherwise they are yielded
+      as soon as they complete.
+    * failfast: bool=False
+      If true, commands not yet started are dropped once any command fails.
+      Commands already running are not interrupted.
+      Results of dropped commands are not yielded.
+    * for more check Run(). They apply to every command.
+    """
+    if argss is not None:
+        if not isinstance(cmds, (str, Command)):
+            raise TypeError(
+                f"Expected a single Command template with argss. Got {cmds}"
+            )
+        template = Command(cmds) if isinstance(cmds, str) else cmds
+        cmds = (template(*_as_argtuple(args)) for args in argss)
+    elif isinstance(cmds, (str, Command)):
+        cmds = [cmds]
+
+    # Imported here, it is one of the slowest modules to import
+    from concurrent.futures import ThreadPoolExecutor
+
+    pool = ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1)
+    futures: "list[Future[CommitResult]]" = []
+    failed = threading.Event()
+
+    def on_done(fut: "Future[CommitResult]") -> None:
+        if fut.cancelled():
+            return
+        if fut.exception() is not None or not fut.result():
+            failed.set()
+            for f in list(futures):
+                f.cancel()
+
+    try:
+        for cmd in cmds:
+            if failed.is_set():
+                break
+            # Threads do not inherit the context, e.g. the Deadline
+            fut = pool.submit(_run_in, contextvars.copy_context(), cmd, kwargs)
+            futures.append(fut)
+            if failfast:
+                fut.add_done_callback(on_done)
+    finally:
+        pool.shutdown(wait=False)
+    return _parallel_results(futures, ordered)
+
+
+def Xargs(
+    cmd: str | Command,
+    items: Iterable[str | Path],
+    *,
+    jobs: int = 1,
+    max_args: int | None = None,
+    max_chars: int | None = None,
+    **kwargs: Any,
+) -> CommitResult:
+    """Runs cmd with the items appended as arguments, packing as many items
+    into each invocation as the kernel allows, like xargs.
+
+    USAGE
+        Xargs(rm_("-f"), Path("build").rglob("*.o"))
+        Xargs(sed("-i", "s/foo/bar/"), files, jobs=4)
+
+    Nothing is run if there are no items, like `xargs -r`.
+
+    Returns:
+      the CommitResults of every invocation merged into one. Outputs are
+      concatenated in item order, retcode is the one of the first failing
+      invocation and stages lists the stages of every invocation.
+
+    Keyword arguments:
+    * jobs: int=1
+      Number of invocations running at the same time.
+    * max_args: int=None
+      Maximum number of items per invocation, like `xargs -n`.
+    * max_chars: int=None
+      Maximum size of the command line, like `xargs -s`. Never more than
+      what ARG_MAX leaves once the environment is accounted for.
+    * for more check Run(). They apply to every invocation, so o= and e=
+      files are refused as every invocation would truncate them. Use a=.
+    """
+    for name in ("o", "stdout", "e", "stderr"):
+        if isinstance(kwargs.get(name, None), (str, Path)):
+            raise ValueError(f"Xargs() cannot redirect {name}= to a file, use a=")
+    template = Command(cmd) if isinstance(cmd, str) else cmd
+    # The environment the invocations get, with env= or from the Session
+    env = contexts.in_session(template.update(**kwargs)).kwargs.get("env", None)
+    batches = _batches(template, items, max_args, max_chars, env or os.environ)
+    start = time.perf_counter()
+    if jobs > 1:
+        results = list(Parallel(template, batches, jobs=jobs, **kwargs))
+    else:
+        results = [Run(template, *batch, **kwargs) for batch in batches]
+    return _merged(results, time.perf_counter() - start)
+
+
+def _batches(
+    cmd: Command,
+    items: Iterable[str | Path],
+    max_args: int | None,
+    max_chars: int | None,
+    environ: Mapping[str, str],
+) -> Iterator[tuple[str, ...]]:
+    """Packs items into argument tuples that fit in ARG_MAX next to environ."""
+    # Each argument and environment variable costs its bytes, a NUL and a pointer
+    ptr = 8
+    env = sum(
+        len(os.fsencode(k)) + len(os.fsencode(v)) + 2 + ptr for k, v in environ.items()
+    )
+    fixed = sum(len(os.fsencode(arg)) + 1 + ptr for arg in cmd.args)
+    # Headroom for the auxiliary vector and the like, as in GNU xargs
+    budget = os.sysconf("SC_ARG_MAX") - env - 2048
+    if max_chars is not None:
+        budget = min(budget, max_chars)
+    batch: list[str] = []
+    size = fixed
+    for item in items:
+        arg = os.fspath(item)
+        cost = len(os.fsencode(arg)) + 1 + ptr
+        if batch and (size + cost > budget or len(batch) == max_args):
+            yield tuple(batch)
+            batch, size = [], fixed
+        batch.append(arg)
+        size += cost
+    if batch:
+        yield tuple(batch)
+
+
+def _merged(results: list[CommitResult], elapsed: float) -> CommitResult:
+    if not results:
+        return CommitResult(CommitResKind.SUCCESS, 0, elapsed=elapsed)
+    kinds = [res.kind for res in results]
+    for kind in (CommitResKind.CRITICAL, CommitResKind.TIMEOUT, CommitResKind.FAILED):
+        if kind in kinds:
+            break
+    else:
+        kind = CommitResKind.SUCCESS
+    failed = next((res for res in results if res.kind != CommitResKind.SUCCESS), None)
+    # str or bytes, depending on text=
+    empty: Any = results[0].stdout[:0]
+    return CommitResult(
+        kind,
+        0 if failed is None else failed.retcode,
+        stdout=empty.join(res.stdout for res in results),
+        stderr=empty.join(res.stderr for res in results),
+        elapsed=elapsed,
+        stages=[stage for res in results for stage in res.stages],
+    )
+
+
+def _run_in(
+    ctx: contextvars.Context, cmd: str | Command, kwargs: dict[str, Any]
+) -> CommitResult:
+    return ctx.run(Run, cmd, **kwargs)
+
+
+def _as_argtuple(args: Any) -> tuple[Any, ...]:
+    if isinstance(args, (str, Path)):
+        return (args,)
+    return tuple(args)
+
+
+def _parallel_results(
+    futures: "list[Future[CommitResult]]", ordered: bool
+) -> Iterator[CommitResult]:
+    from concurrent.futures import as_completed
+
+    if ordered:
+        for fut in futures:
+            if fut.cancelled():
+                break
+            yield fut.result()
+    else:
+        for fut in as_completed(futures):
+            if not fut.cancelled():
+                yield fut.result()
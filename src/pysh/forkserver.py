@@ -0,0 +1,234 @@
+"""A spawn backend that delegates spawning to a small helper process.
+
+Forking a parent that holds gigabytes of memory is slow, because the page
+tables are copied. The fork server is started while the parent is still
+small, so the cost of spawning no longer depends on the size of the parent.
+
+USAGE
+    # As early as possible, before the script grows
+    set_spawn_backend(ForkServerBackend())
+
+The parent sends argv, cwd, env and the descriptors for the redirections
+over a Unix socket (SCM_RIGHTS). The server spawns the process, reports its
+pid, and reports its exit code once it exits.
+"""
+import dataclasses
+import os
+import selectors
+import signal
+import socket
+import subprocess
+import sys
+import threading
+from pathlib import Path
+from typing import Any
+
+from .errors import PyShError
+from .spawn import ChildProcess, Process, Rusage
+
+MAX_MESSAGE = 1 << 20
+
+
+class ForkServerBackend:
+    """Spawns processes through a fork server.
+    The server is started right away and stops when close() is called or
+    when the parent exits."""
+
+    def __init__(self) -> None:
+        parent_sock, child_sock = socket.socketpair(
+            socket.AF_UNIX, socket.SOCK_SEQPACKET
+        )
+        root = str(Path(__file__).parent.parent)
+        code = (
+            f"import sys; sys.path.insert(0, {root!r}); "
+            f"import pysh.forkserver; pysh.forkserver.serve({child_sock.fileno()})"
+        )
+        with child_sock:
+            self._server = subprocess.Popen(
+                [sys.executable, "-c", code],
+                pass_fds=[child_sock.fileno()],
+                stdin=subprocess.DEVNULL,
+            )
+        self._sock = parent_sock
+        self._send_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._next_id = 0
+        self._replies: dict[int, dict[str, Any]] = {}
+        self._exits: dict[int, tuple[int, Rusage | None]] = {}
+        self._closed = False
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._reader.start()
+
+    def spawn(self, args: tuple[str, ...], **popen_kwargs: Any) -> "ForkServerProcess":
+        return ForkServerProcess(self, args, **popen_kwargs)
+
+    def close(self) -> None:
+        """Stops the server. Processes already spawned keep running."""
+        self._sock.shutdown(socket.SHUT_RDWR)
+        self._server.wait()
+        self._reader.join()
+        self._sock.close()
+
+    def _request(self, message: dict[str, Any], fds: list[int]) -> dict[str, Any]:
+        with self._cond:
+            if self._closed:
+                raise PyShError("The fork server is not running")
+            self._next_id += 1
+            message["id"] = req_id = self._next_id
+        import json
+
+        with self._send_lock:
+            socket.send_fds(self._sock, [json.dumps(message).encode()], fds)
+        with self._cond:
+            self._cond.wait_for(lambda: req_id in self._replies or self._closed)
+            if req_id not in self._replies:
+                raise PyShError("The fork server is not running")
+            return self._replies.pop(req_id)
+
+    def _exit(self, pid: int, block: bool) -> tuple[int, Rusage | None] | None:
+        """The exit code and resource usage of pid, if it exited."""
+        with self._cond:
+            if block:
+                self._cond.wait_for(lambda: pid in self._exits or self._closed)
+                if pid not in self._exits:
+                    raise PyShError(f"The fork server exited before process {pid}")
+            return self._exits.pop(pid, None)
+
+    def _read_loop(self) -> None:
+        import json
+
+        while data := self._sock.recv(MAX_MESSAGE):
+            message = json.loads(data)
+            with self._cond:
+                if "exit" in message:
+                    rusage = message["rusage"] and Rusage(**message["rusage"])
+                    self._exits[message["exit"]] = (message["retcode"], rusage)
+                else:
+                    self._replies[message["id"]] = message
+                self._cond.notify_all()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class ForkServerProcess(ChildProcess):
+    """A process spawned by the fork server."""
+
+    def __init__(
+        self,
+        server: ForkServerBackend,
+        args: tuple[str, ...],
+        stdin: Any = None,
+        stdout: Any = None,
+        stderr: Any = None,
+        cwd: Any = None,
+        env: Any = None,
+        process_group: int | None = None,
+    ) -> None:
+        super().__init__(args)
+        self._server = server
+        child_fds, to_close = self._child_stdio(stdin, stdout, stderr)
+        try:
+            reply = server._request(
+                {
+                    "args": [os.fsdecode(arg) for arg in args],
+                    # The server has its own cwd, e.g. unaffected by ChDir
+                    "cwd": os.fsdecode(os.path.abspath("." if cwd is None else cwd)),
+                    "env": dict(os.environ if env is None else env),
+                    "process_group": process_group,
+                },
+                child_fds,
+            )
+        except BaseException:
+            self._close_streams()
+            raise
+        finally:
+            for fd in to_close:
+                os.close(fd)
+        if "errno" in reply:
+            self._close_streams()
+            raise OSError(reply["errno"], reply["strerror"], reply["filename"])
+        self.pid = reply["pid"]
+        self.pgid = reply["pgid"]
+
+    def _try_wait(self, block: bool) -> int | None:
+        if (exited := self._server._exit(self.pid, block)) is None:
+            return None
+        retcode, self.rusage = exited
+        return retcode
+
+
+def serve(fd: int) -> None:
+    """The main loop of the fork server."""
+    import json
+
+    # Only the parent decides when the children die
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    sock = socket.socket(fileno=fd)
+    children: dict[int, Process] = {}
+    sel = selectors.DefaultSelector()
+    sel.register(sock, selectors.EVENT_READ)
+    while True:
+        timeout = None if hasattr(os, "pidfd_open") else 0.01
+        for key, _ in sel.select(timeout):
+            if key.fileobj is sock:
+                data, fds, _, _ = socket.recv_fds(sock, MAX_MESSAGE, 3)
+                if not data:
+                    return
+                reply = _spawn(json.loads(data), fds, children)
+                sock.send(json.dumps(reply).encode())
+                if hasattr(os, "pidfd_open") and "pid" in reply:
+                    pidfd = os.pidfd_open(reply["pid"])
+                    sel.register(pidfd, selectors.EVENT_READ, reply["pid"])
+            else:
+                sel.unregister(key.fd)
+                os.close(key.fd)
+        for pid, proc in list(children.items()):
+            if proc.poll() is not None:
+                del children[pid]
+                rusage = proc.rusage and dataclasses.asdict(proc.rusage)
+                message = {"exit": pid, "retcode": proc.returncode, "rusage": rusage}
+                sock.send(json.dumps(message).encode())
+
+
+def _spawn(
+    message: dict[str, Any], fds: list[int], children: dict[int, Process]
+) -> dict[str, Any]:
+    process_group = message["process_group"]
+    try:
+        try:
+            proc = _popen(message, fds, process_group)
+        except PermissionError:
+            if not process_group:
+                raise
+            # The group is gone if its processes exited and were reaped,
+            # which this server does right away. Start another one.
+            process_group = 0
+            proc = _popen(message, fds, process_group)
+    except OSError as e:
+        return {
+            "id": message["id"],
+            "errno": e.errno,
+            "strerror": e.strerror,
+            "filename": e.filename,
+        }
+    finally:
+        for fd in fds:
+            os.close(fd)
+    children[proc.pid] = proc
+    pgid = None if process_group is None else process_group or proc.pid
+    return {"id": message["id"], "pid": proc.pid, "pgid": pgid}
+
+
+def _popen(
+    message: dict[str, Any], fds: list[int], process_group: int | None
+) -> Process:
+    return Process(
+        message["args"],
+        stdin=fds[0],
+        stdout=fds[1],
+        stderr=fds[2],
+        cwd=message["cwd"],
+        env=message["env"],
+        process_group=process_group,
+    )
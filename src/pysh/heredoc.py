@@ -0,0 +1,106 @@
+"""In-memory data given to commands as a seekable stdin file.
+
+USAGE
+    # Like bash `wc -l <<< "$text"`, without the newline bash appends
+    Run(Command("wc", "-l"), ii=text)
+    # Copied once, then read by every command without copying it again
+    with HereDoc(payload) as doc:
+        Run(Command("sha256sum"), ii=doc)
+        Run(Command("xz", "-T0"), ii=doc, o="payload.xz")
+
+With ii= the data is written to a memfd, a file that only lives in memory,
+sealed so that nobody can modify it, and the command gets it as stdin. The
+command reads it at its own pace and may seek in it, instead of Python
+pumping it through a pipe as with input=. Where memfds are not available,
+an unlinked temporary file is used instead.
+
+For data that already is in a file, i=path does the same without copying.
+"""
+import fcntl
+import os
+from typing import IO, Any, Self
+
+
+class HereDoc:
+    """data, str or bytes-like, kept for the stdin of commands, see the
+    module documentation. str is encoded with encoding.
+    The memory is released by close(), on leaving a with block or when the
+    object is garbage collected."""
+
+    def __init__(self, data: Any, encoding: str = "utf-8") -> None:
+        self._file = _sealed(data, encoding)
+        self.size = os.fstat(self._file.fileno()).st_size
+        self._digest: str | None = None
+
+    def open(self) -> IO[bytes]:
+        """A new read-only file of the data, at offset 0."""
+        fd = self._file.fileno()
+        try:
+            # Its own offset, so that commands reading at once do not interfere
+            return open(f"/proc/self/fd/{fd}", "rb", buffering=0)
+        except OSError:
+            fd = os.dup(fd)
+            os.lseek(fd, 0, os.SEEK_SET)
+            return open(fd, "rb", buffering=0)
+
+    def digest(self) -> str:
+        """SHA-256 of the data, computed on first use."""
+        if self._digest is None:
+            import hashlib
+
+            digest = hashlib.sha256()
+            with self.open() as file:
+                while chunk := file.read(1 << 20):
+                    digest.update(chunk)
+            self._digest = digest.hexdigest()
+        return self._digest
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+    def __repr__(self) -> str:
+        return f"<HereDoc {self.size} bytes>"
+
+
+def open_input(data: Any) -> IO[bytes]:
+    """The stdin file for an ii= kwarg, a HereDoc or the data itself."""
+    if isinstance(data, HereDoc):
+        return data.open()
+    file = _sealed(data, "utf-8")
+    file.seek(0)
+    return file
+
+
+def _sealed(data: Any, encoding: str) -> IO[bytes]:
+    """A memfd holding data, sealed against modifications."""
+    if isinstance(data, str):
+        data = data.encode(encoding)
+    file: IO[bytes]
+    if hasattr(os, "memfd_create"):
+        flags = os.MFD_CLOEXEC | os.MFD_ALLOW_SEALING
+        file = open(os.memfd_create("pysh-heredoc", flags), "r+b", buffering=0)
+    else:
+        import tempfile
+
+        file = tempfile.TemporaryFile(buffering=0)
+    try:
+        with memoryview(data) as view, view.cast("B") as view:
+            while view:
+                view = view[file.write(view) :]
+        if hasattr(fcntl, "F_ADD_SEALS"):
+            seals = fcntl.F_SEAL_SEAL | fcntl.F_SEAL_SHRINK | fcntl.F_SEAL_GROW
+            try:
+                fcntl.fcntl(file, fcntl.F_ADD_SEALS, seals | fcntl.F_SEAL_WRITE)
+            except OSError:
+                # A temporary file cannot be sealed
+                pass
+    except BaseException:
+        file.close()
+        raise
+    return file
@@ -0,0 +1,404 @@
+import os
+import selectors
+import signal
+import subprocess
+import time
+from dataclasses import dataclass
+from typing import Any, Iterator, Self
+
+from . import capture, command, spawn, trace
+from .errors import *
+from .utils import input_chunks, timeout_to_seconds
+
+
+@dataclass
+class StageResult:
+    """Outcome of one process of a pipeline."""
+
+    args: tuple[str, ...]
+    pid: int
+    retcode: int | None
+    elapsed: float | None
+    # Where the backend can tell, see spawn.Rusage
+    rusage: "spawn.Rusage | None" = None
+
+
+class Pipeline:
+    """All processes of `cmd1 | cmd2 | ...`, spawned in one flat pass.
+
+    USAGE
+        with Pipeline(find(".") | sort | head("-n1")) as p:
+            p.spawn()
+            res = p.communicate(timeout=10)
+        res.stages  # retcode, pid, elapsed time and rusage of every stage
+
+    The command kwargs of the last stage configure the whole pipeline:
+    * pipefail: bool=False
+      Like `set -o pipefail`. The pipeline fails if any stage fails, and its
+      retcode is the one of the last failing stage. As soon as a stage fails,
+      the remaining stages are killed, and they do not count as failing.
+    * pgroup: bool=False
+      Spawn the stages in a new process group, so that killing the pipeline
+      also kills whatever the stages forked. Run() enables it when a timeout
+      applies. The stages cannot read from the terminal then.
+    * kill_after: int|str=1
+      On timeout stages get SIGTERM, and SIGKILL if still running after
+      this duration.
+    * keep: policy=None
+      How much of the captured output is kept, see capture.py.
+
+    Redirection files and inter-stage pipes are closed in the parent right
+    after the stages are spawned.
+    """
+
+    READ_SIZE = 65536
+
+    def __init__(self, cmd: "command.Command") -> None:
+        self.cmd = cmd
+        self.commands = Pipeline.unfold(cmd)
+        self.pipefail = bool(cmd.kwargs.get("pipefail", False))
+        self.pgroup = bool(cmd.kwargs.get("pgroup", False))
+        self.kill_after = timeout_to_seconds(cmd.kwargs.get("kill_after", 1))
+        # subprocess.Popen or a compatible object, see spawn.py
+        self.procs: list[Any] = []
+        self._time_start: list[float] = []
+        self._time_end: list[float | None] = []
+        self._failed = False
+        # Stages killed by us rather than failing on their own
+        self._killed: set[int] = set()
+        # Process groups of the stages, normally the one of the first stage
+        self._pgids: list[int] = []
+
+    @staticmethod
+    def unfold(cmd: "command.Command") -> list["command.Command"]:
+        """Unfolds cmd1 | cmd2 | ... into [cmd1, cmd2, ...]."""
+        stages = [cmd]
+        while (pipefrom := stages[-1].kwargs.get("pipefrom", None)) is not None:
+            stages.append(pipefrom)
+        return stages[::-1]
+
+    @property
+    def stdin(self) -> Any:
+        """Writable stdin of the first stage, if spawned with stdin=True."""
+        return self.procs[0].stdin if self.procs else None
+
+    @property
+    def stdout(self) -> Any:
+        """Readable stdout of the last stage, if redirected to a pipe."""
+        return self.procs[-1].stdout if self.procs else None
+
+    @property
+    def stderr(self) -> Any:
+        """Readable stderr of the last stage, if redirected to a pipe."""
+        return self.procs[-1].stderr if self.procs else None
+
+    def spawn(
+        self, stdin: bool = False, stdio: tuple[int, int, int] | None = None
+    ) -> Self:
+        """IMMEDIATELY spawns every stage.
+        If stdin is true, the first stage reads from a pipe available as
+        self.stdin, unless its input is already redirected with i=.
+        stdio are the descriptors the stages get instead of the stdin,
+        stdout and stderr of this process where not redirected.
+        """
+        prev_read: int | None = None
+        try:
+            for idx, cmd in enumerate(self.commands):
+                popen_kwargs = cmd._popen_kwargs()
+                opened = [f for f in popen_kwargs.values() if hasattr(f, "close")]
+                if prev_read is not None:
+                    popen_kwargs["stdin"] = prev_read
+                    opened.append(prev_read)
+                elif stdin and "stdin" not in popen_kwargs:
+                    popen_kwargs["stdin"] = subprocess.PIPE
+                if idx != len(self.commands) - 1:
+                    prev_read, popen_kwargs["stdout"] = os.pipe()
+                    opened.append(popen_kwargs["stdout"])
+                else:
+                    prev_read = None
+                if stdio is not None:
+                    for name, fd in zip(("stdin", "stdout", "stderr"), stdio):
+                        popen_kwargs.setdefault(name, fd)
+                if self.pgroup:
+                    popen_kwargs["process_group"] = next(iter(self._pgids), 0)
+                try:
+                    self._time_start.append(time.perf_counter())
+                    if (pystage := cmd.kwargs.get("pystage", None)) is not None:
+                        # A Python function, see pyfilter.py
+                        from .builtin import BuiltinProcess
+
+                        proc = BuiltinProcess(cmd.args, pystage, [], **popen_kwargs)
+                    else:
+                        backend = spawn.get_spawn_backend()
+                        proc = backend.spawn(cmd.args, **popen_kwargs)
+                    self.procs.append(proc)
+                    self._time_end.append(None)
+                    if self.pgroup and not getattr(proc, "in_process", False):
+                        # The fork server may have had to start another group
+                        pgid = getattr(proc, "pgid", None) or (
+                            popen_kwargs["process_group"] or proc.pid
+                        )
+                        if pgid not in self._pgids:
+                            self._pgids.append(pgid)
+                finally:
+                    # The child owns its copies of the descriptors now
+                    for f in opened:
+                        if isinstance(f, int):
+                            os.close(f)
+                        else:
+                            f.close()
+        except BaseException:
+            if prev_read is not None:
+                os.close(prev_read)
+            self.kill()
+            self._reap()
+            raise
+        return self
+
+    def running(self) -> bool:
+        """Whether any stage is still running."""
+        return any(proc.poll() is None for proc in self.procs)
+
+    def kill(self) -> None:
+        """Kills every stage that is still running. With pgroup, if any stage
+        was running, also every other process left in their process group."""
+        self._signal(signal.SIGKILL, groups=self.running())
+
+    def terminate(self, grace: float | None = None) -> None:
+        """Sends SIGTERM to every stage, then kills the pipeline once every
+        stage exited or after grace seconds, kill_after by default."""
+        self._signal(signal.SIGTERM, groups=True)
+        deadline = time.perf_counter() + (self.kill_after if grace is None else grace)
+        while self.running() and time.perf_counter() < deadline:
+            time.sleep(0.005)
+        self._signal(signal.SIGKILL, groups=True)
+
+    def _signal(self, sig: int, groups: bool) -> None:
+        running = [idx for idx, proc in enumerate(self.procs) if proc.poll() is None]
+        self._killed.update(running)
+        for pgid in self._pgids if groups else []:
+            try:
+                os.killpg(pgid, sig)
+            except (ProcessLookupError, PermissionError):
+                # Everyone in the group exited
+                pass
+        for proc in self.procs:
+            if proc.poll() is None:
+                try:
+                    proc.send_signal(sig)
+                except ProcessLookupError:
+                    pass
+
+    def communicate(
+        self, input: Any = None, timeout: float | None = None
+    ) -> "command.CommitResult":
+        """Feeds input, collects the captured output and waits for every stage.
+        On timeout every stage is killed.
+
+        input may also be a file object, an iterable of str or bytes or a
+        function returning one, see utils.input_chunks(). It is consumed one
+        chunk at a time, as the first stage reads it, so that a slow stage
+        holds back the producer instead of letting memory grow.
+
+        Returns:
+          a CommitResult with the captured output of the last stage and the
+          StageResults of every stage.
+        """
+        chunks = input_chunks(input, self.READ_SIZE)
+        first, last = self.procs[0], self.procs[-1]
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        outputs = capture.sinks(self.cmd)
+        retcode_at_timeout: int | None = None
+        timed_out = False
+
+        with selectors.DefaultSelector() as sel:
+            input_view = memoryview(b"")
+            if first.stdin is not None and not first.stdin.closed:
+                if input_view := self._next_chunk(chunks):
+                    os.set_blocking(first.stdin.fileno(), False)
+                    sel.register(first.stdin, selectors.EVENT_WRITE, "stdin")
+                else:
+                    first.stdin.close()
+            if last.stdout is not None and not last.stdout.closed:
+                sel.register(last.stdout, selectors.EVENT_READ, "stdout")
+            if last.stderr is not None and not last.stderr.closed:
+                sel.register(last.stderr, selectors.EVENT_READ, "stderr")
+            pidfds = self._register_exits(sel)
+            self._check_exits()
+            try:
+                while sel.get_map() or self._running():
+                    wait = None
+                    if deadline is not None:
+                        wait = deadline - time.perf_counter()
+                        if wait <= 0:
+                            timed_out = True
+                            retcode_at_timeout = last.poll()
+                            break
+                    if not pidfds:
+                        wait = 0.01 if wait is None else min(wait, 0.01)
+                    for key, _ in sel.select(wait):
+                        if key.data == "stdin":
+                            input_view = self._feed(sel, key, input_view, chunks)
+                        elif isinstance(key.data, str):
+                            if data := os.read(key.fd, self.READ_SIZE):
+                                outputs[key.data].write(data)
+                            else:
+                                sel.unregister(key.fileobj)
+                        else:
+                            sel.unregister(key.fileobj)
+                            os.close(key.fd)
+                            # Exited, so this returns promptly
+                            self.procs[key.data].wait()
+                    self._check_exits()
+            except BaseException:
+                self.kill()
+                raise
+            finally:
+                for key in list(sel.get_map().values()):
+                    if isinstance(key.data, int):
+                        os.close(key.fd)
+                if timed_out:
+                    self.terminate()
+                self._reap()
+
+        elapsed = time.perf_counter() - self._time_start[0]
+        for stream in (first.stdin, last.stdout, last.stderr):
+            if stream is not None:
+                stream.close()
+        if timed_out:
+            kind = command.CommitResKind.TIMEOUT
+            retcode = retcode_at_timeout
+        else:
+            retcode = self._retcode()
+            if retcode == 0:
+                kind = command.CommitResKind.SUCCESS
+            else:
+                kind = command.CommitResKind.FAILED
+        stages = self.stage_results()
+        for cmd, proc, start, end in zip(
+            self.commands, self.procs, self._time_start, self._time_end
+        ):
+            trace.record(
+                cmd,
+                proc.pid,
+                start,
+                end,
+                proc.returncode,
+                getattr(proc, "rusage", None),
+            )
+        return command.CommitResult(
+            kind,
+            retcode,
+            stdout=outputs["stdout"].value(),
+            stderr=outputs["stderr"].value(),
+            elapsed=elapsed,
+            stages=stages,
+        )
+
+    def stage_results(self) -> list[StageResult]:
+        return [
+            StageResult(
+                cmd.args,
+                proc.pid,
+                proc.returncode,
+                None if end is None else end - start,
+                getattr(proc, "rusage", None),
+            )
+            for cmd, proc, start, end in zip(
+                self.commands, self.procs, self._time_start, self._time_end
+            )
+        ]
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.kill()
+        self._reap()
+        for proc in self.procs:
+            for stream in (proc.stdin, proc.stdout, proc.stderr):
+                if stream is not None:
+                    stream.close()
+
+    def _register_exits(self, sel: selectors.BaseSelector) -> bool:
+        """Get notified of stage exits through pidfds, where supported.
+        Stages that are not processes provide their own open_exit_fd()."""
+        registered = True
+        for idx, proc in enumerate(self.procs):
+            try:
+                if hasattr(proc, "open_exit_fd"):
+                    exit_fd = proc.open_exit_fd()
+                elif hasattr(os, "pidfd_open"):
+                    exit_fd = os.pidfd_open(proc.pid)
+                else:
+                    registered = False
+                    continue
+                sel.register(exit_fd, selectors.EVENT_READ, idx)
+            except ProcessLookupError:
+                # Already exited and reaped, e.g. by the fork server
+                proc.wait()
+            except OSError:
+                registered = False
+        return registered
+
+    def _feed(
+        self,
+        sel: selectors.BaseSelector,
+        key: selectors.SelectorKey,
+        data: memoryview,
+        chunks: Iterator[bytes],
+    ) -> memoryview:
+        """Writes what the pipe takes, then moves on to the next chunk.
+        Only one chunk is held at a time."""
+        try:
+            data = data[os.write(key.fd, data[: self.READ_SIZE]) :]
+        except BlockingIOError:
+            return data
+        except BrokenPipeError:
+            # The stage stopped reading, like `head`. Do not produce the rest.
+            data, chunks = data[:0], iter(())
+        if not data:
+            data = self._next_chunk(chunks)
+        if not data:
+            sel.unregister(key.fileobj)
+            key.fileobj.close()  # type: ignore[union-attr]
+        return data
+
+    @staticmethod
+    def _next_chunk(chunks: Iterator[bytes]) -> memoryview:
+        """The next non-empty chunk, empty once chunks is exhausted."""
+        for chunk in chunks:
+            if chunk:
+                return memoryview(chunk)
+        return memoryview(b"")
+
+    def _running(self) -> bool:
+        return any(end is None for end in self._time_end)
+
+    def _check_exits(self) -> None:
+        """Records the end time of exited stages and enforces pipefail."""
+        for idx, proc in enumerate(self.procs):
+            if self._time_end[idx] is None and proc.poll() is not None:
+                self._time_end[idx] = time.perf_counter()
+                failed = proc.returncode != 0 and idx not in self._killed
+                if failed and self.pipefail and not self._failed:
+                    self._failed = True
+                    self.kill()
+
+    def _reap(self) -> None:
+        for proc in self.procs:
+            proc.wait()
+        self._check_exits()
+
+    def _retcode(self) -> int | None:
+        if self.pipefail:
+            # The last failing stage, as in bash
+            return next(
+                (
+                    proc.returncode
+                    for idx, proc in reversed(list(enumerate(self.procs)))
+                    if proc.returncode and idx not in self._killed
+                ),
+                0,
+            )
+        return self.procs[-1].returncode
@@ -0,0 +1,310 @@
+"""Runs commands that depend on each other, like make.
+
+USAGE
+    plan = Plan(jobs=4, state=".pysh-plan")
+    gen = plan.add(sed("s/@VERSION@/1.2/", "config.in"), o="config.h",
+                   inputs=["config.in"])
+    plan.add(make, "all", inputs=["config.h"], outputs=["app"])
+    plan.add(git, "fetch")            # independent, runs meanwhile
+    if not plan.run():
+        print([node.name for node in plan.failed()])
+
+A node runs once every node it depends on succeeded or was skipped. It
+depends on the nodes listed in after= and on the nodes producing its
+inputs. Files redirected with i= are inputs, with o= and a= outputs.
+Independent nodes run in parallel, at most `jobs` at a time.
+
+A node is skipped if it has outputs, they all exist, and either
+* every output is newer than every input, like make, or
+* with state=, its argv, kwargs and the contents of its inputs hash to the
+  same value as when it last succeeded.
+
+In shell terms, `a && b` is add(b, after=[a]). Nodes of a failed node
+do not run.
+"""
+import contextvars
+import os
+from dataclasses import dataclass
+from enum import Enum, auto
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Iterable
+
+from .command import Command, CommitResult
+from .contexts import session_path
+from .errors import PyShError
+from .pipeline import Pipeline
+
+if TYPE_CHECKING:
+    from concurrent.futures import Future
+
+
+class NodeStatus(Enum):
+    """
+    Value           Definition
+    ================================
+    PENDING         Not run yet.
+    SKIPPED         Its outputs were up to date.
+    SUCCESS         It ran and succeeded.
+    FAILED          It ran and failed, or raised an exception.
+    NOT_RUN         A node it depends on failed or was not run.
+    """
+
+    PENDING = auto()
+    SKIPPED = auto()
+    SUCCESS = auto()
+    FAILED = auto()
+    NOT_RUN = auto()
+
+
+@dataclass(eq=False)
+class Node:
+    cmd: Command
+    kwargs: dict[str, Any]
+    inputs: list[Path]
+    outputs: list[Path]
+    after: list["Node"]
+    name: str
+    status: NodeStatus = NodeStatus.PENDING
+    result: CommitResult | None = None
+
+    def deps(self, producers: dict[Path, "Node"]) -> set["Node"]:
+        """The nodes this node waits for."""
+        deps = set(self.after)
+        deps.update(producers[p] for p in self.inputs if p in producers)
+        deps.discard(self)
+        return deps
+
+
+class Plan:
+    """A graph of commands, see the module documentation.
+
+    Keyword arguments:
+    * jobs: int=os.cpu_count()
+      Maximum number of nodes running at the same time.
+    * state: str|Path=None
+      A JSON file remembering the hash of every node that succeeded, so
+      that nodes whose inputs did not change are skipped.
+    * keep_going: bool=False
+      If true, nodes that do not depend on a failed node still run, like
+      `make -k`. Otherwise no node starts after a failure.
+    """
+
+    def __init__(
+        self,
+        jobs: int | None = None,
+        state: str | Path | None = None,
+        keep_going: bool = False,
+    ) -> None:
+        self.jobs = jobs or os.cpu_count() or 1
+        self.state = None if state is None else Path(state)
+        self.keep_going = keep_going
+        self.nodes: list[Node] = []
+
+    def add(
+        self,
+        cmd: str | Command,
+        *args: str,
+        inputs: Iterable[str | Path] = (),
+        outputs: Iterable[str | Path] = (),
+        after: Iterable[Node] = (),
+        name: str | None = None,
+        **kwargs: Any,
+    ) -> Node:
+        """Adds a node running Run(cmd, *args, **kwargs).
+        name identifies the node in the state file, str(cmd) by default.
+        Relative paths are relative to the cwd of the current Session."""
+        cmd = Command(cmd) if isinstance(cmd, str) else cmd
+        after = list(after)
+        if not all(any(dep is node for node in self.nodes) for dep in after):
+            raise ValueError("Nodes in after= must be added to the plan first")
+        stages = Pipeline.unfold(cmd.update(*args, **kwargs))
+        ins, outs = list(inputs), list(outputs)
+        for stage in stages:
+            ins += [stage.kwargs["i"]] if _is_file(stage.kwargs.get("i", None)) else []
+            outs += [
+                stage.kwargs[kw] for kw in ("o", "a") if _is_file(stage.kwargs.get(kw))
+            ]
+        node = Node(
+            cmd.update(*args),
+            kwargs,
+            [Path(session_path(p)).absolute() for p in ins],
+            [Path(session_path(p)).absolute() for p in outs],
+            after,
+            name if name is not None else str(cmd.update(*args, **kwargs)),
+        )
+        self.nodes.append(node)
+        return node
+
+    def failed(self) -> list[Node]:
+        return [node for node in self.nodes if node.status == NodeStatus.FAILED]
+
+    def run(self) -> bool:
+        """Runs the nodes that are not up to date, in dependency order.
+        Returns whether every node succeeded or was skipped. Exceptions
+        raised by a node are raised again once the running nodes are done.
+        """
+        from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+        producers = {p: node for node in self.nodes for p in node.outputs}
+        waiting = {node: node.deps(producers) for node in self.nodes}
+        _check_acyclic(waiting)
+        hashes = self._load_state()
+        for node in self.nodes:
+            node.status, node.result = NodeStatus.PENDING, None
+        running: "dict[Future[tuple[CommitResult | None, str | None]], Node]" = {}
+        error: Exception | None = None
+        digest: str | None
+        pool = ThreadPoolExecutor(max_workers=self.jobs)
+        try:
+            while waiting or running:
+                stop = error is not None or (
+                    bool(self.failed()) and not self.keep_going
+                )
+                for node in self._ready(waiting):
+                    if stop or any(dep.status not in _OK for dep in waiting[node]):
+                        node.status = NodeStatus.NOT_RUN
+                    elif len(running) < self.jobs:
+                        # Threads do not inherit the context, e.g. the Deadline.
+                        # Never queued in the pool, so a failure stops the rest.
+                        ctx = contextvars.copy_context()
+                        running[pool.submit(self._run, ctx, node, hashes)] = node
+                    else:
+                        continue
+                    del waiting[node]
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    node = running.pop(fut)
+                    try:
+                        node.result, digest = fut.result()
+                    except Exception as e:
+                        error = error or e
+                        node.status = NodeStatus.FAILED
+                    else:
+                        if node.result is None:
+                            node.status = NodeStatus.SKIPPED
+                        elif node.result:
+                            node.status = NodeStatus.SUCCESS
+                        else:
+                            node.status = NodeStatus.FAILED
+                    if node.status in _OK and digest is not None:
+                        hashes[node.name] = digest
+                    elif node.status == NodeStatus.FAILED:
+                        # Its outputs might be stale, whatever its inputs
+                        hashes.pop(node.name, None)
+        finally:
+            pool.shutdown(wait=True)
+            for node in self.nodes:
+                if node.status == NodeStatus.PENDING:
+                    node.status = NodeStatus.NOT_RUN
+            if self.state is not None:
+                self._save_state(hashes)
+        if error is not None:
+            raise error
+        return all(node.status in _OK for node in self.nodes)
+
+    @staticmethod
+    def _ready(waiting: dict[Node, set[Node]]) -> list[Node]:
+        """The waiting nodes whose dependencies are all done."""
+        return [
+            node
+            for node, deps in waiting.items()
+            if all(dep.status != NodeStatus.PENDING for dep in deps)
+        ]
+
+    def _run(
+        self, ctx: contextvars.Context, node: Node, hashes: dict[str, str]
+    ) -> tuple[CommitResult | None, str | None]:
+        """Runs node unless it is up to date. Returns its result, None if
+        skipped, and the hash of the node as it was before running."""
+        # Imported here, exec imports this module through __init__
+        from .exec import Run
+
+        # Before running, so that inputs modified meanwhile are seen next time
+        digest = None if self.state is None else _hash(node)
+        if self._up_to_date(node, hashes.get(node.name, None), digest):
+            return None, digest
+        return ctx.run(Run, node.cmd, **node.kwargs), digest
+
+    @staticmethod
+    def _up_to_date(node: Node, prev: str | None, digest: str | None) -> bool:
+        if not node.outputs:
+            return False
+        try:
+            oldest = min(p.stat().st_mtime_ns for p in node.outputs)
+        except FileNotFoundError:
+            return False
+        if digest is not None and digest == prev:
+            return True
+        try:
+            return all(p.stat().st_mtime_ns <= oldest for p in node.inputs)
+        except FileNotFoundError:
+            # Let the command report the missing input
+            return False
+
+    def _load_state(self) -> dict[str, str]:
+        if self.state is None:
+            return {}
+        import json
+
+        try:
+            return json.loads(self.state.read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def _save_state(self, hashes: dict[str, str]) -> None:
+        import json
+
+        assert self.state is not None
+        # Written then renamed, so that an interrupted run keeps the old state
+        tmp = self.state.with_name(self.state.name + ".tmp")
+        tmp.write_text(json.dumps(hashes, indent=1, sort_keys=True))
+        os.replace(tmp, self.state)
+
+
+_OK = (NodeStatus.SUCCESS, NodeStatus.SKIPPED)
+
+
+def _is_file(redir: Any) -> bool:
+    return isinstance(redir, (str, Path))
+
+
+def _hash(node: Node) -> str:
+    """Hash of the argv and kwargs of every stage and of the input contents."""
+    import hashlib
+
+    digest = hashlib.sha256()
+    for stage in Pipeline.unfold(node.cmd):
+        kwargs = sorted(
+            (k, repr(v)) for k, v in stage.kwargs.items() if k != "pipefrom"
+        )
+        digest.update(repr((stage.args, kwargs)).encode("utf-8", "surrogateescape"))
+    digest.update(repr(sorted((k, repr(v)) for k, v in node.kwargs.items())).encode())
+    for path in node.inputs:
+        digest.update(os.fsencode(path) + b"\0")
+        try:
+            with open(path, "rb") as f:
+                digest.update(hashlib.file_digest(f, "sha256").digest())
+        except OSError:
+            digest.update(b"missing")
+    return digest.hexdigest()
+
+
+def _check_acyclic(deps: dict[Node, set[Node]]) -> None:
+    done: set[Node] = set()
+    visiting: set[Node] = set()
+
+    def visit(node: Node) -> None:
+        if node in done:
+            return
+        if node in visiting:
+            raise PyShError(f"Dependency cycle through {node.name}")
+        visiting.add(node)
+        for dep in deps.get(node, ()):
+            visit(dep)
+        visiting.discard(node)
+        done.add(node)
+
+    for node in deps:
+        visit(node)
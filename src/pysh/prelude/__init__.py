@@ -1,28 +1,75 @@
 """The list of predefined commands is flexible. You can see your most frequently used commands with
-$ history | awk '{print $2}' | sort | uniq -c | sort -hr | head -n 50"""
-from ..command import Command
-
-chmod = Command("chmod")
-fd = Command("fd")
-tr = Command("tr")
-find = Command("find")
-git = Command("git")
-git = Command("git")
-grep = Command("grep")
-head = Command("head")
-make = Command("make")
-rg = Command("rg")
-sed = Command("sed")
-sort = Command("sort")
-tail = Command("tail")
-vim = Command("vim")
-touch = Command("touch")
-
-ls_ = Command("ls")
-echo_ = Command("echo")
-cat_ = Command("cat")
-cp_ = Command("cp")
-mkdir_ = Command("mkdir")
-rm_ = Command("rm")
-mv_ = Command("mv")
-tee_ = Command("tee")
+$ history | awk '{print $2}' | sort | uniq -c | sort -hr | head -n 50
+
+Commands are created on first access from the PRELUDE table."""
+from types import MappingProxyType
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from ..command import Command
+
+    chmod: Command
+    fd: Command
+    tr: Command
+    find: Command
+    git: Command
+    grep: Command
+    head: Command
+    make: Command
+    rg: Command
+    sed: Command
+    sort: Command
+    tail: Command
+    vim: Command
+    touch: Command
+    ls_: Command
+    echo_: Command
+    cat_: Command
+    cp_: Command
+    mkdir_: Command
+    rm_: Command
+    mv_: Command
+    tee_: Command
+
+# name -> program. A trailing _ avoids shadowing Python builtins and modules.
+PRELUDE = MappingProxyType(
+    {
+        "chmod": "chmod",
+        "fd": "fd",
+        "tr": "tr",
+        "find": "find",
+        "git": "git",
+        "grep": "grep",
+        "head": "head",
+        "make": "make",
+        "rg": "rg",
+        "sed": "sed",
+        "sort": "sort",
+        "tail": "tail",
+        "vim": "vim",
+        "touch": "touch",
+        "ls_": "ls",
+        "echo_": "echo",
+        "cat_": "cat",
+        "cp_": "cp",
+        "mkdir_": "mkdir",
+        "rm_": "rm",
+        "mv_": "mv",
+        "tee_": "tee",
+    }
+)
+
+__all__ = list(PRELUDE)
+
+
+def __getattr__(name: str) -> Any:
+    if (program := PRELUDE.get(name, None)) is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    from ..command import Command
+
+    cmd = globals()[name] = Command(program)
+    return cmd
+
+
+def __dir__() -> list[str]:
+    return sorted(set(globals()) | set(PRELUDE))
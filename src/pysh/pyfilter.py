@@ -0,0 +1,123 @@
+"""Python functions as pipeline stages.
+
+USAGE
+    # Keep the lines for which the function is true
+    Run(find(".") | PyFilter(lambda line: not line.endswith(".pyc")) | sort)
+    Run(cat_("log") | PyFilter(re.compile("ERROR|WARN").search))
+    # Replace each line with the returned one, drop it on None
+    Run(cat_("log") | PyFilter(lambda line: line.split()[0]) | sort("-u"))
+    # A generator function gets an iterator of every line
+    def numbered(lines):
+        for n, line in enumerate(lines, 1):
+            yield f"{n}: {line}"
+    Run(git("log", "--oneline") | PyFilter(numbered) | head)
+
+The function runs in a thread connected to the neighbouring stages by OS
+pipes, like the commands of the builtin backend. Lines are given without
+their newline, and one is added to every output line. Output is written
+whenever the function asks for more input, so lines flow as they come.
+
+An exception in the function ends the stage with retcode 1 and the error
+printed to its stderr. Only Run(), Cap(), Stream() and Pipeline support
+Python stages, ARun() does not.
+"""
+import inspect
+from typing import Any, Callable, Iterable, Iterator
+
+from .builtin import Builtin, BuiltinIO
+from .command import Command
+from .utils import split_lines
+
+
+def PyFilter(
+    fn: Callable[..., Any],
+    *,
+    text: bool = True,
+    encoding: str = "utf-8",
+    errors: str = "strict",
+) -> Command:
+    """A pipeline stage running fn on every line of its input.
+
+    fn returns a new line, str or bytes, to replace the line, or None to drop
+    it. Any other result keeps the line if true, e.g. an re.Match, and drops
+    it if false. A generator function instead gets an iterator of all the
+    lines and yields the output lines.
+
+    Keyword arguments:
+    * text: bool=True
+      If false, lines are bytes instead of str.
+    * encoding: str="utf-8", errors: str="strict"
+      How lines are decoded and encoded when text=True.
+    """
+    name = getattr(fn, "__name__", type(fn).__name__)
+    stream = inspect.isgeneratorfunction(fn)
+    codec = (encoding, errors) if text else None
+    return Command("PyFilter", name, pystage=_filter(fn, stream, codec))
+
+
+def _filter(
+    fn: Callable[..., Any], stream: bool, codec: tuple[str, str] | None
+) -> Builtin:
+    def run(io: BuiltinIO) -> int:
+        out = _Output(io, codec)
+        lines: Iterator[Any] = _lines(io, out)
+        if codec is not None:
+            lines = (line.decode(*codec) for line in lines)
+        results: Iterable[Any] = fn(lines) if stream else _each(fn, lines)
+        for line in results:
+            out.add(line)
+        out.flush()
+        return 0
+
+    return run
+
+
+def _each(fn: Callable[[Any], Any], lines: Iterator[Any]) -> Iterator[Any]:
+    for line in lines:
+        match fn(line):
+            case str() | bytes() as result:
+                yield result
+            case None:
+                pass
+            case result if result:
+                yield line
+
+
+def _lines(io: BuiltinIO, out: "_Output") -> Iterator[bytes]:
+    """The lines of stdin without their newline.
+    Pending output is flushed before waiting for input."""
+
+    def chunks() -> Iterator[bytes]:
+        reads = io.chunks()
+        while True:
+            out.flush()
+            if not (data := next(reads, b"")):
+                return
+            yield data
+
+    return split_lines(chunks(), b"\n")
+
+
+class _Output:
+    """Buffers output lines and writes them in batches."""
+
+    def __init__(self, io: BuiltinIO, codec: tuple[str, str] | None) -> None:
+        self.io = io
+        self.codec = codec
+        self.buffer: list[bytes] = []
+        self.size = 0
+
+    def add(self, line: str | bytes) -> None:
+        if isinstance(line, str):
+            if self.codec is None:
+                raise TypeError(f"Expected bytes with text=False. Got {line!r}")
+            line = line.encode(*self.codec)
+        self.buffer += [line, b"\n"]
+        self.size += len(line) + 1
+        if self.size >= BuiltinIO.READ_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.buffer:
+            self.io.write(b"".join(self.buffer))
+            self.buffer, self.size = [], 0
@@ -0,0 +1,358 @@
+"""How the processes of a command are spawned.
+
+Two backends are available:
+* PopenBackend       subprocess.Popen. The default.
+* PosixSpawnBackend  os.posix_spawn with executables resolved once through
+                     a cache. Avoids the fork/exec and close_fds overhead of
+                     Popen, which dominates when running many short commands.
+
+USAGE
+    set_spawn_backend(PosixSpawnBackend())
+"""
+import errno
+import io
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Self
+
+
+class ExecutableCache:
+    """Caches the resolution of command names through PATH.
+    Entries are keyed by the value of PATH, so modifying PATH never returns
+    stale entries. Call invalidate() after installing or removing programs.
+    """
+
+    def __init__(self) -> None:
+        self._paths: dict[tuple[str, str | None], str] = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, name: str | Path, env: Any = None) -> str:
+        """The path of the executable name, searched in the PATH of env,
+        by default the environment of this process."""
+        name = str(name)
+        if os.sep in name:
+            return name
+        key = (name, (os.environ if env is None else env).get("PATH", None))
+        with self._lock:
+            if (path := self._paths.get(key, None)) is not None:
+                return path
+        import shutil  # slow to import, rarely needed
+
+        path = shutil.which(name, path=key[1])
+        if path is None:
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), name)
+        with self._lock:
+            self._paths[key] = path
+        return path
+
+    def invalidate(self, name: str | None = None) -> None:
+        """Forgets the resolution of name, or of every name if not given."""
+        with self._lock:
+            if name is None:
+                self._paths.clear()
+            else:
+                for key in [key for key in self._paths if key[0] == name]:
+                    del self._paths[key]
+
+
+executables = ExecutableCache()
+
+
+@dataclass
+class Rusage:
+    """Resources used by a process, see getrusage(2).
+    CPU times are in seconds and maxrss in bytes."""
+
+    utime: float = 0.0
+    stime: float = 0.0
+    maxrss: int = 0
+    minflt: int = 0
+    majflt: int = 0
+    nvcsw: int = 0
+    nivcsw: int = 0
+
+    @staticmethod
+    def from_struct(ru: Any) -> "Rusage":
+        # Linux reports KiB, macOS bytes
+        scale = 1 if sys.platform == "darwin" else 1024
+        return Rusage(
+            ru.ru_utime,
+            ru.ru_stime,
+            ru.ru_maxrss * scale,
+            ru.ru_minflt,
+            ru.ru_majflt,
+            ru.ru_nvcsw,
+            ru.ru_nivcsw,
+        )
+
+    def __add__(self, other: "Rusage") -> "Rusage":
+        """Total usage of both. maxrss is the largest of the two."""
+        return Rusage(
+            self.utime + other.utime,
+            self.stime + other.stime,
+            max(self.maxrss, other.maxrss),
+            self.minflt + other.minflt,
+            self.majflt + other.majflt,
+            self.nvcsw + other.nvcsw,
+            self.nivcsw + other.nivcsw,
+        )
+
+    @property
+    def cpu(self) -> float:
+        return self.utime + self.stime
+
+
+def wait4(pid: int, block: bool) -> tuple[int | None, Rusage | None]:
+    """Reaps pid with os.wait4.
+
+    Returns:
+      the exit code and resource usage, None if still running.
+    """
+    try:
+        waited, status, ru = os.wait4(pid, 0 if block else os.WNOHANG)
+    except ChildProcessError:
+        # Reaped by someone else, like Popen assume success
+        return 0, None
+    if waited != pid:
+        return None, None
+    return os.waitstatus_to_exitcode(status), Rusage.from_struct(ru)
+
+
+class Process(subprocess.Popen):
+    """subprocess.Popen that reaps the child with wait4(), so that its
+    resource usage is available as self.rusage once it exited."""
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        self.rusage: Rusage | None = None
+        self._wait4_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def _wait4(self, block: bool) -> int | None:
+        # Like Popen, do not block poll() while another thread waits
+        if not self._wait4_lock.acquire(block):
+            return None
+        try:
+            if self.returncode is None:
+                retcode, self.rusage = wait4(self.pid, block)
+                # Popen only sets returncode itself when it reaps the child
+                self.returncode = retcode
+        finally:
+            self._wait4_lock.release()
+        return self.returncode
+
+    def poll(self) -> int | None:
+        return self._wait4(False)
+
+    def wait(self, timeout: float | None = None) -> int:
+        if timeout is not None:
+            deadline = time.perf_counter() + timeout
+            while self._wait4(False) is None:
+                if time.perf_counter() > deadline:
+                    raise subprocess.TimeoutExpired(self.args, timeout)
+                time.sleep(0.005)
+        while self._wait4(True) is None:
+            pass
+        assert self.returncode is not None
+        return self.returncode
+
+
+class PopenBackend:
+    """Spawns processes with subprocess.Popen."""
+
+    def spawn(self, args: tuple[str, ...], **popen_kwargs: Any) -> Any:
+        return Process(args, **popen_kwargs)
+
+
+class PosixSpawnBackend:
+    """Spawns processes with os.posix_spawn.
+    Falls back to Popen for the options posix_spawn cannot express, e.g. cwd.
+    """
+
+    # Like Popen(restore_signals=True), which Python sets to SIG_IGN
+    SIGDEF_NAMES = ("SIGPIPE", "SIGXFSZ")
+    SIGDEF = tuple(getattr(signal, name) for name in SIGDEF_NAMES)
+
+    def __init__(self, cache: ExecutableCache | None = None) -> None:
+        self.cache = cache if cache is not None else executables
+
+    def spawn(self, args: tuple[str, ...], **popen_kwargs: Any) -> Any:
+        posix_kwargs = {"stdin", "stdout", "stderr", "env", "process_group"}
+        if not hasattr(os, "posix_spawn") or not set(popen_kwargs) <= posix_kwargs:
+            return PopenBackend().spawn(args, **popen_kwargs)
+        env = popen_kwargs.get("env", None)
+        path = self.cache.resolve(args[0], env)
+        try:
+            return SpawnedProcess(path, args, self.SIGDEF, **popen_kwargs)
+        except FileNotFoundError:
+            # The cached executable might have been removed since
+            self.cache.invalidate(str(args[0]))
+            path = self.cache.resolve(args[0], env)
+            return SpawnedProcess(path, args, self.SIGDEF, **popen_kwargs)
+
+
+_backend: Any = PopenBackend()
+
+
+def get_spawn_backend() -> Any:
+    return _backend
+
+
+def set_spawn_backend(backend: Any) -> Any:
+    """Sets the backend used to spawn commands.
+    Returns the previous one."""
+    global _backend
+    prev, _backend = _backend, backend
+    return prev
+
+
+class ChildProcess:
+    """A process spawned by a backend other than Popen.
+    Offers the subset of the subprocess.Popen interface used by pysh.
+    Subclasses implement _try_wait(), which sets self.rusage if it can."""
+
+    def __init__(self, args: tuple[str, ...]) -> None:
+        self.args = args
+        self.pid = -1
+        self.returncode: int | None = None
+        self.rusage: Rusage | None = None
+        self.stdin: io.BufferedWriter | None = None
+        self.stdout: io.BufferedReader | None = None
+        self.stderr: io.BufferedReader | None = None
+
+    def _child_stdio(
+        self, stdin: Any, stdout: Any, stderr: Any
+    ) -> tuple[list[int], list[int]]:
+        """Translates Popen-style redirections to the descriptors the child
+        should get as 0, 1 and 2. Pipes to the parent become self.stdin etc.
+
+        Returns:
+          the child descriptors, and the ones to close once the child is spawned.
+        """
+        child_fds: list[int] = []
+        to_close: list[int] = []
+        try:
+            for target, redir in enumerate((stdin, stdout, stderr)):
+                match redir:
+                    case None:
+                        fd = target
+                    case subprocess.STDOUT:
+                        fd = child_fds[1]
+                    case subprocess.DEVNULL:
+                        fd = os.open(os.devnull, os.O_RDWR)
+                        to_close.append(fd)
+                    case subprocess.PIPE:
+                        r, w = os.pipe()
+                        if target == 0:
+                            self.stdin = open(w, "wb")
+                            fd = r
+                        else:
+                            fd = w
+                            if target == 1:
+                                self.stdout = open(r, "rb")
+                            else:
+                                self.stderr = open(r, "rb")
+                        to_close.append(fd)
+                    case int(fd):
+                        pass
+                    case f:
+                        fd = f.fileno()
+                child_fds.append(fd)
+        except BaseException:
+            self._close_streams()
+            for fd in to_close:
+                os.close(fd)
+            raise
+        return child_fds, to_close
+
+    def _close_streams(self) -> None:
+        for stream in (self.stdin, self.stdout, self.stderr):
+            if stream is not None:
+                stream.close()
+
+    def _try_wait(self, block: bool) -> int | None:
+        """Returns the exit code if the process has exited."""
+        raise NotImplementedError
+
+    def poll(self) -> int | None:
+        if self.returncode is None:
+            self.returncode = self._try_wait(False)
+        return self.returncode
+
+    def wait(self, timeout: float | None = None) -> int:
+        if timeout is not None:
+            deadline = time.perf_counter() + timeout
+            while self.poll() is None:
+                if time.perf_counter() > deadline:
+                    raise subprocess.TimeoutExpired(self.args, timeout)
+                time.sleep(0.005)
+        while self.returncode is None:
+            self.returncode = self._try_wait(True)
+        return self.returncode
+
+    def send_signal(self, sig: int) -> None:
+        if self.poll() is None:
+            os.kill(self.pid, sig)
+
+    def kill(self) -> None:
+        self.send_signal(signal.SIGKILL)
+
+    def terminate(self) -> None:
+        self.send_signal(signal.SIGTERM)
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self._close_streams()
+        self.wait()
+
+
+class SpawnedProcess(ChildProcess):
+    """A process spawned with os.posix_spawn."""
+
+    def __init__(
+        self,
+        path: str,
+        args: tuple[str, ...],
+        sigdef: tuple[int, ...],
+        stdin: Any = None,
+        stdout: Any = None,
+        stderr: Any = None,
+        env: Any = None,
+        process_group: int | None = None,
+    ) -> None:
+        super().__init__(args)
+        child_fds, to_close = self._child_stdio(stdin, stdout, stderr)
+        # posix_spawn rejects setpgroup=None
+        group: dict[str, Any] = {}
+        if process_group is not None:
+            group["setpgroup"] = process_group
+        try:
+            self.pid = os.posix_spawn(
+                path,
+                args,
+                os.environ if env is None else env,
+                file_actions=[
+                    (os.POSIX_SPAWN_DUP2, fd, target)
+                    for target, fd in enumerate(child_fds)
+                    if fd != target
+                ],
+                setsigdef=sigdef,
+                **group,
+            )
+        except BaseException:
+            self._close_streams()
+            raise
+        finally:
+            for fd in to_close:
+                os.close(fd)
+
+    def _try_wait(self, block: bool) -> int | None:
+        retcode, self.rusage = wait4(self.pid, block)
+        return retcode
@@ -0,0 +1,149 @@
+import codecs
+import os
+import subprocess
+import threading
+import time
+from typing import Any, AnyStr, Iterator, Self
+
+from .command import Command, CommitResult, CommitResKind
+from .contexts import effective_timeout, in_session
+from .errors import PyShCommitError
+from .pipeline import Pipeline
+from .utils import *
+
+
+class Stream:
+    """Iterates over the stdout of a command while it is still running.
+    Memory usage stays constant no matter how much the command outputs.
+
+    USAGE
+        for line in Stream(find(".") | sort):
+            print(line)
+
+        s = Stream("cat", "big.bin", chunk=1 << 16)
+        for data in s:
+            h.update(data)
+        s.result.retcode  # available once the iterator is exhausted
+
+    Yields:
+      str lines without their line endings, or bytes chunks of at most
+      `chunk` bytes if `chunk` is given.
+      Lines are decoded incrementally, so multi-byte characters split across
+      reads are handled. With text=False lines are yielded as bytes.
+
+    Keyword arguments:
+    * chunk: int=None
+      Yield raw bytes chunks instead of decoded lines.
+    * keepends: bool=False
+      Keep the line endings of yielded lines.
+    * timeout: int|str=None
+      Kill the command once the timeout is reached, see Run().
+    * strict: bool=False
+      If true, raise PyShCommitError on exhaustion if the command failed.
+    * for more check Run(). stdout must not be redirected.
+    * input, capture: NOT SUPPORTED
+
+    Leaving the iteration early leaks the process unless the stream is closed,
+    so prefer using it as a context manager:
+        with Stream(cmd) as s:
+            first = next(s)
+    """
+
+    def __init__(self, cmd: str | Command, *args: str, **kwargs: Any) -> None:
+        (self._chunk, self._keepends, timeout, self._strict) = multipop_dict(
+            kwargs, chunk=None, keepends=False, timeout=None, strict=False
+        )
+        if isinstance(cmd, str):
+            cmd = Command(cmd)
+        self.result: CommitResult | None = None
+        self._time_start = time.perf_counter()
+        self._timed_out = False
+        self._cmd = in_session(cmd.update(*args, **{"o": subprocess.PIPE} | kwargs))
+        self._pipeline = Pipeline(self._cmd)
+        timeout = effective_timeout(timeout)
+        if timeout is not None and "pgroup" not in self._cmd.kwargs:
+            self._pipeline.pgroup = True
+        self._pipeline.spawn()
+        self._timer: threading.Timer | None = None
+        if timeout is not None:
+            self._timer = threading.Timer(timeout, self._on_timeout)
+            self._timer.daemon = True
+            self._timer.start()
+        self._it = self._iter()
+
+    @property
+    def retcode(self) -> int | None:
+        return None if self.result is None else self.result.retcode
+
+    def __iter__(self) -> Self:
+        return self
+
+    def __next__(self) -> Any:
+        return next(self._it)
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Kill the command if it is still running and wait for it."""
+        if self.result is None:
+            self._pipeline.kill()
+            self._finish()
+
+    def _iter(self) -> Iterator[Any]:
+        stdout = self._pipeline.stdout
+        if stdout is not None:
+            fd = stdout.fileno()
+            if self._chunk is not None:
+                yield from _read_chunks(fd, self._chunk)
+            elif not self._cmd.kwargs.get("text", True):
+                yield from self._lines(_read_chunks(fd), b"\n", b"\r")
+            else:
+                encoding = self._cmd.kwargs.get("encoding", None) or "utf-8"
+                errors = self._cmd.kwargs.get("errors", None) or "strict"
+                decoder = codecs.getincrementaldecoder(encoding)(errors)
+                texts = _decode_chunks(_read_chunks(fd), decoder)
+                yield from self._lines(texts, "\n", "\r")
+        res = self._finish()
+        if self._strict and not res:
+            raise PyShCommitError(res)
+
+    def _lines(
+        self, chunks: Iterator[AnyStr], nl: AnyStr, cr: AnyStr
+    ) -> Iterator[AnyStr]:
+        """Splits str or bytes chunks into lines."""
+        for line in split_lines(chunks, nl, self._keepends):
+            yield line if self._keepends else line.removesuffix(cr)
+
+    def _on_timeout(self) -> None:
+        if self._pipeline.running():
+            self._timed_out = True
+            self._pipeline.terminate()
+
+    def _finish(self) -> CommitResult:
+        if self._timer is not None:
+            self._timer.cancel()
+        if self._pipeline.stdout is not None:
+            self._pipeline.stdout.close()
+        res = self._pipeline.communicate()
+        res.elapsed = time.perf_counter() - self._time_start
+        if self._timed_out:
+            res.kind = CommitResKind.TIMEOUT
+        self.result = res
+        return res
+
+
+def _read_chunks(fd: int, size: int = 65536) -> Iterator[bytes]:
+    while data := os.read(fd, size):
+        yield data
+
+
+def _decode_chunks(
+    chunks: Iterator[bytes], decoder: codecs.IncrementalDecoder
+) -> Iterator[str]:
+    for chunk in chunks:
+        yield decoder.decode(chunk)
+    yield decoder.decode(b"", final=True)
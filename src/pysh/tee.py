@@ -0,0 +1,163 @@
+"""Copies the output of a command to several commands and files at once.
+
+USAGE
+    gz = Command("gzip", "-c", o="logs.gz")
+    digest = Command("sha256sum", o="logs.sha256")
+    Run(journalctl | Tee(gz, digest, o="raw.log"))
+
+Like tee(1), the input is also copied to the stdout of the Tee stage,
+which is redirected like the one of any command: o="raw.log" above, o=None
+to drop it, or piped to a next stage.
+
+On Linux the data is spliced from the input pipe into a memfd and sent to
+every output with sendfile(), so it never passes through Python objects.
+Elsewhere, or when the input is not a pipe, one buffer is reused for every
+read and write.
+"""
+import contextlib
+import errno
+import fcntl
+import os
+import select
+import stat
+import sys
+import termios
+from pathlib import Path
+
+from .builtin import Builtin, BuiltinIO
+from .command import Command
+from .contexts import in_session, session_path
+from .pipeline import Pipeline
+
+# Bytes moved per round, at most what the input pipe holds
+CHUNK = 1 << 20
+
+
+def Tee(*outputs: Command | Path, **kwargs: object) -> Command:
+    """A pipeline stage copying its input to the stdin of every command,
+    to every file and to its own stdout.
+
+    The output commands are spawned when the stage starts. They inherit
+    the stdout and stderr of this process unless redirected. Outputs that
+    stop reading are dropped, the others still get everything. Like the
+    other stages, they and the files are resolved in the active Session.
+
+    Returns:
+      a Command. Its retcode is the one of the first failing output
+      command, 0 if none fails.
+
+    Keyword arguments: redirections of the stdout, see Command.
+    """
+    for out in outputs:
+        if not isinstance(out, (Command, Path)):
+            raise TypeError(f"Expected a Command or a Path to Tee into. Got {out}")
+    return Command(
+        "Tee", *(str(out) for out in outputs), pystage=_tee(outputs), **kwargs
+    )
+
+
+def _tee(outputs: tuple[Command | Path, ...]) -> Builtin:
+    def run(io: BuiltinIO) -> int:
+        with contextlib.ExitStack() as stack:
+            fds = [io.fds[1]]
+            pipes = []
+            for out in outputs:
+                if isinstance(out, Path):
+                    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC
+                    fds.append(os.open(session_path(out), flags, 0o666))
+                    stack.callback(os.close, fds[-1])
+                else:
+                    # Killed on the way out unless they exited
+                    cmd = in_session(out, stdin=True)
+                    pipe = stack.enter_context(Pipeline(cmd)).spawn(stdin=True)
+                    pipes.append(pipe)
+                    fds.append(pipe.stdin.fileno())
+            if _can_splice(io.fds[0]):
+                _copy_splice(io, fds)
+            else:
+                _copy_read(io, fds)
+            for pipe in pipes:
+                pipe.stdin.close()
+            retcodes = [pipe.communicate().retcode for pipe in pipes]
+        return next((rc for rc in retcodes if rc), 0)
+
+    return run
+
+
+def _can_splice(fd: int) -> bool:
+    if not hasattr(os, "splice") or not hasattr(os, "memfd_create"):
+        return False
+    return stat.S_ISFIFO(os.fstat(fd).st_mode)
+
+
+def _copy_splice(io: BuiltinIO, outs: list[int]) -> None:
+    """Copies stdin to outs through a memfd, without copies in user space."""
+    # Larger pipes, fewer rounds. The size is capped for unprivileged users.
+    for fd in [io.fds[0], *outs]:
+        try:
+            fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, CHUNK)
+        except OSError:
+            pass
+    memfd = os.memfd_create("pysh-tee", os.MFD_CLOEXEC)
+    try:
+        while outs:
+            io.wait(io.fds[0], select.POLLIN)
+            size = os.splice(io.fds[0], memfd, CHUNK, offset_dst=0)  # type: ignore[attr-defined]
+            if not size:
+                return
+            outs = [fd for fd in outs if _send(io, fd, memfd, size)]
+            # sendfile() queued the pages themselves in the output pipes.
+            # Truncating detaches them, so the next round cannot overwrite them.
+            os.ftruncate(memfd, 0)
+    finally:
+        os.close(memfd)
+
+
+def _send(io: BuiltinIO, fd: int, memfd: int, size: int) -> bool:
+    """Sends the first size bytes of memfd to fd. False if fd is closed."""
+    offset = 0
+    try:
+        while offset < size:
+            io.wait(fd, select.POLLOUT)
+            count = min(size - offset, _room(fd, size))
+            try:
+                offset += os.sendfile(fd, memfd, offset, count)
+            except BlockingIOError:
+                pass
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                    raise
+                # e.g. a terminal, which sendfile() cannot write to
+                io.write(os.pread(memfd, size - offset, offset), fd)
+                offset = size
+    except BrokenPipeError:
+        return False
+    return True
+
+
+def _room(fd: int, default: int) -> int:
+    """How much can be written to fd without blocking, once it is writable.
+    default if fd is not a pipe."""
+    try:
+        capacity = fcntl.fcntl(fd, fcntl.F_GETPIPE_SZ)
+    except (AttributeError, OSError):
+        return default
+    queued = bytearray(4)
+    fcntl.ioctl(fd, termios.FIONREAD, queued)
+    # Writable means at least PIPE_BUF bytes free
+    return max(select.PIPE_BUF, capacity - int.from_bytes(queued, sys.byteorder))
+
+
+def _copy_read(io: BuiltinIO, outs: list[int]) -> None:
+    """Copies stdin to outs through one reused buffer."""
+    buffer = bytearray(BuiltinIO.READ_SIZE)
+    view = memoryview(buffer)
+    while outs:
+        io.wait(io.fds[0], select.POLLIN)
+        if not (size := os.readv(io.fds[0], [buffer])):
+            return
+        for fd in list(outs):
+            try:
+                io.write(view[:size], fd)
+            except BrokenPipeError:
+                outs.remove(fd)
@@ -0,0 +1,132 @@
+"""Records a span for every process spawned by Run, Cap and the like.
+
+USAGE
+    tracer = Tracer()
+    set_tracer(tracer)
+    ...  # the script
+    tracer.export("trace.json")  # open in chrome://tracing or Perfetto
+    print(tracer.top())          # the commands that used the most CPU
+
+Tracing is off unless a tracer is set. ARun() and Batch are traced too.
+The commands of a Batch share the row of the bash process running them,
+with the times it measured and without resource usage.
+"""
+import os
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+from .spawn import Rusage
+
+if TYPE_CHECKING:
+    from .command import Command
+
+
+@dataclass
+class Span:
+    """One process. start and end are perf_counter() timestamps."""
+
+    args: tuple[str, ...]
+    cwd: str
+    pid: int
+    start: float
+    end: float | None
+    retcode: int | None
+    rusage: Rusage | None
+
+
+class Tracer:
+    def __init__(self) -> None:
+        self.spans: list[Span] = []
+        self._lock = threading.Lock()
+        # Trace timestamps are relative to the creation of the tracer
+        self._origin = time.perf_counter()
+
+    def record(self, span: Span) -> None:
+        with self._lock:
+            self.spans.append(span)
+
+    def chrome_trace(self) -> dict[str, Any]:
+        """The spans in the Chrome trace-event format.
+        Each process gets its own row, named after its pid."""
+        events = []
+        for span in list(self.spans):
+            end = span.start if span.end is None else span.end
+            args: dict[str, Any] = {
+                "argv": [os.fsdecode(arg) for arg in span.args],
+                "cwd": span.cwd,
+                "retcode": span.retcode,
+            }
+            if span.rusage is not None:
+                args |= vars(span.rusage)
+            events.append(
+                {
+                    "name": " ".join(args["argv"]),
+                    "cat": "process",
+                    "ph": "X",
+                    "ts": (span.start - self._origin) * 1e6,
+                    "dur": (end - span.start) * 1e6,
+                    "pid": os.getpid(),
+                    "tid": span.pid,
+                    "args": args,
+                }
+            )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def export(self, path: str | Path) -> None:
+        import json
+
+        Path(path).write_text(json.dumps(self.chrome_trace()))
+
+    def top(self, n: int = 10) -> str:
+        """A report of the n programs that used the most CPU in total."""
+        totals: dict[str, list[Any]] = {}
+        for span in list(self.spans):
+            name = os.path.basename(os.fsdecode(span.args[0]))
+            total = totals.setdefault(name, [0, 0.0, 0.0, 0])
+            total[0] += 1
+            if span.end is not None:
+                total[1] += span.end - span.start
+            if span.rusage is not None:
+                total[2] += span.rusage.cpu
+                total[3] = max(total[3], span.rusage.maxrss)
+        rows = sorted(totals.items(), key=lambda item: item[1][2], reverse=True)
+        lines = [
+            f"{'command':<24} {'runs':>6} {'wall s':>10} {'cpu s':>10} {'max rss':>10}"
+        ]
+        for name, (runs, wall, cpu, maxrss) in rows[:n]:
+            lines.append(
+                f"{name:<24} {runs:>6} {wall:>10.3f} {cpu:>10.3f} {maxrss >> 20:>8}Mi"
+            )
+        return "\n".join(lines)
+
+
+_tracer: Tracer | None = None
+
+
+def get_tracer() -> Tracer | None:
+    return _tracer
+
+
+def set_tracer(tracer: Tracer | None) -> Tracer | None:
+    """Sets the tracer recording every process, None to stop tracing.
+    Returns the previous one."""
+    global _tracer
+    prev, _tracer = _tracer, tracer
+    return prev
+
+
+def record(
+    cmd: "Command",
+    pid: int,
+    start: float,
+    end: float | None,
+    retcode: int | None,
+    rusage: Rusage | None = None,
+) -> None:
+    """Records the span of one stage if a tracer is set."""
+    if (tracer := _tracer) is not None:
+        cwd = os.path.abspath(cmd.kwargs.get("cwd", None) or os.getcwd())
+        tracer.record(Span(cmd.args, cwd, pid, start, end, retcode, rusage))
@@ -1,5 +1,6 @@
+import re
 from pathlib import Path
-from typing import Any
+from typing import Any, AnyStr, Iterable, Iterator
 
 
 def ensure_path(p: str | Path) -> Path:
@@ -9,20 +10,29 @@ def ensure_path(p: str | Path) -> Path:
         return Path(p)
 
 
-def timeout_to_seconds(x: int | str) -> int:
+def timeout_to_seconds(x: int | float | str) -> float:
+    """Converts a duration like 90, "90", "1.5s", "5m" or "1h3m24s" to seconds."""
+    if isinstance(x, (int, float)):
+        return x
+    if re.fullmatch(r"\d+(\.\d*)?", x.strip()):
+        return float(x)
+    parts = re.findall(r"(\d+(?:\.\d*)?|\.\d+)([smh])", x.strip().lower())
+    if not parts or "".join(num + unit for num, unit in parts) != x.strip().lower():
+        raise ValueError(f"Unrecognized timeout {x}")
+    units = {"s": 1, "m": 60, "h": 60 * 60}
+    return sum(float(num) * units[unit] for num, unit in parts)
+
+
+def size_to_bytes(x: int | str) -> int:
+    """Converts a size like 4096, "4096", "4K", "4KiB" or "64MiB" to bytes.
+    Units are binary multiples, so "1KB" is also 1024 bytes."""
     if isinstance(x, int):
         return x
-    # TODO: Support 3m24s
-    num = int(x[:-1])
-    match x[-1].lower():
-        case "s":
-            return num
-        case "m":
-            return num * 60
-        case "h":
-            return num * 60 * 60
-        case _:
-            raise ValueError(f"Unrecognized timeout {x}")
+    match = re.fullmatch(r"(\d+)\s*(?:([kmg])i?)?b?", x.strip().lower())
+    if match is None:
+        raise ValueError(f"Unrecognized size {x}")
+    num, unit = match.groups()
+    return int(num) << {None: 0, "k": 10, "m": 20, "g": 30}[unit]
 
 
 def multipop_dict(d: dict[str, Any], **kwargs: Any) -> list[Any]:
@@ -31,3 +41,42 @@ def multipop_dict(d: dict[str, Any], **kwargs: Any) -> list[Any]:
 
 def project_dict(d: dict[str, Any], *args: str) -> dict[str, Any]:
     return {k: v for k, v in d.items() if k in args}
+
+
+def input_chunks(input: Any, size: int = 65536) -> Iterator[bytes]:
+    """The bytes of an input= kwarg, produced on demand.
+    input is str, bytes, a file object, an iterable of str or bytes, or a
+    function returning one of those. str is encoded with utf-8."""
+    if callable(input):
+        input = input()
+    if input is None:
+        return
+    if isinstance(input, (bytes, bytearray, memoryview, str)):
+        input = [input]
+    elif hasattr(input, "read"):
+        file = input
+        # read(0) is the empty str or bytes that read() returns at EOF
+        input = iter(lambda: file.read(size), file.read(0))
+    for chunk in input:
+        yield chunk.encode() if isinstance(chunk, str) else bytes(chunk)
+
+
+def split_lines(
+    chunks: Iterable[AnyStr], nl: AnyStr, keepends: bool = False
+) -> Iterator[AnyStr]:
+    """Splits str or bytes chunks into lines, in time linear in their size
+    even when a line spans many chunks. The last line may lack nl."""
+    pending: list[AnyStr] = []
+    for chunk in chunks:
+        if nl not in chunk:
+            pending.append(chunk)
+            continue
+        lines = chunk.split(nl)
+        if pending:
+            pending.append(lines[0])
+            lines[0] = nl[:0].join(pending)
+        pending = [lines.pop()]
+        for line in lines:
+            yield line + nl if keepends else line
+    if last := nl[:0].join(pending):
+        yield last
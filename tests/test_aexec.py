@@ -0,0 +1,69 @@
+import asyncio
+import time
+
+import pytest
+
+from pysh import *
+
+echo = Command("echo")
+
+
+def test_acap():
+    assert asyncio.run(ACap(echo, "hello world")) == "hello world"
+    res = asyncio.run(ACap(echo("hello world") | sed("s/o/O/g") | tr("a-z", "A-Z")))
+    assert res == "HELLO WORLD"
+
+
+def test_arun_redirect(tmp_path):
+    res = asyncio.run(ARun(echo("hi") | cat_, o=tmp_path / "o.txt"))
+    assert res and (tmp_path / "o.txt").read_text() == "hi\n"
+    res = asyncio.run(ARun(ls_("/NonEXISTENT"), capture=True))
+    assert not res and res.stdout == "" and res.stderr != ""
+
+
+def test_arun_input():
+    assert asyncio.run(ACap("cat", input="abc")) == "abc"
+    assert asyncio.run(ACap(cat_ | sort, input="b\na\n")) == "a\nb"
+
+    async def lines():
+        for line in ["b\n", "a\n"]:
+            yield line
+
+    assert asyncio.run(ACap(sort, input=lines())) == "a\nb"
+    assert asyncio.run(ACap("cat", input=iter([b"a", b"b"]))) == "ab"
+
+
+def test_arun_concurrent():
+    async def main():
+        return await asyncio.gather(*(ARun("sleep", "0.3") for _ in range(8)))
+
+    start = time.perf_counter()
+    assert all(asyncio.run(main()))
+    assert time.perf_counter() - start < 1.0
+
+
+def test_arun_timeout():
+    res = asyncio.run(ARun("yes", o=None, timeout=0.1))
+    assert res.kind == CommitResKind.TIMEOUT
+    with pytest.raises(PyShCommitError):
+        asyncio.run(ARun("yes", o=None, timeout=0.1, strict=True))
+    with pytest.raises(FileNotFoundError):
+        asyncio.run(ARun("CrAzY-NoNeXiStEnT-CoMmAnD"))
+
+
+def test_arun_like_run(tmp_path):
+    res = asyncio.run(ARun(echo("a") | Command("false") | cat_, o=None))
+    assert [s.args[0] for s in res.stages] == ["echo", "false", "cat"]
+    assert [s.retcode for s in res.stages] == [0, 1, 0]
+    assert all(s.pid > 0 and s.elapsed is not None for s in res.stages)
+    cache = ResultCache()
+    date = Command("date", "+%N")
+    first = asyncio.run(ACap(date, cache=cache))
+    assert asyncio.run(ACap(date, cache=cache)) == first == Cap(date, cache=cache)
+    assert cache.hits == 2
+    log = tmp_path / "log"
+    with Batch():
+        asyncio.run(ARun(echo("1"), a=log))
+        Run(echo("2"), a=log)
+        assert not log.exists()
+    assert log.read_text() == "1\n2\n"
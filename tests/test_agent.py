@@ -0,0 +1,107 @@
+import itertools
+import os
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+import pysh
+from pysh import *
+
+
+@pytest.fixture(scope="module")
+def agent(tmp_path_factory):
+    path = tmp_path_factory.mktemp("agent") / "sock"
+    env = os.environ | {"PYTHONPATH": str(Path(pysh.__file__).parent.parent)}
+    server = subprocess.Popen([sys.executable, "-m", "pysh.agent", path], env=env)
+    while True:
+        assert server.poll() is None
+        try:
+            agent = Agent(path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            time.sleep(0.01)
+        else:
+            break
+    with agent:
+        agent.pid = server.pid
+        yield agent
+    server.terminate()
+    server.wait()
+
+
+def test_agent_runs(agent, tmp_path, monkeypatch, capfd):
+    assert int(Cap("sh", "-c", "echo $PPID")) == agent.pid
+    assert Cap(echo_("hello") | sed("s/h/j/")) == "jello"
+    res = Run(ls_("/NonEXISTENT", "."), capture=True)
+    assert not res and res.retcode == 2 and res.stdout != "" and res.stderr != ""
+    assert res.stages[0].rusage is not None
+    # The cwd, environment and stdout of the script
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("PYSH_AGENT_TEST", "x")
+    Run(echo_("hi"), o="out")
+    assert (tmp_path / "out").read_text() == "hi\n"
+    assert Cap("sh", "-c", "pwd; echo $PYSH_AGENT_TEST") == f"{tmp_path}\nx"
+    capfd.readouterr()
+    Run(echo_("to the terminal"))
+    assert capfd.readouterr().out == "to the terminal\n"
+
+
+def test_agent_streams(agent):
+    chunks = itertools.repeat(b"x" * 1000, 10000)
+    assert Cap(Command("wc", "-c"), input=chunks) == "10000000"
+    res = Run(head("-c3"), input=itertools.repeat(b"ab"), o=-1)
+    assert res.stdout == "aba"
+    res = Run(Command("seq", "100000"), o=-1, keep=KeepTail(7), text=False)
+    assert res.stdout == b"100000\n"
+
+
+def test_agent_errors(agent):
+    res = Run("sleep", "5", timeout=0.2)
+    assert res.kind == CommitResKind.TIMEOUT and res.elapsed < 2
+    with pytest.raises(FileNotFoundError):
+        Run("NonExistentCommand")
+    with pytest.raises(PyShError):
+        Run(echo_("x") | PyFilter(str.upper))
+    assert Cap("true") == ""
+
+
+def test_agent_disconnect(agent):
+    conn = Agent(agent._sock.getpeername())
+    errors = []
+
+    def run() -> None:
+        try:
+            conn.run(Command("sleep", "30"))
+        except PyShError as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    time.sleep(0.2)
+    conn.close()
+    thread.join(5)
+    assert not thread.is_alive() and errors
+
+
+def test_agent_access(agent, tmp_path, monkeypatch):
+    assert os.stat(agent._sock.getpeername()).st_mode & 0o777 == 0o600
+    public = tmp_path / "public"
+    public.mkdir(mode=0o755)
+    public.chmod(0o755)
+    with pytest.raises(PyShError):
+        AgentServer(public / "sock")
+    server = AgentServer(tmp_path / "private" / "sock", jobs=1)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        # Connections of other users are closed right away
+        uid = os.getuid()
+        monkeypatch.setattr(os, "getuid", lambda: uid + 1)
+        with Agent(server.path) as other, pytest.raises(PyShError):
+            other.run(Command("true"))
+    finally:
+        server.close()
+        thread.join()
@@ -0,0 +1,74 @@
+import shlex
+import threading
+
+import pytest
+
+from pysh import *
+
+
+def test_str_quoting():
+    cmd = echo_("a b", "it's", "$HOME", o="out file") | sort(e=None) | tee_(a="x")
+    assert (
+        str(cmd)
+        == "echo 'a b' 'it'\"'\"'s' '$HOME' > 'out file' | sort 2> /dev/null | tee >> x"
+    )
+    assert shlex.split(str(echo_("a b", "it's")))[1:] == ["a b", "it's"]
+    assert str(Command("ls", capture=1)) == "$( ls )"
+
+
+def test_batch(tmp_path):
+    with Batch():
+        hello = Run(echo_("hello world"), o=-1)
+        fail = Run(Command("sh", "-c", "echo oops >&2; exit 3"), e=-1)
+        piped = Run(echo_("abc") | tr("a", "x"), o=-1)
+        Run(echo_("to file"), o=tmp_path / "out")
+        cwd = Run("pwd", o=-1, cwd=tmp_path)
+        assert "kind" not in vars(hello)
+    assert hello and hello.stdout == "hello world\n"
+    assert not fail and fail.retcode == 3 and fail.stderr == "oops\n"
+    assert piped.stdout == "xbc\n"
+    assert (tmp_path / "out").read_text() == "to file\n"
+    assert cwd.stdout == f"{tmp_path}\n"
+    assert hello.elapsed is not None and hello.elapsed >= 0
+
+
+def test_batch_order(tmp_path):
+    log = tmp_path / "log"
+    with Batch():
+        Run(echo_("1"), a=log)
+        # Not batchable, runs after the queue
+        Run(Command("sh", "-c", f"echo 2 >> {log}"), input="")
+        res = Run(echo_("3"), a=log)
+        assert res  # runs the queue
+        Run(echo_("4"), a=log)
+        assert Cap(cat_(log)) == "1\n2\n3\n4"
+
+
+def test_batch_errors():
+    with Batch():
+        with pytest.raises(FileNotFoundError):
+            Run("nonexistent-program")
+        # Would exit the batch shell, runs on its own like outside the block
+        with pytest.raises(FileNotFoundError):
+            Run("exit", "3")
+
+
+def test_batch_threads():
+    with Batch():
+        results = [Run(echo_(str(n)), o=-1) for n in range(20)]
+        expected = [f"{n}\n" for n in range(20)]
+        seen = []
+        # Every thread uses results, each use may run the queue
+        threads = [
+            threading.Thread(target=lambda: seen.append([r.stdout for r in results]))
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert seen == [expected] * 8
+        # Parallel workers run in the block, and flush the queue
+        queued = Run(echo_("q"), o=-1)
+        assert all(Parallel(echo_, [("x",)] * 8, jobs=4, o=None))
+        assert queued.stdout == "q\n"
@@ -0,0 +1,76 @@
+import os
+
+import pytest
+
+from pysh import *
+from pysh.builtin import BuiltinProcess
+
+CASES = [
+    ("echo", "hello", "world"),
+    ("echo", "-n", "x"),
+    ("echo", "-nE", "a\\nb"),
+    ("echo", "-e", "a\\tb"),
+    ("head", "-n2"),
+    ("head", "-c", "5"),
+    ("head", "-n0"),
+    ("tail", "-n", "2"),
+    ("tail", "-c3"),
+    # More than the input
+    ("tail", "-c", "30"),
+    ("tr", "a-c", "x"),
+    ("tr", "-d", "a\n"),
+    ("sort",),
+    ("sort", "-ru"),
+    ("cat", "-"),
+    ("cat", "/NonEXISTENT"),
+    ("head", "--lines=1"),
+]
+INPUT = "b\na\nc\na\nbanana\ncab"
+
+
+def run(args, **kwargs):
+    res = Run(Command(*args), capture=True, input=INPUT, text=False, **kwargs)
+    return res.retcode, res.stdout
+
+
+@pytest.mark.parametrize("args", CASES)
+def test_builtin_same_as_binary(args):
+    expected = run(args)
+    prev = set_spawn_backend(BuiltinBackend())
+    try:
+        assert run(args) == expected
+    finally:
+        set_spawn_backend(prev)
+
+
+def test_builtin_pipeline(tmp_path):
+    prev = set_spawn_backend(BuiltinBackend())
+    try:
+        pipe = Pipeline(echo_("b\na") | sort | tee_(tmp_path / "t.txt", capture=True))
+        with pipe:
+            pipe.spawn()
+            res = pipe.communicate()
+        assert isinstance(pipe.procs[1], BuiltinProcess)
+        assert res.stdout == "a\nb\n" == (tmp_path / "t.txt").read_text()
+        # Falls back to the binary for unsupported flags
+        assert Cap(echo_("a b") | tr("-s", " ")) == "a b"
+        res = Run(Command("yes") | head("-n1", pipefail=True), o=None)
+        assert res.stages[0].retcode == -13
+        res = Run(cat_ | cat_, input="x", timeout=0.1, capture=True)
+        assert res.stdout == "x"
+    finally:
+        set_spawn_backend(prev)
+
+
+def test_builtin_only_system_binaries(tmp_path, monkeypatch):
+    script = tmp_path / "cat"
+    script.write_text("#!/bin/sh\necho mine\n")
+    script.chmod(0o755)
+    prev = set_spawn_backend(BuiltinBackend())
+    try:
+        assert Cap(Command("./cat"), cwd=tmp_path, input="x") == "mine"
+        assert Cap(Command(str(script)), input="x") == "mine"
+        monkeypatch.setenv("PATH", f"{tmp_path}:{os.environ['PATH']}")
+        assert Cap(cat_, input="x") == "mine"
+    finally:
+        set_spawn_backend(prev)
@@ -0,0 +1,65 @@
+import os
+import time
+
+from pysh import *
+
+
+def test_cache_hits(tmp_path):
+    cache = ResultCache(maxsize=2)
+    date = Command("date", "+%N")
+    first = Cap(date, cache=cache)
+    assert Cap(date, cache=cache) == first
+    assert Cap(date, "-u", cache=cache) != first
+    assert Cap(date, cache=cache, input="x") != first
+    assert (cache.hits, cache.misses, len(cache)) == (1, 3, 2)
+    # Evicted as least recently used
+    assert Cap(date, cache=cache) != first
+    # Failures are results too, side effects are not cached
+    assert Run("false", cache=cache).retcode == 1
+    Run(date, o=tmp_path / "o.txt", cache=cache)
+    assert (tmp_path / "o.txt").read_text() != ""
+    assert (cache.hits, cache.misses) == (1, 5)
+
+
+def test_cache_copies():
+    cache = ResultCache()
+    res = Run("echo", "x", capture=True, cache=cache)
+    stdout = res.stdout
+    # Whoever changes a result only changes their copy
+    res.stdout, res.retcode = "changed", 5
+    res.stages.clear()
+    hit = Run("echo", "x", capture=True, cache=cache)
+    assert (hit.stdout, hit.retcode, len(hit.stages)) == (stdout, 0, 1)
+    hit.stages[0].retcode = 7
+    assert Run("echo", "x", capture=True, cache=cache).stages[0].retcode == 0
+    list(Parallel(Command("echo", "y"), [()] * 64, jobs=8, cache=cache))
+    assert cache.hits + cache.misses == 67
+
+
+def test_cache_invalidation(tmp_path):
+    dep = tmp_path / "dep"
+    dep.write_text("a")
+    cache = ResultCache(ttl=0.2, depends=["dep"])
+    cat = cat_(cwd=tmp_path)
+    assert Cap(cat, "dep", cache=cache) == "a"
+    dep.write_text("b")
+    os.utime(dep, ns=(0, 1))
+    assert Cap(cat, "dep", cache=cache) == "b"
+    assert Cap(cat, "dep", cache=cache) == "b" and cache.hits == 1
+    time.sleep(0.3)
+    assert Cap(cat, "dep", cache=cache) == "b" and cache.hits == 1
+    # Input files are dependencies
+    (tmp_path / "i").write_text("x")
+    assert Cap(cat_, i=tmp_path / "i", cache=cache) == "x"
+    (tmp_path / "i").write_text("y")
+    os.utime(tmp_path / "i", ns=(0, 1))
+    assert Cap(cat_, i=tmp_path / "i", cache=cache) == "y"
+
+
+def test_cache_on_disk(tmp_path):
+    date = Command("date", "+%N")
+    first = Cap(date, cache=ResultCache(path=tmp_path))
+    cache = ResultCache(path=tmp_path)
+    assert Cap(date, cache=cache) == first and cache.hits == 1
+    cache.clear()
+    assert Cap(date, cache=ResultCache(path=tmp_path)) != first
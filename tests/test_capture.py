@@ -0,0 +1,72 @@
+import asyncio
+import tracemalloc
+
+import pytest
+
+from pysh import *
+from pysh.utils import size_to_bytes
+
+MiB = 1 << 20
+seq = Command("seq")
+
+
+def test_keep_head_tail():
+    assert Cap(seq("1000"), keep=KeepHead(6)) == "1\n2\n3"
+    assert Cap(seq("1000"), keep=KeepTail("9")) == "999\n1000"
+    res = Run(seq("5"), capture=True, keep=(KeepHead(100), KeepTail(0)))
+    assert res.stdout == "1\n2\n3\n4\n5\n" and res.stderr == ""
+    # The tail of stderr only
+    cmd = Command("sh", "-c", "seq 100000 >&2; exit 2")
+    res = Run(cmd, capture=True, keep=(None, KeepTail(7)))
+    assert not res and res.stderr == "100000\n"
+
+
+def test_keep_cut_characters():
+    res = Run(echo_("-n", "ééé"), o=-1, keep=KeepHead(3))
+    assert res.stdout == "é"
+    res = Run(echo_("-n", "ééé"), o=-1, keep=KeepTail(3))
+    assert res.stdout == "é"
+    res = asyncio.run(ARun(echo_("-n", "ééé"), o=-1, keep=KeepTail(5), text=False))
+    assert res.stdout == "ééé".encode()[-5:]
+
+
+def test_keep_tail_memory():
+    cmd = Command("head", "-c", str(64 * MiB), "/dev/zero")
+    tracemalloc.start()
+    try:
+        res = Run(cmd, o=-1, keep=KeepTail("4KiB"), text=False)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert res.stdout == bytes(4096)
+    assert peak < 4 * MiB
+
+
+def test_spill():
+    with Run(seq("100000"), o=-1, keep=Spill("64KiB")).stdout as out:
+        assert isinstance(out, SpilledOutput) and out.size == 588895
+        assert len(out) == 100000
+        assert out[0] == "1" and out[-1] == "100000" and out[41:43] == ["42", "43"]
+        assert list(out)[:2] == ["1", "2"] and sum(1 for _ in out) == 100000
+        assert str(out) == Cap(seq("100000"), strip=False)
+    # Small outputs stay in memory, with the same interface
+    out = Cap(seq("3"), keep=Spill(), text=False)
+    assert out[:] == [b"1", b"2", b"3"] and bytes(out) == b"1\n2\n3\n"
+    with pytest.raises(IndexError):
+        out[3]
+
+
+@pytest.mark.parametrize("data", ["", "a", "a\n", "\n", "a\n\n", "a\n\nb"])
+def test_spilled_lines(data):
+    out = Cap(Command("printf", "%s", data), keep=Spill(0))
+    lines = data.split("\n")[:-1] if data.endswith("\n") else data.split("\n")
+    lines = lines if data else []
+    assert list(out) == out[:] == lines
+
+
+def test_size_to_bytes():
+    assert size_to_bytes(10) == size_to_bytes("10") == 10
+    assert size_to_bytes("4K") == size_to_bytes("4KiB") == 4096
+    assert size_to_bytes("1 gb") == 1 << 30
+    with pytest.raises(ValueError):
+        size_to_bytes("4 kilobytes")
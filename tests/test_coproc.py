@@ -0,0 +1,97 @@
+import sys
+import threading
+
+import pytest
+
+from pysh import *
+from pysh.coproc import FrameReader
+
+double = Command("sh", "-c", 'while read l; do echo "$l$l"; done')
+
+
+def test_coproc_lines():
+    with Coproc(double) as co:
+        assert co.request("ab") == "abab"
+        assert co.request(b"c\n") == "cc"
+        co.send("x")
+        assert co.recv() == "xx"
+    # Large messages do not deadlock even though cat answers while we write
+    with Coproc(cat_, text=False) as co:
+        big = b"x" * (1 << 22)
+        assert co.request(big) == big
+
+
+def test_coproc_length_prefixed():
+    echo = "import sys\nwhile h := sys.stdin.buffer.read(4):\n"
+    echo += (
+        "    sys.stdout.buffer.write(h + sys.stdin.buffer.read(int.from_bytes(h)))\n"
+    )
+    echo += "    sys.stdout.flush()\n"
+    with Coproc(sys.executable, "-c", echo, framing=LengthPrefixFraming()) as co:
+        assert co.request("a\nb") == "a\nb"
+        assert co.request("") == ""
+
+
+class CatFileFraming(LineFraming):
+    """git cat-file --batch: a header line, then the contents and a newline."""
+
+    def decode(self, reader: FrameReader) -> bytes:
+        header = super().decode(reader)
+        size = int(header.split()[2])
+        return reader.read_exact(size + 1)[:-1]
+
+
+def test_coproc_custom_framing(tmp_path):
+    repo = git("-C", tmp_path, "-c", "user.name=t", "-c", "user.email=t@t")
+    Run(repo("init", "-q"))
+    Run(repo("commit", "-q", "--allow-empty", "-m", "init"))
+    with Coproc(repo("cat-file", "--batch"), framing=CatFileFraming()) as co:
+        assert co.request("HEAD").startswith("tree ")
+
+
+def test_coproc_restart():
+    co = Coproc("sh", "-c", "read l; echo oops >&2; exit 3")
+    with pytest.raises(PyShCoprocError) as e:
+        co.request("x")
+    assert e.value.stderr == b"oops\n" and "retcode 3" in str(e.value)
+    with pytest.raises(PyShCoprocError):
+        co.request("x")
+    assert co.restarts == 1
+    co.close()
+    co = Coproc("sleep", "5", restart=False)
+    with pytest.raises(PyShCoprocError, match="timed out"):
+        co.request("x", timeout=0.1)
+    with pytest.raises(PyShCoprocError, match="exited"):
+        co.request("x")
+    co.close()
+    with pytest.raises(PyShCoprocError, match="closed"):
+        co.request("x")
+
+
+def test_coproc_pool():
+    results = {}
+    with CoprocPool(double, size=3) as pool:
+
+        def work(n: int) -> None:
+            for i in range(20):
+                results[n, i] = pool.request(f"{n}-{i}")
+
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(pool._all) == 3
+    assert all(res == f"{n}-{i}" * 2 for (n, i), res in results.items())
+    assert len(results) == 120
+
+
+def test_coproc_pool_no_restart():
+    slow = 'while read l; do [ "$l" = slow ] && sleep 5; echo "$l$l"; done'
+    with CoprocPool("sh", "-c", slow, size=1, restart=False) as pool:
+        assert pool.request("a") == "aa"
+        with pytest.raises(PyShCoprocError, match="timed out"):
+            pool.request("slow", timeout=0.1)
+        # The instance killed on timeout is replaced
+        assert pool.request("b") == "bb"
+        assert len(pool._all) == 1
@@ -0,0 +1,44 @@
+import os
+
+import pytest
+
+from pysh import *
+
+
+@pytest.fixture(scope="module")
+def forkserver():
+    backend = ForkServerBackend()
+    prev = set_spawn_backend(backend)
+    yield backend
+    set_spawn_backend(prev)
+    backend.close()
+
+
+def test_forkserver_spawns(forkserver):
+    ppid = int(Cap("sh", "-c", "echo $PPID"))
+    assert ppid != os.getpid() and ppid == forkserver._server.pid
+
+
+def test_forkserver_results(forkserver, tmp_path):
+    assert Cap(echo_("hello") | sed("s/h/j/")) == "jello"
+    res = Run(ls_("/NonEXISTENT", "."), capture=True)
+    assert not res and res.retcode == 2 and res.stdout != "" and res.stderr != ""
+    assert res.rusage is not None and res.rusage.maxrss > 0
+    res = Run(ls_("/NonEXISTENT", "."), eo=1, capture=True)
+    assert res.stdout != "" and res.stderr == ""
+    Run(echo_("x"), o=tmp_path / "o.txt")
+    assert Cap(cat_, i=tmp_path / "o.txt") == "x"
+    assert Cap(cat_, input="abc") == "abc"
+    assert Cap("pwd", cwd=tmp_path) == str(tmp_path)
+    with ChDir(tmp_path):
+        assert Cap("pwd") == str(tmp_path)
+        (tmp_path / "sub").mkdir()
+        assert Cap("pwd", cwd="sub") == str(tmp_path / "sub")
+    assert Run("sleep", "5", timeout=0.1).kind == CommitResKind.TIMEOUT
+    with pytest.raises(FileNotFoundError):
+        Run("CrAzY-NoNeXiStEnT-CoMmAnD")
+
+
+def test_forkserver_env(forkserver, monkeypatch):
+    monkeypatch.setenv("PYSH_TEST_VAR", "42")
+    assert Cap("sh", "-c", "echo $PYSH_TEST_VAR") == "42"
@@ -0,0 +1,73 @@
+import os
+import threading
+
+import pytest
+
+from pysh import *
+
+
+def test_here_string(tmp_path):
+    assert Cap("cat", ii="a\nb") == "a\nb"
+    assert Cap(Command("wc", "-c"), ii=b"\0" * 100000) == "100000"
+    assert Cap(Command("tail", "-c2"), ii=memoryview(b"abcd")) == "cd"
+    assert Cap(Command("cat", ii="aa") | Command("tr", "a", "b")) == "bb"
+    assert str(Command("cat", ii="x") | Command("wc")) == "cat < <heredoc> | wc"
+    with pytest.raises(ValueError):
+        Run("cat", i=tmp_path / "x", ii="x")
+    # A Session's stdin does not override it
+    (tmp_path / "in").write_text("file")
+    with Session(cwd=tmp_path, i="in"):
+        assert Cap("cat", ii="data") == "data"
+        assert Cap("cat") == "file"
+
+
+def test_heredoc_reused():
+    with HereDoc("é\n" * 1000) as doc:
+        assert doc.size == 3000
+        # Every command reads it from the start, even several at once
+        assert Cap(Command("tail", "-n1"), ii=doc) == "é"
+        assert Cap(Command("wc", "-l"), ii=doc) == "1000"
+        results = [Run(Command("wc", "-c"), ii=doc, o=-1) for _ in range(4)]
+        assert {res.stdout for res in results} == {"3000\n"}
+        threads = [
+            threading.Thread(
+                target=Run, args=(Command("cat"),), kwargs={"ii": doc, "o": None}
+            )
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    with pytest.raises(ValueError):
+        doc.open()
+
+
+def test_heredoc_sealed():
+    with HereDoc(b"data") as doc, doc.open() as file:
+        if hasattr(os, "memfd_create"):
+            with pytest.raises(OSError):
+                os.write(os.open(f"/proc/self/fd/{file.fileno()}", os.O_WRONLY), b"x")
+        assert file.read() == b"data"
+
+
+def test_heredoc_batch_cache():
+    with Batch():
+        assert Cap("cat", ii="batched") == "batched"
+    cache = ResultCache()
+    with HereDoc("x") as doc:
+        for _ in range(2):
+            assert Cap("cat", ii=doc, cache=cache) == "x"
+            assert Cap("cat", ii="y", cache=cache) == "y"
+    assert cache.hits == 2
+
+
+def test_heredoc_persistent_cache(tmp_path):
+    # A new cache for each, as in a new process
+    with HereDoc("a") as doc:
+        assert Cap("cat", ii=doc, cache=ResultCache(path=tmp_path)) == "a"
+    with HereDoc("b") as doc:
+        assert Cap("cat", ii=doc, cache=ResultCache(path=tmp_path)) == "b"
+    cache = ResultCache(path=tmp_path)
+    with HereDoc("a") as doc:
+        assert Cap("cat", ii=doc, cache=cache) == "a" and cache.hits == 1
@@ -0,0 +1,48 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+# Imported on first use only. Timings are too noisy for CI, so we check which
+# modules an import pulls in, as reported by -X importtime.
+HEAVY = {"asyncio", "concurrent.futures", "hashlib", "json", "pickle", "shutil"}
+
+
+def imported(stmt: str) -> set[str]:
+    env = os.environ | {"PYTHONPATH": os.pathsep.join(sys.path)}
+    res = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", stmt],
+        env=env,
+        stderr=subprocess.PIPE,
+        text=True,
+        check=True,
+    )
+    return {
+        line.rsplit("|", 1)[1].strip()
+        for line in res.stderr.splitlines()
+        if line.startswith("import time:") and line.count("|") == 2
+    }
+
+
+def test_import_pysh():
+    modules = imported("import pysh")
+    assert "pysh" in modules
+    assert not {m for m in modules if m.startswith("pysh.")} - {"pysh.prelude"}
+
+
+@pytest.mark.parametrize(
+    "stmt", ["from pysh import Run, Cap", "from pysh import *; Run('true')"]
+)
+def test_no_heavy_imports(stmt):
+    assert "pysh.command" in imported(stmt)
+    assert not HEAVY & imported(stmt)
+
+
+def test_lazy_names():
+    import pysh
+
+    assert set(dir(pysh)) >= set(pysh.__all__)
+    assert pysh.sort.args == ("sort",) and pysh.ls_.args == ("ls",)
+    with pytest.raises(AttributeError):
+        pysh.nonexistent
@@ -0,0 +1,67 @@
+import os
+import time
+
+import pytest
+
+from pysh import *
+
+echo = Command("echo")
+
+
+def test_parallel_ordered():
+    res = list(Parallel([echo("a"), echo("b"), "true"], o=None))
+    assert len(res) == 3 and all(res)
+    res = Parallel(echo, [("x", "y"), "z"], capture=True)
+    assert [r.stdout for r in res] == ["x y\n", "z\n"]
+
+
+def test_parallel_concurrent():
+    start = time.perf_counter()
+    res = list(Parallel("sleep", ["0.3"] * 4, jobs=4))
+    assert all(res)
+    assert time.perf_counter() - start < 1.0
+
+
+def test_parallel_unordered():
+    res = Parallel("sleep", ["0.4", "0"], jobs=2, ordered=False)
+    assert [r.elapsed < 0.2 for r in res] == [True, False]
+
+
+def test_parallel_failfast():
+    cmds = ["false"] + ["true"] * 10
+    res = list(Parallel(cmds, jobs=1, failfast=True))
+    assert len(res) == 1 and not res[0]
+    assert len(list(Parallel(cmds, jobs=1))) == 11
+
+
+def test_xargs():
+    items = [str(i) for i in range(300000)]
+    res = Xargs(Command("echo"), items, capture=True)
+    assert res and res.stdout.split() == items
+    assert 1 < len(res.stages) < 10
+    res = Xargs("echo", items[:10], max_args=3, jobs=3, capture=True)
+    assert res.stdout == "0 1 2\n3 4 5\n6 7 8\n9\n" and len(res.stages) == 4
+    res = Xargs("echo", ["aaaa", "bbbb", "cccc"], max_chars=40, capture=True)
+    assert len(res.stages) == 2
+    assert Xargs(rm_, []) and Xargs("false", "ab").retcode == 1
+
+
+def test_xargs_session_env():
+    # Close to ARG_MAX once exported, each variable under MAX_ARG_STRLEN
+    big = os.sysconf("SC_ARG_MAX") // 20
+    env = {f"PYSH_BIG{i}": "x" * big for i in range(18)}
+    items = [str(i) for i in range(100000)]
+    with Session(env=env):
+        res = Xargs(Command("true"), items)
+    assert res and len(res.stages) > 1
+
+
+def test_xargs_redirections(tmp_path):
+    out = tmp_path / "out"
+    Xargs("echo", map(str, range(10)), max_args=3, a=out)
+    assert out.read_text() == "0 1 2\n3 4 5\n6 7 8\n9\n"
+    Xargs("echo", map(str, range(10)), max_args=3, jobs=2, a=out, e=None)
+    assert sorted(out.read_text().split()) == sorted(2 * list(map(str, range(10))))
+    for kwargs in [{"o": out}, {"e": str(out)}, {"stdout": out}]:
+        with pytest.raises(ValueError):
+            Xargs("echo", ["x"], **kwargs)
@@ -0,0 +1,72 @@
+import itertools
+import os
+import time
+import tracemalloc
+
+from pysh import *
+
+
+def test_stages():
+    # seq might get SIGPIPE if false exits first, true never writes
+    res = Run(Command("true") | Command("false") | sort, o=None)
+    assert res and res.retcode == 0
+    assert [s.args[0] for s in res.stages] == ["true", "false", "sort"]
+    assert [s.retcode for s in res.stages] == [0, 1, 0]
+    assert all(s.pid > 0 and s.elapsed is not None for s in res.stages)
+
+
+def test_pipefail():
+    for _ in range(20):
+        # Whether seq gets SIGPIPE or is killed, false is the last to fail
+        cmd = Command("seq", "3") | Command("false") | sort(pipefail=True)
+        res = Run(cmd, o=None)
+        assert not res and res.retcode == 1
+    # a failing stage kills the rest of the pipeline right away
+    start = time.perf_counter()
+    res = Run(Command("sleep", "5") | Command("sh", "-c", "exit 3", pipefail=True))
+    assert res.retcode == 3 and time.perf_counter() - start < 2
+    assert res.stages[0].retcode != 0
+
+
+def test_input():
+    assert Cap("cat", input="abc") == "abc"
+    assert Cap(cat_ | sort, input="b\na\n") == "a\nb"
+    assert Cap(sort, input="".join(f"{i}\n" for i in range(100000)))
+
+
+def test_streaming_input(tmp_path):
+    def lines():
+        for i in range(3):
+            yield f"{i}\n"
+
+    assert Cap(cat_ | sort("-r"), input=lines) == "2\n1\n0"
+    assert Cap("cat", input=[b"a", "b", b""]) == "ab"
+    (tmp_path / "in").write_bytes(b"x" * 200000)
+    with open(tmp_path / "in", "rb") as f:
+        assert Cap("wc", "-c", input=f) == "200000"
+    # Chunks are produced as the command reads them, memory stays flat
+    chunk = b"\0" * 65536
+    tracemalloc.start()
+    try:
+        assert Cap("wc", "-c", input=(chunk for _ in range(1024))) == str(64 << 20)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert peak < 4 << 20
+    # Production stops once the command stops reading
+    assert Cap(head("-c", "3"), input=itertools.repeat(b"abc\n")) == "abc"
+
+
+def test_no_fd_leak(tmp_path):
+    before = len(os.listdir("/proc/self/fd"))
+    for _ in range(20):
+        Run(echo_("x") | cat_ | cat_, o=tmp_path / "o.txt", e=tmp_path / "e.txt")
+        Run(cat_, i=tmp_path / "o.txt", a=tmp_path / "o.txt")
+    assert len(os.listdir("/proc/self/fd")) == before
+
+
+def test_pipeline_object():
+    with Pipeline(Command("seq", "3") | sort("-r", o=-1)) as p:
+        p.spawn()
+        res = p.communicate()
+    assert res.stdout == "3\n2\n1\n" and len(res.stages) == 2
@@ -0,0 +1,100 @@
+import time
+
+import pytest
+
+from pysh import *
+from pysh.plan import NodeStatus
+
+
+def test_plan_parallel():
+    plan = Plan(jobs=4)
+    nodes = [plan.add("sleep", "0.3") for _ in range(4)]
+    start = time.monotonic()
+    assert plan.run()
+    assert time.monotonic() - start < 1
+    assert all(node.status == NodeStatus.SUCCESS for node in nodes)
+
+
+def test_plan_order(tmp_path):
+    src, mid, dst = tmp_path / "src", tmp_path / "mid", tmp_path / "dst"
+    src.write_text("b\na\n")
+    plan = Plan()
+    # Added out of order, the input of sort is the output of cat
+    last = plan.add("sort", i=mid, o=dst)
+    first = plan.add("cat", src, o=mid, inputs=[src])
+    assert plan.run()
+    assert dst.read_text() == "a\nb\n"
+    assert last.result and first.result
+
+    # Outputs newer than inputs are skipped
+    assert plan.run()
+    assert first.status == last.status == NodeStatus.SKIPPED
+    src.write_text("c\n")
+    time.sleep(0.01)
+    assert plan.run() and first.status == NodeStatus.SUCCESS
+    assert dst.read_text() == "c\n"
+
+
+def test_plan_state(tmp_path):
+    src, dst = tmp_path / "src", tmp_path / "dst"
+    src.write_text("x")
+    plan = Plan(state=tmp_path / "state")
+    node = plan.add("cp", src, dst, inputs=[src], outputs=[dst])
+    assert plan.run() and node.status == NodeStatus.SUCCESS
+    # Touched but unchanged, the hash still matches
+    time.sleep(0.01)
+    src.touch()
+    assert plan.run() and node.status == NodeStatus.SKIPPED
+    src.write_text("y")
+    assert plan.run() and node.status == NodeStatus.SUCCESS
+
+
+def test_plan_session(tmp_path):
+    (tmp_path / "sub").mkdir()
+    plan = Plan()
+    with Session(cwd=tmp_path / "sub"):
+        node = plan.add(Command("sh", "-c", "echo hi"), o="out.txt")
+        assert node.outputs == [tmp_path / "sub" / "out.txt"]
+        assert plan.run() and node.status == NodeStatus.SUCCESS
+        assert plan.run() and node.status == NodeStatus.SKIPPED
+    assert (tmp_path / "sub" / "out.txt").read_text() == "hi\n"
+
+
+def test_plan_state_failure(tmp_path):
+    src, dst = tmp_path / "src", tmp_path / "dst"
+    src.write_text("ok")
+    plan = Plan(state=tmp_path / "state")
+    cmd = Command("sh", "-c", f"grep -q ok {src} && cp {src} {dst}")
+    node = plan.add(cmd, inputs=[src], outputs=[dst])
+    assert plan.run()
+    time.sleep(0.01)
+    src.write_text("bad")
+    assert not plan.run()
+    # Same inputs as the last success, but the last run failed
+    src.write_text("ok")
+    assert plan.run() and node.status == NodeStatus.SUCCESS
+
+
+def test_plan_failure():
+    plan = Plan(jobs=1)
+    bad = plan.add("false")
+    after = plan.add("true", after=[bad])
+    other = plan.add("true")
+    assert not plan.run()
+    assert plan.failed() == [bad]
+    assert after.status == other.status == NodeStatus.NOT_RUN
+
+    plan.keep_going = True
+    assert not plan.run()
+    assert after.status == NodeStatus.NOT_RUN
+    assert other.status == NodeStatus.SUCCESS
+
+
+def test_plan_errors(tmp_path):
+    plan = Plan()
+    plan.add("cat", i=tmp_path / "a", o=tmp_path / "b")
+    plan.add("cat", i=tmp_path / "b", o=tmp_path / "a")
+    with pytest.raises(PyShError):
+        plan.run()
+    with pytest.raises(ValueError):
+        Plan().add("true", after=[plan.nodes[0]])
@@ -0,0 +1,50 @@
+import asyncio
+import re
+
+import pytest
+
+from pysh import *
+
+seq = Command("seq")
+
+
+def test_pyfilter():
+    evens = PyFilter(lambda line: int(line) % 2 == 0)
+    assert Cap(seq("6") | evens | PyFilter(lambda line: line + "!")) == "2!\n4!\n6!"
+    assert (
+        Cap(seq("3") | PyFilter(lambda line: None if line == "2" else line)) == "1\n3"
+    )
+    assert Cap(PyFilter(str.upper), input="ab\ncd") == "AB\nCD"
+    # Any true result keeps the line
+    assert Cap(seq("12") | PyFilter(re.compile("1$").search)) == "1\n11"
+    assert Cap(seq("3") | PyFilter(lambda line: int(line) - 2)) == "1\n3"
+    assert Cap(seq("2") | PyFilter(bytes.upper, text=False), text=False) == b"1\n2"
+
+
+def test_pyfilter_generator():
+    def numbered(lines):
+        for n, line in enumerate(lines, 1):
+            yield f"{n}: {line}"
+
+    assert Cap(echo_("a\nb") | PyFilter(numbered) | sort("-r")) == "2: b\n1: a"
+
+
+def test_pyfilter_long_line():
+    line = Command("head", "-c", str(16 << 20), "/dev/zero") | tr("\\0", "x")
+    assert Cap(line | PyFilter(len)) == "x" * (16 << 20)
+
+
+def test_pyfilter_streams():
+    # Endless input, the stages stop once head exits
+    res = Run(seq("inf") | PyFilter(lambda line: line) | head("-n2"), o=-1)
+    assert res.stdout == "1\n2\n"
+    res = Run(seq("inf") | PyFilter(lambda line: False), timeout=0.2)
+    assert res.kind == CommitResKind.TIMEOUT
+
+
+def test_pyfilter_errors():
+    res = Run(seq("3") | PyFilter(lambda line: 1 / int(line) / 0), capture=True)
+    assert not res and res.stages[1].retcode == 1
+    assert res.stderr == "PyFilter: float division by zero\n"
+    with pytest.raises(PyShError):
+        asyncio.run(ARun(seq("3") | PyFilter(str.upper)))
@@ -0,0 +1,81 @@
+import asyncio
+import os
+import threading
+
+import pytest
+
+from pysh import *
+
+
+def test_session_cwd(tmp_path):
+    (tmp_path / "sub").mkdir()
+    cwd = os.getcwd()
+    with Session(cwd=tmp_path):
+        assert Cap("pwd") == str(tmp_path) and os.getcwd() == cwd
+        Run(echo_("x"), o="out")
+        assert (tmp_path / "out").read_text() == "x\n"
+        assert Cap(cat_, i="out") == "x"
+        assert Cap("pwd", cwd="sub") == str(tmp_path / "sub")
+        with Session(cwd="sub"):
+            assert Cap("pwd") == str(tmp_path / "sub")
+            assert Cap(ls_("..")) == "out\nsub"
+        assert asyncio.run(ACap("pwd")) == str(tmp_path)
+        with Stream("pwd") as lines:
+            assert list(lines) == [str(tmp_path)]
+    assert Cap("pwd") == cwd
+    with pytest.raises(NotADirectoryError):
+        Session(cwd=tmp_path / "missing").__enter__()
+
+
+def test_session_env(monkeypatch):
+    monkeypatch.setenv("PYSH_A", "a")
+    echo = Command("sh", "-c", 'echo "$PYSH_A $PYSH_B"')
+    with Session(env={"PYSH_B": "b"}):
+        assert Cap(echo) == "a b"
+        with Session(env={"PYSH_A": None, "PYSH_B": "c"}):
+            assert Cap(echo) == "c"
+        assert Cap(echo) == "a b"
+        # A whole environment given to the command wins
+        assert Cap(echo, env={"PYSH_A": "x"}) == "x"
+    assert "PYSH_B" not in os.environ
+
+
+def test_session_redirections(tmp_path, capfd):
+    with Session(cwd=tmp_path, a="log", e=None):
+        Run(echo_("a"))
+        Run(Command("sh", "-c", "echo err >&2") | Command("cat"))
+        # Explicit redirections, and captures, win
+        assert Cap(echo_("b")) == "b"
+        res = Run(Command("sh", "-c", "echo err >&2"), capture=True)
+        assert res.stderr == "err\n"
+        with Session(i="log"):
+            assert Cap("cat") == "a"
+            assert Cap("cat", input="c") == "c"
+    assert (tmp_path / "log").read_text() == "a\n"
+    assert capfd.readouterr().err == ""
+    with pytest.raises(TypeError):
+        Session(pipefail=True)
+
+
+def test_session_threads(tmp_path):
+    dirs = [tmp_path / str(n) for n in range(8)]
+    errors = []
+
+    def work(path):
+        path.mkdir()
+        with Session(cwd=path):
+            for _ in range(10):
+                if Cap("pwd") != str(path):
+                    errors.append(path)
+
+    threads = [threading.Thread(target=work, args=(path,)) for path in dirs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    # Parallel runs in the session of its caller
+    with Session(cwd=dirs[0]):
+        assert [res.stdout for res in Parallel("pwd", [()] * 3, o=-1)] == [
+            f"{dirs[0]}\n"
+        ] * 3
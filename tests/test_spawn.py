@@ -0,0 +1,58 @@
+import os
+import signal
+
+import pytest
+
+from pysh import *
+from pysh.spawn import ExecutableCache
+
+
+@pytest.fixture(params=[PopenBackend, PosixSpawnBackend])
+def backend(request):
+    prev = set_spawn_backend(request.param())
+    yield
+    set_spawn_backend(prev)
+
+
+def test_backend_redirections(backend, tmp_path):
+    assert Cap(echo_("hello") | sed("s/h/j/")) == "jello"
+    res = Run(ls_("/NonEXISTENT", "."), capture=True)
+    assert res.stdout != "" and res.stderr != ""
+    res = Run(ls_("/NonEXISTENT", "."), eo=1, capture=True)
+    assert res.stdout != "" and res.stderr == ""
+    Run(echo_("x"), a=tmp_path / "a.txt")
+    Run(echo_("y"), a=tmp_path / "a.txt", e=0)
+    assert Cap(cat_, i=tmp_path / "a.txt") == "x\ny"
+    assert Cap(cat_, input="abc") == "abc"
+    assert Cap("pwd", cwd=tmp_path) == str(tmp_path)
+    env = {"PATH": os.environ["PATH"], "PYSH_TEST": "x"}
+    assert Cap("sh", "-c", "echo $PYSH_TEST $HOME", env=env) == "x"
+
+
+def test_backend_signals(backend):
+    # SIGPIPE is restored to default in the children
+    res = Run(Command("yes") | head("-n1", pipefail=True), o=None)
+    assert res.stages[0].retcode == -13
+    assert Run("sleep", "5", timeout=0.1).kind == CommitResKind.TIMEOUT
+    with pytest.raises(FileNotFoundError):
+        Run("CrAzY-NoNeXiStEnT-CoMmAnD")
+
+
+def test_sigdef_names():
+    for name in PosixSpawnBackend.SIGDEF_NAMES:
+        assert getattr(signal, name) in PosixSpawnBackend.SIGDEF
+
+
+def test_executable_cache(tmp_path, monkeypatch):
+    cache = ExecutableCache()
+    prog = tmp_path / "prog"
+    prog.write_text("#!/bin/sh\necho prog\n")
+    prog.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path}:{os.environ['PATH']}")
+    assert cache.resolve("prog") == str(prog)
+    prog.unlink()
+    assert cache.resolve("prog") == str(prog)
+    cache.invalidate("prog")
+    with pytest.raises(FileNotFoundError):
+        cache.resolve("prog")
+    assert cache.resolve("/bin/sh") == "/bin/sh"
@@ -0,0 +1,58 @@
+import pytest
+
+from pysh import *
+from pysh.utils import split_lines
+
+
+def test_stream_lines():
+    s = Stream("seq", "3")
+    assert s.result is None
+    assert list(s) == ["1", "2", "3"]
+    assert s.result and s.retcode == 0
+    assert list(Stream(Command("seq", "3") | sort("-r"), keepends=True)) == [
+        "3\n",
+        "2\n",
+        "1\n",
+    ]
+
+
+def test_stream_long_lines():
+    # A line spanning hundreds of reads, then lines split across reads
+    line = Command("head", "-c", str(16 << 20), "/dev/zero") | tr("\\0", "x")
+    assert [len(x) for x in Stream(line, text=False)] == [16 << 20]
+    assert list(split_lines([b"a", b"b\nc", b"", b"d\n\ne"], b"\n")) == [
+        b"ab",
+        b"cd",
+        b"",
+        b"e",
+    ]
+
+
+def test_stream_chunks():
+    data = b"".join(Stream("head", "-c", "100000", "/dev/zero", chunk=4096))
+    assert data == bytes(100000)
+    for chunk in Stream("head", "-c", "100000", "/dev/zero", chunk=4096):
+        assert 0 < len(chunk) <= 4096
+
+
+def test_stream_early_close():
+    with Stream("yes") as s:
+        assert next(s) == "y"
+    assert s.result is not None and s.retcode != 0
+
+
+def test_stream_failure():
+    s = Stream(ls_("/NonEXISTENT"), e=0)
+    assert list(s) == [] and not s.result
+    with pytest.raises(PyShCommitError):
+        list(Stream("false", strict=True))
+    s = Stream("sleep", "5", timeout=0.1)
+    assert list(s) == [] and s.result.kind == CommitResKind.TIMEOUT
+
+
+def test_stream_decoding():
+    # multi-byte characters split across reads are decoded correctly
+    s = Stream(Command("printf", "h\\303\\251\\nx\\377\\n"), errors="replace")
+    assert list(s) == ["hé", "x�"]
+    s = Stream(Command("printf", "a\\r\\nb\\377"), text=False)
+    assert list(s) == [b"a", b"b\xff"]
@@ -0,0 +1,41 @@
+from pathlib import Path
+
+import pytest
+
+from pysh import *
+
+MiB = 1 << 20
+
+
+@pytest.mark.parametrize("spliced", [True, False])
+def test_tee(tmp_path, spliced):
+    data = tmp_path / "data"
+    Run("head", "-c", str(8 * MiB), "/dev/urandom", o=data)
+    count = Command("wc", "-c", o=tmp_path / "count")
+    tee = Tee(count, tmp_path / "copy", o=tmp_path / "stdout")
+    # Input from a pipe is spliced, from a file it is read
+    res = Run(cat_(data) | tee) if spliced else Run(tee, i=data)
+    assert res
+    assert (tmp_path / "count").read_text().strip() == str(8 * MiB)
+    assert (tmp_path / "copy").read_bytes() == data.read_bytes()
+    assert (tmp_path / "stdout").read_bytes() == data.read_bytes()
+
+
+def test_tee_outputs_exit():
+    zeros = Command("head", "-c", str(4 * MiB), "/dev/zero")
+    # head stops reading early, the other outputs still get everything
+    res = Run(zeros | Tee(head("-c1", o=None)) | Command("wc", "-c"), o=-1)
+    assert res and res.stdout.strip() == str(4 * MiB)
+    res = Run(zeros | Tee(Command("sh", "-c", "cat >/dev/null; exit 3"), o=None))
+    assert not res and res.retcode == 3
+    with pytest.raises(TypeError):
+        Tee("wc")
+
+
+def test_tee_session(tmp_path):
+    (tmp_path / "sub").mkdir()
+    wc = Command("wc", "-c", o="count")
+    with Session(cwd=tmp_path / "sub"):
+        assert Run(echo_("hello") | Tee(wc, Path("copy"), o=None))
+    assert (tmp_path / "sub" / "copy").read_text() == "hello\n"
+    assert (tmp_path / "sub" / "count").read_text().strip() == "6"
@@ -0,0 +1,59 @@
+import asyncio
+import subprocess
+import time
+from pathlib import Path
+
+import pytest
+
+from pysh import *
+from pysh.utils import timeout_to_seconds
+
+
+def alive(pid: int) -> bool:
+    try:
+        return Path(f"/proc/{pid}/stat").read_text().split()[2] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+def test_timeout_to_seconds():
+    assert timeout_to_seconds(5) == 5
+    assert timeout_to_seconds("90") == 90
+    assert timeout_to_seconds("3m24s") == 204
+    assert timeout_to_seconds("1h0.5m") == 3630
+    for bad in ("", "5x", "3m24", "m"):
+        with pytest.raises(ValueError):
+            timeout_to_seconds(bad)
+
+
+def test_timeout_kills_pipeline_and_children():
+    start = time.perf_counter()
+    res = Run(Command("sleep", "30") | cat_, timeout="0.2s")
+    assert res.kind == CommitResKind.TIMEOUT and time.perf_counter() - start < 2
+    assert [stage.retcode for stage in res.stages] == [-15, -15]
+    # The grandchild keeps the pipe open, only killing its group ends this
+    res = Run("sh", "-c", "sleep 30 & echo $!; wait", o=subprocess.PIPE, timeout=0.3)
+    assert res.kind == CommitResKind.TIMEOUT and time.perf_counter() - start < 4
+    time.sleep(0.1)
+    assert not alive(int(res.stdout))
+
+
+def test_timeout_escalates():
+    start = time.perf_counter()
+    res = Run("sh", "-c", "trap '' TERM; sleep 30", timeout=0.2, kill_after=0.3)
+    assert 0.5 <= time.perf_counter() - start < 2
+    assert res.stages[0].retcode == -9
+
+
+def test_deadline():
+    start = time.perf_counter()
+    with Deadline("0.5s") as deadline:
+        assert Run("sleep", "0.1")
+        assert Run("sleep", "5", timeout="1m").kind == CommitResKind.TIMEOUT
+        assert deadline.remaining() == 0
+        res = list(Parallel("sleep", ["5"] * 2))
+        assert all(r.kind == CommitResKind.TIMEOUT for r in res)
+        res = asyncio.run(ARun("sleep", "5"))
+        assert res.kind == CommitResKind.TIMEOUT
+    assert time.perf_counter() - start < 2
+    assert Run("sleep", "0.1")
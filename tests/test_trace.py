@@ -0,0 +1,56 @@
+import asyncio
+import json
+
+import pytest
+
+from pysh import *
+
+
+@pytest.mark.parametrize("backend", [PopenBackend, PosixSpawnBackend])
+def test_rusage(backend):
+    prev = set_spawn_backend(backend())
+    try:
+        burn = Command("sh", "-c", "i=0; while [ $i -lt 20000 ]; do i=$((i+1)); done")
+        res = Run(burn | cat_, o=None)
+    finally:
+        set_spawn_backend(prev)
+    assert all(stage.rusage is not None for stage in res.stages)
+    assert res.stages[0].rusage.cpu > 0 and res.stages[0].rusage.maxrss > 0
+    assert res.rusage.cpu == pytest.approx(sum(s.rusage.cpu for s in res.stages))
+
+
+def test_tracer(tmp_path):
+    tracer = Tracer()
+    prev = set_tracer(tracer)
+    try:
+        Run(echo_("x") | sort, o=None)
+        Cap("pwd", cwd=tmp_path)
+    finally:
+        set_tracer(prev)
+    Run("true")
+    assert [span.args[0] for span in tracer.spans] == ["echo", "sort", "pwd"]
+    assert tracer.spans[2].cwd == str(tmp_path)
+    tracer.export(tmp_path / "trace.json")
+    events = json.loads((tmp_path / "trace.json").read_text())["traceEvents"]
+    assert [e["name"] for e in events] == ["echo x", "sort", "pwd"]
+    assert all(e["ph"] == "X" and e["dur"] >= 0 for e in events)
+    assert "utime" in events[0]["args"]
+    report = tracer.top(2).splitlines()
+    assert len(report) == 3 and report[0].startswith("command")
+
+
+def test_tracer_arun_batch():
+    tracer = Tracer()
+    prev = set_tracer(tracer)
+    try:
+        asyncio.run(ARun(echo_("x") | sort, o=None))
+        with Batch():
+            Run("true")
+            Run(Command("sleep", "0.05") | cat_, o=None)
+    finally:
+        set_tracer(prev)
+    names = [span.args[0] for span in tracer.spans]
+    assert names[:2] == ["echo", "sort"] and "sleep" in names and "true" in names
+    sleep = next(span for span in tracer.spans if span.args[0] == "sleep")
+    assert sleep.end - sleep.start >= 0.05 and sleep.retcode == 0
+    assert "sleep" in tracer.top()
@@ -146,3 +146,36 @@ def test_cd(tmp_path):
             "./c/d",
             "./c/e",
         ]
+
+
+def test_binary():
+    assert Cap(Command("printf", "\\377\\376"), text=False) == b"\xff\xfe"
+    assert Cap(Command("printf", "\\377"), errors="replace") == "�"
+    assert Cap(Command("printf", "\\351t\\351"), encoding="latin-1") == "été"
+    with pytest.raises(UnicodeDecodeError):
+        Cap(Command("printf", "\\377"))
+    res = Run(Command("printf", "\\377", text=False), capture=True)
+    assert res.stdout == b"\xff" and res.stderr == b""
+
+
+def test_immutable():
+    import copy
+    import pickle
+
+    greet = echo("hello")
+    greet_tom = greet("tom", o=None)
+    assert greet.args == ("echo", "hello") and "o" not in greet.kwargs
+    assert greet_tom.args == ("echo", "hello", "tom")
+    with pytest.raises(AttributeError):
+        greet.args = ("echo",)
+    with pytest.raises(TypeError):
+        greet.kwargs["o"] = None
+    pipe = greet | sed("s/h/j/")
+    assert pipe.kwargs["pipefrom"] is greet
+    assert copy.deepcopy(pipe) is pipe
+    assert pickle.loads(pickle.dumps(pipe)) == pipe
+    assert hash(echo("hello")) == hash(greet) and echo("hello") == greet
+    # Unhashable kwargs, e.g. an environment
+    env = echo("x", env={"A": "1"}, data=bytearray(b"y"))
+    assert hash(env) == hash(echo("x", env={"A": "1"}, data=bytearray(b"y")))
+    assert {env: 1}[echo("x", env={"A": "1"}, data=bytearray(b"y"))] == 1